@@ -0,0 +1,74 @@
+import os
+import time
+import shutil
+import tempfile
+from subprocess import Popen, PIPE
+from argparse import ArgumentParser
+from muppet.utils import do_cmd, find_executable
+from muppet.vcs.git import Git
+
+def make_repository(path, git, revisions):
+    os.makedirs(path)
+    do_cmd(git, 'init', '-q', cwd=path)
+    do_cmd(git, 'symbolic-ref', 'HEAD', 'refs/heads/master', cwd=path)
+    # fast-import creates the whole history in a single process
+    stream = []
+    for i in range(revisions):
+        message = 'revision %d\n' % i
+        stream.append('commit refs/heads/master\n')
+        stream.append('committer bench <bench@example.com> %d +0000\n' % (1000000000 + i))
+        stream.append('data %d\n%s' % (len(message), message))
+        stream.append('M 644 inline file\ndata %d\n%d\n\n' % (len(str(i)) + 1, i))
+    p = Popen([git, 'fast-import', '--quiet'], cwd=path, stdin=PIPE)
+    p.communicate(''.join(stream))
+
+def walk(vcs):
+    count = 0
+    rev = vcs['HEAD']
+    while True:
+        count += 1
+        parents = rev.parents
+        if not parents:
+            break
+        rev = parents[0]
+    return count
+
+def walk_forking(git, path):
+    # the access pattern prior to the cat-file backend: one git log per
+    # revision
+    count = 0
+    rev = 'HEAD'
+    while rev:
+        count += 1
+        out = do_cmd(git, 'log', '-1', '--format=raw', rev, cwd=path)
+        rev = None
+        for line in out.splitlines():
+            if line.startswith('parent '):
+                rev = line.split(' ', 1)[1]
+                break
+            if line == '':
+                break
+    return count
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--revisions', type=int, default=300)
+    args = parser.parse_args()
+    git = find_executable('git')
+    workdir = tempfile.mkdtemp()
+    try:
+        repo = os.path.join(workdir, 'repo')
+        make_repository(repo, git, args.revisions)
+        start = time.time()
+        count = walk_forking(git, repo)
+        print("%-20s %4d revisions %8.3fs" % ('fork per query', count, time.time() - start))
+        vcs = Git(git, repo)
+        start = time.time()
+        count = walk(vcs)
+        print("%-20s %4d revisions %8.3fs" % ('cat-file --batch', count, time.time() - start))
+        vcs.close()
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import os
+import time
+import shutil
+import tempfile
+import logging
+from argparse import ArgumentParser
+from stat import S_ISDIR
+from muppet import utils, tree as tree_module
+from muppet.tree import Tree, TreeCopier
+from synthetic import generate_tree, shape_for
+
+class SyscallCounter(object):
+    # counts the filesystem calls made from Python.  The native scandir
+    # implementation takes the entry type from getdents() and performs the
+    # lstat() behind DirEntry.stat() itself, so neither shows up here.
+    names = ('listdir', 'lstat', 'stat')
+
+    def __init__(self):
+        self.counts = dict((name, 0) for name in self.names + ('scandir',))
+        self.originals = {}
+
+    def wrap(self, module, name, key):
+        original = getattr(module, name)
+        self.originals[(module, name)] = original
+        def wrapper(*args, **kwargs):
+            self.counts[key] += 1
+            return original(*args, **kwargs)
+        setattr(module, name, wrapper)
+
+    def __enter__(self):
+        for name in self.names:
+            self.wrap(os, name, name)
+        self.wrap(utils, 'scandir', 'scandir')
+        self.wrap(tree_module, 'scandir', 'scandir')
+        return self
+
+    def __exit__(self, *exc_info):
+        for (module, name), original in self.originals.items():
+            setattr(module, name, original)
+
+def listdir_walk(root):
+    # the access pattern of the loader prior to the scandir rework
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        os.path.exists(os.path.join(path, '.muppetmeta'))
+        for name in os.listdir(path):
+            abs_path = os.path.join(path, name)
+            if S_ISDIR(os.lstat(abs_path).st_mode):
+                stack.append(abs_path)
+
+def scandir_walk(root):
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        for dirent in utils.scandir(path):
+            if dirent.is_dir(follow_symlinks=False):
+                stack.append(dirent.path)
+
+def measure(label, func, *args):
+    with SyscallCounter() as counter:
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+    print("%-24s %8.3fs  %s" % (label, elapsed, ' '.join(
+        '%s=%d' % (name, counter.counts[name]) for name in sorted(counter.counts))))
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--fanout', type=int, default=10)
+    parser.add_argument('--files-per-dir', type=int, default=10)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    workdir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(workdir, 'src')
+        dest = os.path.join(workdir, 'dest')
+        depth = shape_for(args.entries, args.fanout, args.files_per_dir)
+        count = generate_tree(src, depth, args.fanout, args.files_per_dir)
+        print("%d entries, depth %d" % (count, depth))
+        measure('listdir+lstat walk', listdir_walk, src)
+        measure('scandir walk', scandir_walk, src)
+        measure('Tree.from_annotated_fs', Tree.from_annotated_fs, src)
+        tree = Tree.from_annotated_fs(src)
+        os.mkdir(dest)
+        TreeCopier()(dest, src, tree)
+        measure('TreeCopier (dry run)', TreeCopier(dry_run=True), dest, src, tree)
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
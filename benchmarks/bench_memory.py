@@ -0,0 +1,58 @@
+import os
+import sys
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from subprocess import check_output
+from synthetic import generate_tree, shape_for
+
+# run in a fresh interpreter, so that the peak RSS only covers one load
+MEASURE = '''
+import gc, sys, time, resource, logging
+logging.basicConfig(level=logging.ERROR)
+from muppet.tree import Tree
+rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+objects_before = len(gc.get_objects())
+start = time.time()
+if sys.argv[2] == 'walk':
+    # what put-local --stream holds: one directory at a time
+    for directory in Tree.walk_annotated_fs(sys.argv[1]):
+        pass
+else:
+    tree = Tree.from_annotated_fs(sys.argv[1])
+elapsed = time.time() - start
+print("%f %d %d" % (
+    elapsed,
+    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before,
+    len(gc.get_objects()) - objects_before))
+'''
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--entries', default='10000,100000,300000')
+    parser.add_argument('--fanout', type=int, default=10)
+    parser.add_argument('--files-per-dir', type=int, default=30)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--mode', choices=['load', 'walk'], default='load')
+    args = parser.parse_args()
+    for entries in [int(entries) for entries in args.entries.split(',')]:
+        workdir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(workdir, 'src')
+            count = generate_tree(
+                src, shape_for(entries, args.fanout, args.files_per_dir),
+                args.fanout, args.files_per_dir, file_size=0,
+                owner='root', group='root')
+            results = []
+            for i in range(args.runs):
+                elapsed, rss, objects = check_output(
+                    [sys.executable, '-c', MEASURE, src, args.mode]).split()
+                results.append((float(elapsed), int(rss), int(objects)))
+            elapsed, rss, objects = min(results)
+            print("%8d entries  %8.3fs  %8d KiB peak RSS growth  %9d tracked objects" % (
+                count, elapsed, rss, objects))
+        finally:
+            shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
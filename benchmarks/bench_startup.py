@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from subprocess import Popen, PIPE, check_call
+from synthetic import generate_tree
+
+MUPPET = 'from muppet.scripts.muppet_ import main; main()'
+
+# reports, once the command is done, how many modules it imported and
+# which of the expensive ones among them
+MODULES = '''
+import sys, atexit
+def report():
+    names = set(name for name, module in sys.modules.items() if module is not None)
+    sys.stderr.write('modules %d %s\\n' % (len(names), ' '.join(
+        name for name in ('fabric', 'paramiko', 'muppet.vcs') if name in names)))
+atexit.register(report)
+'''
+
+def best_of(runs, command, devnull):
+    best = None
+    for i in range(runs):
+        start = time.time()
+        check_call(command, stdout=devnull, stderr=devnull)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def modules_loaded(command):
+    p = Popen(command[:2] + [MODULES + command[2]] + command[3:], stdout=PIPE, stderr=PIPE)
+    out, err = p.communicate()
+    for line in err.splitlines():
+        if line.startswith('modules '):
+            fields = line.split(' ', 2)
+            return int(fields[1]), fields[2]
+    return None, ''
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp()
+    devnull = open(os.devnull, 'w')
+    try:
+        # a tree small enough that starting up is all there is to time
+        src = os.path.join(workdir, 'src')
+        dest = os.path.join(workdir, 'dest')
+        generate_tree(src, 0, files_per_dir=2)
+        os.mkdir(dest)
+        commands = [
+            ('python', [sys.executable, '-c', 'pass']),
+            ('import muppet_', [sys.executable, '-c', 'import muppet.scripts.muppet_']),
+            ('import commands', [sys.executable, '-c', 'import muppet.scripts.commands']),
+            ('put-local', [sys.executable, '-c', MUPPET, '-i', 'put-local', src, dest]),
+            ('verify', [sys.executable, '-c', MUPPET, 'verify', src, dest]),
+            ]
+        baseline = None
+        for label, command in commands:
+            elapsed = best_of(args.runs, command, devnull)
+            if baseline is None:
+                baseline = elapsed
+            count, heavy = modules_loaded(command)
+            print("%-16s %8.3fs (+%.3fs)  %4s modules  %s" % (
+                label, elapsed, elapsed - baseline, count, heavy))
+    finally:
+        devnull.close()
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+import simplejson as json
+import os
+import sys
+import time
+import shutil
+import logging
+import platform
+import tempfile
+from argparse import ArgumentParser
+import muppet
+from muppet.tree import Tree, TreeCopier
+from muppet.utils import do_cmd, find_executable
+from muppet.vcs.git import Git
+from muppet.stats import stats, count_syscalls
+from synthetic import generate_tree, precreate, shape_for
+
+SUITE_VERSION = 1
+
+def measure(results, name, func, setup=None, repeat=3):
+    # func is timed after setup has run, repeat times; the counters are
+    # those of the last run
+    runs = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        stats.counters.clear()
+        start = time.time()
+        func()
+        runs.append(time.time() - start)
+    results[name] = {
+        'best': min(runs),
+        'median': sorted(runs)[len(runs) // 2],
+        'runs': runs,
+        'counters': dict(stats.counters),
+        }
+    sys.stderr.write("%-28s %8.3fs\n" % (name, min(runs)))
+
+def reset_dest(src, dest):
+    if os.path.exists(dest):
+        shutil.rmtree(dest)
+    os.mkdir(dest)
+    precreate(src, dest)
+
+def copy(dest, src, **kwargs):
+    def func():
+        copier = TreeCopier(**kwargs)
+        copier(dest, src, Tree.from_annotated_fs(src))
+        copier.finish()
+    return func
+
+def bench_tree(results, workdir, args):
+    src = os.path.join(workdir, 'src')
+    dest = os.path.join(workdir, 'dest')
+    cache_dir = os.path.join(workdir, 'cache')
+    depth = shape_for(args.entries, args.fanout, args.files_per_dir)
+    count = generate_tree(
+        src, depth, args.fanout, args.files_per_dir, args.file_size,
+        metadata_density=args.metadata_density,
+        symlinks_per_dir=args.symlinks_per_dir,
+        precreated_per_dir=args.precreated_per_dir,
+        seed=args.seed)
+    repeat = args.repeat
+
+    measure(results, 'load', lambda: Tree.from_annotated_fs(src), repeat=repeat)
+    measure(results, 'dry-run.cold', copy(dest, src, dry_run=True),
+            lambda: reset_dest(src, dest), repeat)
+    measure(results, 'copy.cold', copy(dest, src, jobs=args.jobs),
+            lambda: reset_dest(src, dest), repeat)
+    measure(results, 'copy.warm', copy(dest, src, jobs=args.jobs), repeat=repeat)
+    measure(results, 'dry-run.warm', copy(dest, src, dry_run=True), repeat=repeat)
+    # the first incremental run only records the manifest the others use
+    copy(dest, src, incremental=True, cache_dir=cache_dir)()
+    measure(results, 'copy.warm-incremental',
+            copy(dest, src, incremental=True, cache_dir=cache_dir, jobs=args.jobs),
+            repeat=repeat)
+    return src, count
+
+def bench_git(results, workdir, src, args):
+    git = find_executable('git')
+    if git is None:
+        sys.stderr.write("git is not available; skipping the git benchmarks\n")
+        return
+    repo = os.path.join(workdir, 'repo')
+    shutil.copytree(src, repo, symlinks=True)
+    env = ['-c', 'user.name=bench', '-c', 'user.email=bench@example.com']
+    do_cmd(git, 'init', '-q', cwd=repo)
+    do_cmd(git, 'add', '-A', cwd=repo)
+    do_cmd(git, *(env + ['commit', '-q', '-m', 'initial']), cwd=repo)
+    for i in range(args.revisions):
+        f = open(os.path.join(repo, 'file%d' % (i % args.files_per_dir)), 'a')
+        f.write('%d\n' % i)
+        f.close()
+        do_cmd(git, *(env + ['commit', '-q', '-a', '-m', 'revision %d' % i]), cwd=repo)
+    first = do_cmd(git, 'rev-list', '--max-parents=0', 'HEAD', cwd=repo).strip()
+
+    def open_repo():
+        vcs = Git(git, repo)
+        vcs.branch
+        vcs.close()
+
+    def walk():
+        vcs = Git(git, repo)
+        rev = vcs['HEAD']
+        while rev.parents:
+            rev = rev.parents[0]
+        vcs.close()
+
+    def changed_paths():
+        vcs = Git(git, repo)
+        vcs.changed_paths(vcs[first], vcs['HEAD'], repo)
+        vcs.close()
+
+    def tag():
+        vcs = Git(git, repo)
+        vcs.put_tag('bench', vcs['HEAD'].id)
+        vcs.get_tag('bench').referenced.id
+        vcs.close()
+
+    repeat = args.repeat
+    measure(results, 'git.open', open_repo, repeat=repeat)
+    measure(results, 'git.walk', walk, repeat=repeat)
+    measure(results, 'git.changed-paths', changed_paths, repeat=repeat)
+    measure(results, 'git.tag', tag, repeat=repeat)
+
+def source_revision():
+    # the revision of the muppet being measured, when run from a checkout
+    git = find_executable('git')
+    if git is None:
+        return None
+    try:
+        return do_cmd(git, 'rev-parse', 'HEAD',
+                      cwd=os.path.dirname(os.path.abspath(muppet.__file__))).strip()
+    except Exception:
+        return None
+
+def compare(results, baseline):
+    for name in sorted(results):
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['best']
+        after = results[name]['best']
+        sys.stderr.write("%-28s %8.3fs -> %8.3fs  %+6.1f%%\n" % (
+            name, before, after, before and (after - before) * 100.0 / before or 0.0))
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--entries', type=int, default=10000)
+    parser.add_argument('--fanout', type=int, default=10)
+    parser.add_argument('--files-per-dir', type=int, default=10)
+    parser.add_argument('--file-size', type=int, default=256)
+    parser.add_argument('--metadata-density', type=float, default=1.0,
+                        help='fraction of directories carrying a .muppetmeta')
+    parser.add_argument('--symlinks-per-dir', type=int, default=2)
+    parser.add_argument('--precreated-per-dir', type=int, default=1)
+    parser.add_argument('--revisions', type=int, default=50)
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-git', action='store_true')
+    parser.add_argument('--output', type=str, metavar='file',
+                        help='write the results to file instead of standard output')
+    parser.add_argument('--compare', type=str, metavar='file',
+                        help='report the change against the results in file')
+    args = parser.parse_args()
+    # the copier reports its summary and unmanaged files as warnings
+    logging.basicConfig(level=logging.ERROR)
+    stats.enabled = True
+    count_syscalls()
+
+    results = {}
+    workdir = tempfile.mkdtemp()
+    try:
+        src, count = bench_tree(results, workdir, args)
+        if not args.skip_git:
+            bench_git(results, workdir, src, args)
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {
+        'version': SUITE_VERSION,
+        'revision': source_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'parameters': vars(args),
+        'entries': count,
+        'results': results,
+        }
+    if args.output:
+        f = open(args.output, 'w')
+        try:
+            json.dump(report, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    if args.compare:
+        compare(results, json.load(open(args.compare)))
+
+if __name__ == '__main__':
+    main()
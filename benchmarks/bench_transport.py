@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from subprocess import Popen, PIPE, check_call
+from muppet.utils import find_executable
+from muppet.transport import write_stream
+from synthetic import generate_tree, shape_for
+
+MUPPET = [sys.executable, '-c', 'from muppet.scripts.muppet_ import main; main()']
+
+def via_rsync(rsync, src, workdir):
+    staging = os.path.join(workdir, 'staging')
+    dest = os.path.join(workdir, 'dest-rsync')
+    os.mkdir(dest)
+    check_call([rsync, '-a', '-L', src + '/', staging])
+    check_call(MUPPET + ['put-local', staging, dest])
+
+def via_tar(src, workdir):
+    dest = os.path.join(workdir, 'dest-tar')
+    os.mkdir(dest)
+    p = Popen(MUPPET + ['put-stream', dest], stdin=PIPE)
+    write_stream(src, None, p.stdin)
+    p.stdin.close()
+    if p.wait() != 0:
+        raise Exception("put-stream failed")
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--file-size', type=int, default=256)
+    args = parser.parse_args()
+    rsync = find_executable('rsync')
+    if rsync is None:
+        print("rsync is not available; timing the tar stream only")
+    for size in [int(size) for size in args.sizes.split(',')]:
+        workdir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(workdir, 'src')
+            count = generate_tree(src, shape_for(size), file_size=args.file_size)
+            if rsync is not None:
+                start = time.time()
+                via_rsync(rsync, src, workdir)
+                print("%7d entries  rsync + put-local  %8.3fs" % (count, time.time() - start))
+            start = time.time()
+            via_tar(src, workdir)
+            print("%7d entries  tar | put-stream   %8.3fs" % (count, time.time() - start))
+        finally:
+            shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
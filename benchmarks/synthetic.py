@@ -0,0 +1,71 @@
+import simplejson as json
+import os
+import random
+
+def generate_tree(root, depth=3, fanout=10, files_per_dir=10, file_size=64, owner=None, group=None,
+                  metadata_density=1.0, symlinks_per_dir=0, precreated_per_dir=0, seed=0):
+    # metadata_density is the fraction of directories that carry a
+    # .muppetmeta; the others inherit everything from their parents.  The
+    # first precreated_per_dir files of an annotated directory are expected
+    # to exist at the destination (see precreate())
+    count = 0
+    payload = 'x' * file_size
+    rng = random.Random(seed)
+    stack = [(root, depth)]
+    while stack:
+        path, level = stack.pop()
+        os.makedirs(path)
+        annotated = path == root or rng.random() < metadata_density
+        entries = {}
+        for i in range(files_per_dir):
+            name = 'file%d' % i
+            f = open(os.path.join(path, name), 'w')
+            f.write(payload)
+            f.close()
+            entries[name] = {'file-mode': '644'}
+            if owner is not None:
+                entries[name]['file-owner'] = owner
+            if group is not None:
+                entries[name]['file-group'] = group
+            if i < precreated_per_dir:
+                entries[name]['expects'] = ['precreated']
+            count += 1
+        for i in range(files_per_dir and symlinks_per_dir):
+            name = 'link%d' % i
+            # the placeholder on disk only makes the loader see the entry
+            open(os.path.join(path, name), 'w').close()
+            entries[name] = {'symlink': 'file%d' % (i % files_per_dir)}
+            count += 1
+        if level > 0:
+            for i in range(fanout):
+                name = 'dir%d' % i
+                entries[name + '/'] = {'file-mode': '755'}
+                stack.append((os.path.join(path, name), level - 1))
+                count += 1
+        if annotated:
+            json.dump({'entries': entries}, open(os.path.join(path, '.muppetmeta'), 'w'))
+    return count
+
+def precreate(root, dest):
+    # creates at dest what the tree generated under root expects to find
+    count = 0
+    for dir_path, dir_names, file_names in os.walk(root):
+        if '.muppetmeta' not in file_names:
+            continue
+        dest_dir = os.path.join(dest, os.path.relpath(dir_path, root))
+        metadata = json.load(open(os.path.join(dir_path, '.muppetmeta')))
+        for name, entry in metadata['entries'].iteritems():
+            if 'precreated' in entry.get('expects', ()):
+                if not os.path.exists(dest_dir):
+                    os.makedirs(dest_dir)
+                open(os.path.join(dest_dir, name), 'w').close()
+                count += 1
+    return count
+
+def shape_for(entries, fanout=10, files_per_dir=10):
+    depth = 0
+    total = files_per_dir
+    while total < entries:
+        depth += 1
+        total = total * fanout + files_per_dir + fanout
+    return depth
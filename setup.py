@@ -1,5 +1,6 @@
 # encoding: utf-8
 import os
+import sys
 from setuptools import setup, find_packages
 
 requires = [
@@ -8,6 +9,9 @@ requires = [
     'simplejson',
     ]
 
+if sys.version_info < (3, 5):
+    requires.append('scandir')
+
 here = os.path.abspath(os.path.dirname(__file__))
 README = open(os.path.join(here, 'README.rst')).read()
 CHANGES = open(os.path.join(here, 'CHANGES.txt')).read()
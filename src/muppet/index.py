@@ -0,0 +1,177 @@
+import simplejson as json
+import os
+import logging
+import hashlib
+import tempfile
+from muppet.stats import stats
+from muppet.tree import Tree, LocalFS, EntryMetadata, NO_METADATA, File, Symlink, Directory, MUPPET_META, entry_type_name
+
+INDEX_VERSION = 2
+
+ENTRY_TYPES = {
+    'directory': Directory,
+    'file': File,
+    'symlink': Symlink,
+    }
+
+def index_path(cache_dir, src, follow_symlinks=False):
+    key = hashlib.sha1(os.path.abspath(src) + (follow_symlinks and '\0L' or '')).hexdigest()
+    return os.path.join(cache_dir, 'indexes', key + '.json')
+
+def _metadata_stamp(dir_path):
+    try:
+        stat = os.stat(os.path.join(dir_path, MUPPET_META))
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+def build_index(src, tree, follow_symlinks=False):
+    # every entry is stored with its inheritance and defaults already
+    # resolved, along with the mtime of each directory and the size and
+    # mtime of each .muppetmeta, which are all that is needed to tell
+    # whether the index still describes the source
+    records = []
+    dirs = {}
+    stack = [('', tree.root)]
+    while stack:
+        path, entry = stack.pop()
+        record = {'path': path, 'type': entry_type_name(entry)}
+        if entry.mode is not None:
+            record['mode'] = entry.mode
+        if entry.owner is not None:
+            record['owner'] = entry.owner
+        if entry.group is not None:
+            record['group'] = entry.group
+        if entry.meta is not None and entry.meta.expects:
+            record['expects'] = entry.meta.expects
+        if isinstance(entry, Symlink):
+            record['to'] = entry.to
+        records.append(record)
+        if isinstance(entry, Directory):
+            dir_path = os.path.join(src, path)
+            dirs[path] = [os.stat(dir_path).st_mtime, _metadata_stamp(dir_path)]
+            for child in reversed(entry.children()):
+                stack.append((os.path.join(path, child.name), child))
+    return {
+        'version': INDEX_VERSION,
+        'src': os.path.abspath(src),
+        'follow_symlinks': follow_symlinks,
+        'dirs': dirs,
+        'entries': records,
+        }
+
+def save_index(cache_dir, src, index):
+    path = index_path(cache_dir, src, index['follow_symlinks'])
+    dir = os.path.dirname(path)
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    fd, tmp_path = tempfile.mkstemp(dir=dir, prefix='.index-')
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            json.dump(index, f, separators=(',', ':'))
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+    return path
+
+def index_is_fresh(src, index):
+    for path, (mtime, metadata_stamp) in index['dirs'].iteritems():
+        dir_path = os.path.join(src, path)
+        try:
+            if os.stat(dir_path).st_mtime != mtime:
+                return False
+        except OSError:
+            return False
+        if _metadata_stamp(dir_path) != metadata_stamp:
+            return False
+    return True
+
+def tree_from_index(index):
+    tree = Tree()
+    dirs = {}
+    for record in index['entries']:
+        path = record['path']
+        expects = record.get('expects')
+        entry = ENTRY_TYPES[record['type']](
+            tree, None, os.path.basename(path) or None,
+            expects and EntryMetadata(expects=expects) or NO_METADATA,
+            mode=record.get('mode'),
+            owner=record.get('owner'),
+            group=record.get('group'),
+            to=record.get('to'))
+        if path:
+            entry.parent = dirs[os.path.dirname(path)]
+            entry.parent.add(entry)
+        else:
+            tree.root = entry
+        if isinstance(entry, Directory):
+            dirs[path] = entry
+    return tree
+
+def load_index(cache_dir, src):
+    with stats.timer('phase.load-index'):
+        index = _read_index(cache_dir, src)
+        return index and _tree_from_index(index_path(cache_dir, src), index)
+
+def _tree_from_index(path, index):
+    try:
+        return tree_from_index(index)
+    except (KeyError, TypeError), e:
+        logging.warning("%s is corrupt; ignored (%s)" % (path, e))
+        return None
+
+def _read_index(cache_dir, src, follow_symlinks=False):
+    path = index_path(cache_dir, src, follow_symlinks)
+    if not os.path.exists(path):
+        return None
+    try:
+        index = json.load(open(path))
+        if index['version'] != INDEX_VERSION or \
+                index['src'] != os.path.abspath(src) or \
+                index['follow_symlinks'] != follow_symlinks:
+            logging.info("%s is stale; ignored" % path)
+            return None
+        if not index_is_fresh(src, index):
+            logging.info("%s is older than %s; ignored" % (path, src))
+            return None
+        return index
+    except (ValueError, KeyError, TypeError), e:
+        logging.warning("%s is corrupt; loading %s instead (%s)" % (path, src, e))
+        return None
+
+def compile_tree(cache_dir, src):
+    return save_index(cache_dir, src, build_index(src, Tree.from_annotated_fs(src)))
+
+def current_index(cache_dir, src, follow_symlinks=False):
+    # the index of src, compiled afresh unless the one under cache_dir
+    # still describes it; an index to be shipped with a tree is to follow
+    # symbolic links as the transport does
+    index = _read_index(cache_dir, src, follow_symlinks)
+    if index is None:
+        index = build_index(
+            src, Tree.from_annotated_fs(src, fs=LocalFS(follow_symlinks)), follow_symlinks)
+        try:
+            save_index(cache_dir, src, index)
+        except EnvironmentError, e:
+            logging.info("Failed to save the index of %s: %s" % (src, e))
+    return index
+
+def load_shipped_index(path):
+    # an index that travelled with the tree it describes, as put-staged
+    # finds it beside a staged run, is taken without checking the tree
+    with stats.timer('phase.load-index'):
+        if not os.path.exists(path):
+            return None
+        try:
+            index = json.load(open(path))
+        except ValueError, e:
+            logging.warning("%s is corrupt; ignored (%s)" % (path, e))
+            return None
+        if index.get('version') != INDEX_VERSION:
+            logging.info("%s is stale; ignored" % path)
+            return None
+        return _tree_from_index(path, index)
@@ -0,0 +1,239 @@
+import simplejson as json
+import os
+import re
+import time
+import errno
+import shutil
+import hashlib
+import logging
+import tempfile
+from muppet.exceptions import MuppetConfigurationError
+from muppet.tree import Tree, LocalFS, Entry, Directory, Symlink, MUPPET_META
+from muppet.store import build_manifest, link_or_copy
+from muppet.utils import scandir
+from muppet.stats import stats
+
+OVERLAY_VERSION = 1
+
+def server_layers(settings, name, resolving=()):
+    # the layers name is laid over, lowest first, as listed by
+    # layers.<name>; a layer may in turn be laid over layers of its own
+    if name in resolving:
+        raise MuppetConfigurationError(
+            "layers.%s refers back to %s" % (resolving[-1], name))
+    retval = []
+    layers_str = settings.get('layers.%s' % name, '').strip()
+    for layer in layers_str and re.split(r'\s*,\s*', layers_str) or []:
+        for dir in server_layers(settings, layer, resolving + (name, )) + [layer]:
+            if dir not in retval:
+                retval.append(dir)
+    return retval
+
+def tree_stamp(root):
+    # changes whenever anything under root does: a name, a type, or the
+    # size or mtime of a file.  Symbolic links are followed, as they are
+    # when a layer is loaded
+    h = hashlib.sha1()
+    stack = ['']
+    while stack:
+        dir = stack.pop()
+        for dirent in sorted(scandir(os.path.join(root, dir)), key=lambda dirent: dirent.name):
+            path = os.path.join(dir, dirent.name)
+            if dirent.is_dir():
+                h.update(('d %s\0' % path).encode('utf-8'))
+                stack.append(path)
+            else:
+                stat = dirent.stat(follow_symlinks=False)
+                if dirent.is_symlink():
+                    # a symbolic link stands for its target, when it has one
+                    try:
+                        stat = dirent.stat()
+                    except OSError, e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                h.update(('f %s %d %r\0' % (path, stat.st_size, stat.st_mtime)).encode('utf-8'))
+    return h.hexdigest()
+
+def overlay_entry(lower, upper):
+    # an entry of the upper layer takes whatever it leaves unset from the
+    # same entry below, through Entry.merge(); one of another type
+    # replaces it outright
+    if lower.__class__ is not upper.__class__:
+        return upper
+    if not isinstance(upper, Directory):
+        return lower.merge(upper)
+    retval = Entry.merge(lower, upper)
+    retval.entries = dict(lower.entries)
+    for name, entry in upper.entries.iteritems():
+        existing = retval.entries.get(name)
+        retval.entries[name] = existing is None and entry or overlay_entry(existing, entry)
+    return retval
+
+def metadata_for(entry):
+    retval = {}
+    if entry.mode is not None:
+        retval['file-mode'] = '%o' % entry.mode
+    if entry.owner is not None:
+        retval['file-owner'] = entry.owner
+    if entry.group is not None:
+        retval['file-group'] = entry.group
+    if entry.meta is not None and entry.meta.expects:
+        retval['expects'] = sorted(
+            value and '%s:%s' % (name, value) or name
+            for name, value in entry.meta.expects.iteritems())
+    if isinstance(entry, Symlink):
+        retval['symlink'] = entry.to
+    return retval
+
+def write_overlay(root, dest, lower, upper, upper_root):
+    # lays out the merged tree under dest, with every entry spelled out in
+    # its .muppetmeta and the content of each file linked from the layer
+    # that provides it; returns the paths of the files from the upper one
+    from_upper = set()
+    stack = [('', root, upper_root)]
+    while stack:
+        path, dir, upper_dir = stack.pop()
+        dest_dir = os.path.join(dest, path)
+        if path:
+            os.mkdir(dest_dir)
+        entries = {}
+        for entry in dir.children():
+            entry_path = os.path.join(path, entry.name)
+            upper_entry = upper_dir is not None and upper_dir.get(entry.name) or None
+            if isinstance(entry, Directory):
+                entries[entry.name + '/'] = metadata_for(entry)
+                stack.append((entry_path, entry, isinstance(upper_entry, Directory) and upper_entry or None))
+                continue
+            entries[entry.name] = metadata_for(entry)
+            if isinstance(entry, Symlink):
+                # as in the layers, only a placeholder
+                open(os.path.join(dest, entry_path), 'w').close()
+            elif upper_entry is not None:
+                link_or_copy(os.path.join(upper, entry_path), os.path.join(dest, entry_path))
+                from_upper.add(entry_path)
+            else:
+                link_or_copy(os.path.join(lower, entry_path), os.path.join(dest, entry_path))
+        metadata = {'entries': entries}
+        if not path:
+            metadata.update(metadata_for(dir))
+        f = open(os.path.join(dest_dir, MUPPET_META), 'w')
+        try:
+            json.dump(metadata, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    return from_upper
+
+class OverlayCache(object):
+    # overlays live under root, named after what went into them, each
+    # beside the staging manifest of its files.  A combination
+    # of layers is built upon the overlay of all but its topmost layer, so
+    # that servers sharing their lower layers share those overlays too,
+    # and each layer is stamped only once per run
+    def __init__(self, root):
+        self.root = root
+        self.stamps = {}
+
+    def stamp(self, dir):
+        dir = os.path.abspath(dir)
+        retval = self.stamps.get(dir)
+        if retval is None:
+            retval = self.stamps[dir] = tree_stamp(dir)
+        return retval
+
+    def is_overlay(self, dir):
+        return os.path.dirname(os.path.abspath(dir)) == os.path.abspath(self.root)
+
+    def overlay(self, dirs):
+        with stats.timer('phase.overlay'):
+            return self._overlay(dirs)[0]
+
+    def _overlay(self, dirs):
+        # returns the path of the overlay of dirs and its key
+        if len(dirs) == 1:
+            return dirs[0], self.stamp(dirs[0])
+        lower, lower_key = self._overlay(dirs[:-1])
+        upper = dirs[-1]
+        key = hashlib.sha1('%d %s %s' % (OVERLAY_VERSION, lower_key, self.stamp(upper))).hexdigest()
+        path = os.path.join(self.root, key)
+        if os.path.exists(path):
+            # marks it used; see collect()
+            os.utime(path, None)
+        else:
+            logging.info("Laying %s over %s" % (upper, lower))
+            self._build(path, lower, upper)
+        return path, key
+
+    def _build(self, path, lower, upper):
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        # what an overlay holds is only ever shipped, so a symbolic link to
+        # a directory is taken for the directory, as rsync -L takes it
+        fs = LocalFS(follow_symlinks=True)
+        upper_tree = Tree.from_annotated_fs(upper, fs=fs)
+        root = overlay_entry(Tree.from_annotated_fs(lower, fs=fs).root, upper_tree.root)
+        tmp_path = tempfile.mkdtemp(dir=self.root, prefix='.overlay-')
+        try:
+            from_upper = write_overlay(root, tmp_path, lower, upper, upper_tree.root)
+            known = None
+            if self.is_overlay(lower):
+                # only what was linked from lower is known; a file from
+                # upper or a rewritten .muppetmeta may well have the same
+                # size and mtime and still differ
+                known = dict(
+                    (entry['path'], entry) for entry in self._load_manifest(lower)['entries']
+                    if entry['path'] not in from_upper and
+                        os.path.basename(entry['path']) != MUPPET_META)
+            self._save_manifest(path, build_manifest(tmp_path, known=known))
+            os.rename(tmp_path, path)
+        except EnvironmentError, e:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            # another run has just built the same overlay
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY) or not os.path.isdir(path):
+                raise
+        except:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+    def _save_manifest(self, path, manifest):
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.manifest-')
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                json.dump(manifest, f, separators=(',', ':'))
+            finally:
+                f.close()
+            os.rename(tmp_path, path + '.json')
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    def _load_manifest(self, path):
+        return json.load(open(path + '.json'))
+
+    def manifest(self, dir, paths=None):
+        # the staging manifest of dir, hashing only what the overlay has
+        # not already hashed
+        if not self.is_overlay(dir):
+            return build_manifest(dir, paths)
+        manifest = self._load_manifest(dir)
+        if paths is None:
+            return manifest
+        return build_manifest(dir, paths, dict(
+            (entry['path'], entry) for entry in manifest['entries']))
+
+    def collect(self, max_age):
+        # removes the overlays no run has used for max_age seconds
+        if not os.path.exists(self.root):
+            return
+        threshold = time.time() - max_age
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith('.json') or os.path.getmtime(path) >= threshold:
+                continue
+            logging.info("Removing overlay %s" % name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.unlink(path)
+            if os.path.exists(path + '.json'):
+                os.unlink(path + '.json')
@@ -0,0 +1,118 @@
+import simplejson as json
+import os
+import logging
+import hashlib
+import tempfile
+from stat import *
+
+MANIFEST_VERSION = 1
+
+def entry_type(stat):
+    if S_ISDIR(stat.st_mode):
+        return 'directory'
+    elif S_ISLNK(stat.st_mode):
+        return 'symlink'
+    elif S_ISREG(stat.st_mode):
+        return 'file'
+    else:
+        return 'other'
+
+class Manifest(object):
+    def __init__(self, dest, entries=None):
+        self.dest = dest
+        self.entries = entries or {}
+
+    @classmethod
+    def path_for(self, cache_dir, dest):
+        key = hashlib.sha1(os.path.abspath(dest)).hexdigest()
+        return os.path.join(cache_dir, 'manifests', key + '.json')
+
+    @classmethod
+    def load(self, cache_dir, dest):
+        path = self.path_for(cache_dir, dest)
+        if not os.path.exists(path):
+            return None
+        try:
+            manifest_json = json.load(open(path))
+            if manifest_json['version'] != MANIFEST_VERSION or \
+                    manifest_json['dest'] != os.path.abspath(dest):
+                logging.info("%s is stale; ignored" % path)
+                return None
+            return self(dest, dict(
+                (record['path'], record) for record in manifest_json['entries']
+                ))
+        except (ValueError, KeyError, TypeError), e:
+            logging.warning("%s is corrupt; falling back to a full scan (%s)" % (path, e))
+            return None
+
+    def save(self, cache_dir):
+        path = self.path_for(cache_dir, self.dest)
+        dir = os.path.dirname(path)
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        fd, tmp_path = tempfile.mkstemp(dir=dir, prefix='.manifest-')
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                json.dump({
+                    'version': MANIFEST_VERSION,
+                    'dest': os.path.abspath(self.dest),
+                    'entries': [self.entries[key] for key in sorted(self.entries)],
+                    }, f)
+            finally:
+                f.close()
+            os.rename(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    def lookup(self, dest_path):
+        return self.entries.get(dest_path)
+
+    def unchanged(self, dest_path, stat, src_stat=None):
+        record = self.entries.get(dest_path)
+        if record is None:
+            return False
+        if record['type'] != entry_type(stat) or \
+                record['mode'] != S_IMODE(stat.st_mode) or \
+                record['owner'] != stat.st_uid or \
+                record['group'] != stat.st_gid or \
+                record['size'] != stat.st_size or \
+                record['mtime'] != stat.st_mtime or \
+                record['ctime'] != stat.st_ctime or \
+                record['ino'] != stat.st_ino:
+            return False
+        if src_stat is not None:
+            if record.get('src_size') != src_stat.st_size or \
+                    record.get('src_mtime') != int(src_stat.st_mtime):
+                return False
+        return True
+
+    def record(self, dest_path, stat, source=None, previous=None):
+        record = {
+            'path': dest_path,
+            'type': entry_type(stat),
+            'mode': S_IMODE(stat.st_mode),
+            'owner': stat.st_uid,
+            'group': stat.st_gid,
+            'size': stat.st_size,
+            # to the full precision of the file system, so that a change
+            # within the second of the last run still shows
+            'mtime': stat.st_mtime,
+            'ctime': stat.st_ctime,
+            'ino': stat.st_ino,
+            }
+        if source is not None:
+            src_stat = source.stat
+            record['src_size'] = src_stat.st_size
+            record['src_mtime'] = int(src_stat.st_mtime)
+            previous_record = previous and previous.lookup(dest_path)
+            if previous_record is not None and \
+                    previous_record.get('src_size') == src_stat.st_size and \
+                    previous_record.get('src_mtime') == int(src_stat.st_mtime) and \
+                    previous_record.get('hash'):
+                record['hash'] = previous_record['hash']
+            else:
+                record['hash'] = source.digest()
+        self.entries[dest_path] = record
+        return record
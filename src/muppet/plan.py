@@ -0,0 +1,100 @@
+import simplejson as json
+import os
+import tempfile
+import threading
+from muppet.exceptions import MuppetException
+
+PLAN_VERSION = 1
+
+# the order in which operations on the same path are carried out
+OPERATION_ORDER = ('verify', 'remove', 'create', 'replace', 'chmod', 'chown', 'keep')
+
+OPERATION_RANKS = dict((op, rank) for rank, op in enumerate(OPERATION_ORDER))
+
+class Plan(object):
+    def __init__(self, dest, src=None, incremental=False, operations=None, unmanaged=None):
+        self.dest = dest
+        self.src = src
+        self.incremental = incremental
+        self.operations = operations or []
+        self.unmanaged = unmanaged or []
+        self.lock = threading.Lock()
+
+    def add(self, op, path, **fields):
+        fields['op'] = op
+        fields['path'] = path
+        with self.lock:
+            self.operations.append(fields)
+        return fields
+
+    def sort(self):
+        # parents before their children, and operations on one path in
+        # OPERATION_ORDER, whatever order the planner produced them in
+        self.operations.sort(key=lambda operation: (
+            operation['path'].split(os.path.sep),
+            OPERATION_RANKS[operation['op']]))
+
+    def select(self, *ops):
+        return [operation for operation in self.operations if operation['op'] in ops]
+
+    def owners_and_groups(self):
+        owners = set()
+        groups = set()
+        for operation in self.operations:
+            if operation.get('owner') is not None:
+                owners.add(operation['owner'])
+            if operation.get('group') is not None:
+                groups.add(operation['group'])
+        return owners, groups
+
+    def summary(self):
+        counts = dict((op, 0) for op in OPERATION_ORDER)
+        for operation in self.operations:
+            counts[operation['op']] += 1
+        return ', '.join('%d %s' % (counts[op], op) for op in OPERATION_ORDER)
+
+    def to_json_dict(self):
+        return {
+            'version': PLAN_VERSION,
+            'dest': self.dest,
+            'src': self.src,
+            'incremental': self.incremental,
+            'operations': self.operations,
+            'unmanaged': self.unmanaged,
+            }
+
+    def dump(self, f):
+        json.dump(self.to_json_dict(), f, indent=2, sort_keys=True)
+        f.write('\n')
+
+    def save(self, path):
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), prefix='.plan-')
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                self.dump(f)
+            finally:
+                f.close()
+            os.rename(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def from_json_dict(self, dict_):
+        if dict_.get('version') != PLAN_VERSION:
+            raise MuppetException("unsupported plan version: %s" % dict_.get('version'))
+        for operation in dict_['operations']:
+            if operation.get('op') not in OPERATION_RANKS or 'path' not in operation:
+                raise MuppetException("invalid operation: %r" % (operation, ))
+        return self(
+            dict_['dest'], dict_.get('src'), dict_.get('incremental', False),
+            dict_['operations'], dict_.get('unmanaged'))
+
+    @classmethod
+    def load(self, path):
+        try:
+            return self.from_json_dict(json.load(open(path)))
+        except (ValueError, KeyError, TypeError), e:
+            raise MuppetException("%s is not a valid plan" % path, e)
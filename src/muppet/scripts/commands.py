@@ -1,18 +1,37 @@
 from muppet.vcs import query_backends
 from muppet.vcs.base import NoSuchReference
 from muppet.exceptions import MuppetException
-from muppet.scripts.common import MuppetApplicationError
+from muppet.scripts.common import Command, MuppetApplicationError
 from muppet.settings import config_wrapper_from_file
-from muppet.tree import Tree, copy
+from muppet.tree import MUPPET_META
+from muppet.utils import iter_files
+from muppet.store import ObjectStore, stage_objects, INDEX_SUFFIX
+from muppet.index import current_index
+from muppet.transport import write_stream
+from muppet.layers import OverlayCache, server_layers
+from muppet.ssh import ssh_command, SSHSessionPool
+from muppet.stats import stats
+from subprocess import Popen, PIPE, STDOUT
+from tempfile import TemporaryFile
+import errno
 from datetime import datetime
-import fabric.api, fabric.contrib.project
+from tempfile import NamedTemporaryFile, mkdtemp
+import simplejson as json
+import shutil
+import fabric.api, fabric.contrib.project, fabric.network
 import logging
 import re, os
 
-class Command(object):
-    def __init__(self, settings, variables):
-        self.settings = settings
-        self.variables = variables
+TRANSPORTS = ('store', 'tar', 'rsync')
+
+def expand_servers(settings, servers):
+    # servers.<name> lists the servers that name stands for
+    groups = settings.get_prefixed('servers.')
+    retval = []
+    for server in servers:
+        servers_str = groups.get(server, '').strip()
+        retval.extend(servers_str and re.split(r'\s*,\s*', servers_str) or [server])
+    return retval
 
 class ProjectCommand(Command):
     def __init__(self, settings, variables):
@@ -32,19 +51,22 @@ class VCSCommand(Command):
         backends = query_backends(settings, variables)
         if not backends:
             raise MuppetApplicationError("Directory (%s) is not version-controlled" % variables['cwd'])
-        repo_root = backends[0].repo_root
-        if repo_root != variables['project_dir']:
-            raise MuppetApplicationError("Project directory (%s) is not the root directory of the repository (%s)" % (variables['project_dir'], repo_root))
-        ProjectCommand.__init__(self, settings, variables)
+        try:
+            repo_root = backends[0].repo_root
+            if repo_root != variables['project_dir']:
+                raise MuppetApplicationError("Project directory (%s) is not the root directory of the repository (%s)" % (variables['project_dir'], repo_root))
+            ProjectCommand.__init__(self, settings, variables)
+        except:
+            backends[0].close()
+            raise
         self.vcs = backends[0]
 
 class apply(VCSCommand):
     def __call__(self, *servers):
-        servers_ = []
-        for server in servers:
-            servers_str = self.settings.get('servers.%s' % servers, '').strip()
-            servers_.extend(servers_str and re.split(r'\s+,\s+', servers_str) or [server])
-        self.do(servers_)
+        try:
+            self.do(expand_servers(self.settings, servers))
+        finally:
+            self.vcs.close()
 
     def do(self, servers):
         for server, tag, head in self.gather_info(servers):
@@ -64,44 +86,390 @@ class apply(VCSCommand):
         return retval
 
 class put(ProjectCommand):
+    vcs = None
+    sessions = None
+    sudo_passwords = None
+
     def __call__(self, *servers):
-        servers_ = []
-        for server in servers:
-            servers_str = self.settings.get('servers.%s' % servers, '').strip()
-            servers_.extend(servers_str and re.split(r'\s+,\s+', servers_str) or [server])
-        self.do(servers_)
+        try:
+            self.do(expand_servers(self.settings, servers))
+        finally:
+            # opened by do() for --changed-only
+            if self.vcs is not None:
+                self.vcs.close()
+                self.vcs = None
+
+    def changed_paths(self, server, source_dirs, tree_dir, head):
+        # what changed in any of source_dirs, as paths in tree_dir, which
+        # they are laid out in
+        try:
+            tag = self.vcs.get_tag(server)
+        except NoSuchReference:
+            logging.warning("%s has never been put; putting everything" % server)
+            return None
+        selected = set()
+        for source_dir in source_dirs:
+            for status, path in self.vcs.changed_paths(tag.referenced, head, os.path.abspath(source_dir)):
+                path = os.path.relpath(path, source_dir)
+                if status == 'D':
+                    logging.warning("%s was removed; it is left as is on %s" % (path, server))
+                elif os.path.basename(path) == MUPPET_META:
+                    # changed metadata may affect everything below it
+                    selected.update(iter_files(tree_dir, os.path.dirname(path)))
+                else:
+                    selected.add(path)
+        # a file of a lower layer may have been replaced by a directory
+        selected = set(path for path in selected if os.path.isfile(os.path.join(tree_dir, path)))
+        for path in list(selected):
+            dir = path
+            while dir:
+                dir = os.path.dirname(dir)
+                metadata_file = os.path.join(dir, MUPPET_META)
+                if os.path.exists(os.path.join(tree_dir, metadata_file)):
+                    selected.add(metadata_file)
+        return sorted(selected)
+
+    def remote_options(self, paths):
+        options = []
+        if self.variables.get('verbose'):
+            options.append('-v')
+        if self.variables.get('dry_run'):
+            options.append('-n')
+        if self.variables.get('incremental'):
+            options.append('-i')
+        if self.variables.get('jobs', 1) > 1:
+            options.append('-j %d' % self.variables['jobs'])
+        if paths is not None:
+            options.append('--partial')
+        return options
+
+    def ssh_command(self, host_string):
+        # logs in with the user and keys fabric would use
+        env = fabric.api.env
+        identity_files = env.key_filename or []
+        if isinstance(identity_files, basestring):
+            identity_files = [identity_files]
+        # leave the user to ssh_config unless fabric was told of one
+        user = env.user != env.local_user and env.user or None
+        if self.sessions is not None:
+            return self.sessions.command_for(
+                host_string, user=user, identity_files=identity_files)
+        return ssh_command(
+            self.settings, host_string, self.variables.get('host_timeout'),
+            user=user, identity_files=identity_files)
+
+    def run_remote(self, command, capture=False, feed=None):
+        # runs command on the current host over ssh, writing to its
+        # standard input with feed if given
+        host_string = fabric.api.env['host_string']
+        output = None
+        if capture:
+            output = TemporaryFile()
+        with stats.timer('subprocess.ssh'):
+            p = Popen(
+                self.ssh_command(host_string) + [command],
+                stdin=feed and PIPE, stdout=output, stderr=output and STDOUT)
+            if feed is not None:
+                try:
+                    feed(p.stdin)
+                    p.stdin.close()
+                except IOError, e:
+                    # the remote side went away; its exit status tells why
+                    if e.errno != errno.EPIPE:
+                        raise
+            p.wait()
+        if p.returncode != 0:
+            raise MuppetApplicationError("%s on %s exited with %d" % (command, host_string, p.returncode))
+        if output is not None:
+            output.seek(0)
+            return output.read()
+
+    def sudo_password(self):
+        # the password sudo wants on the current host, or None if it wants
+        # none.  sudo -n fails rather than prompt, so that is tried once
+        # per host; the password is then asked for as fabric would
+        host_string = fabric.api.env['host_string']
+        if self.sudo_passwords is None:
+            self.sudo_passwords = {}
+        if host_string not in self.sudo_passwords:
+            devnull = open(os.devnull, 'w')
+            try:
+                with stats.timer('subprocess.ssh'):
+                    returncode = Popen(
+                        self.ssh_command(host_string) + ['sudo -n true'],
+                        stdin=devnull, stdout=devnull, stderr=devnull).wait()
+            finally:
+                devnull.close()
+            password = None
+            # 255 is ssh failing, which the command itself will report
+            if returncode not in (0, 255):
+                env = fabric.api.env
+                password = env.passwords.get(host_string) or env.password or \
+                    fabric.network.prompt_for_password("[%s] sudo password" % host_string)
+            self.sudo_passwords[host_string] = password
+        return self.sudo_passwords[host_string]
+
+    def run_sudo(self, command, capture=False, feed=None):
+        # runs command as root over ssh; where sudo wants a password, it
+        # reads it from standard input ahead of whatever feed writes
+        password = self.sudo_password()
+        if password is None:
+            return self.run_remote('sudo -n ' + command, capture, feed)
+        def feed_password(stdin):
+            stdin.write(password + '\n')
+            if feed is not None:
+                feed(stdin)
+            else:
+                stdin.flush()
+        return self.run_remote("sudo -S -p '' " + command, capture, feed_password)
+
+    def sudo(self, command, capture=False):
+        if self.sessions is None:
+            with stats.timer('subprocess.ssh'):
+                return fabric.api.sudo(command)
+        return self.run_sudo(command, capture)
+
+    def rsync(self, local_dir, remote_dir, extra_opts, capture=False):
+        ssh_opts = ''
+        if self.sessions is not None:
+            ssh_opts = ' '.join(self.sessions.options_for(fabric.api.env['host_string']))
+        with stats.timer('subprocess.rsync'):
+            return fabric.contrib.project.rsync_project(
+                local_dir=local_dir, remote_dir=remote_dir,
+                extra_opts=extra_opts, ssh_opts=ssh_opts, capture=capture)
+
+    def transport(self):
+        return self.variables.get('transport') or self.settings.get('muppet.transport', 'store')
+
+    def put_host(self, jobs, capture=False):
+        # puts the servers in jobs, which all live on the current host, and
+        # returns (server, error or None, outputs) for each
+        transport = self.transport()
+        if transport == 'store':
+            return self.put_host_via_store(jobs, capture)
+        put_server = getattr(self, 'put_server_via_%s' % transport)
+        results = []
+        for server, host_string, server_settings_dir, paths in jobs:
+            try:
+                results.append((server, None, put_server(server, server_settings_dir, paths, capture)))
+            except (Exception, SystemExit), e:
+                results.append((server, e, []))
+        return results
+
+    def put_host_via_store(self, jobs, capture=False):
+        # ships the files as content-addressed objects under
+        # muppet.cache_dir/objects, which rsync skips when the host already
+        # has them, along with a manifest per server under
+        # muppet.cache_dir/runs/<run>; the remote put-staged rebuilds each tree
+        # from the two.  The servers on a host are staged and transferred
+        # together, so that the objects they share go over once
+        extra_opts = '-L --ignore-existing'
+        timeout = self.variables.get('host_timeout')
+        if timeout:
+            extra_opts += ' --timeout=%d' % timeout
+        cache_dir = self.settings['muppet.cache_dir']
+        run = datetime.now().strftime(self.settings['muppet.timestamp'])
+        manifest_files = []
+        staging_dir = mkdtemp()
+        try:
+            store = ObjectStore(os.path.join(staging_dir, 'objects'))
+            run_dir = os.path.join(staging_dir, 'runs', run)
+            os.makedirs(run_dir)
+            for server, host_string, server_settings_dir, paths in jobs:
+                manifest = self.overlays.manifest(server_settings_dir, paths)
+                stage_objects(manifest, server_settings_dir, store)
+                json.dump(manifest, open(os.path.join(run_dir, server + '.json'), 'w'))
+                if paths is None:
+                    # a whole tree goes with its compiled index, which
+                    # put-staged takes instead of parsing every .muppetmeta
+                    json.dump(
+                        current_index(cache_dir, server_settings_dir, follow_symlinks=True),
+                        open(os.path.join(run_dir, server + INDEX_SUFFIX), 'w'),
+                        separators=(',', ':'))
+                manifest_files.append(os.path.join(cache_dir, 'runs', run, server + '.json'))
+            staged = self.rsync(staging_dir + '/', cache_dir, extra_opts, capture)
+        except (Exception, SystemExit), e:
+            return [(job[0], e, []) for job in jobs]
+        finally:
+            shutil.rmtree(staging_dir)
+        results = []
+        for (server, host_string, server_settings_dir, paths), manifest_file in zip(jobs, manifest_files):
+            options = self.remote_options(paths)
+            try:
+                results.append((server, None, [
+                    staged,
+                    self.sudo(' '.join(['muppet'] + options + ['put-staged', manifest_file]), capture)]))
+            except (Exception, SystemExit), e:
+                results.append((server, e, [staged]))
+        return results
+
+    def put_server_via_tar(self, server, server_settings_dir, paths, capture=False):
+        # streams the tree as a single compressed archive into the remote
+        # put-stream over one ssh channel
+        options = self.remote_options(paths)
+        manifest = self.overlays.manifest(server_settings_dir, paths)
+        return [self.run_sudo(
+            ' '.join(['muppet'] + options + ['put-stream']), capture,
+            lambda stdin: write_stream(server_settings_dir, paths, stdin, manifest))]
+
+    def put_server_via_rsync(self, server, server_settings_dir, paths, capture=False):
+        outputs = []
+        extra_opts = '-L'
+        timeout = self.variables.get('host_timeout')
+        if timeout:
+            extra_opts += ' --timeout=%d' % timeout
+        remote_dir = os.path.join(
+            self.settings['muppet.cache_dir'],
+            datetime.now().strftime(self.settings['muppet.timestamp'])
+            )
+        files_from = None
+        if paths is not None:
+            files_from = NamedTemporaryFile()
+            files_from.write(''.join(path + '\n' for path in paths))
+            files_from.flush()
+            extra_opts += ' --files-from=%s' % files_from.name
+        try:
+            outputs.append(self.rsync(server_settings_dir + '/', remote_dir, extra_opts, capture))
+        finally:
+            if files_from is not None:
+                files_from.close()
+        options = self.remote_options(paths)
+        outputs.append(self.sudo(' '.join(['muppet'] + options + ['put-local', remote_dir]), capture))
+        return outputs
+
+    def jobs_by_host(self, jobs):
+        hosts = []
+        jobs_by_host = {}
+        for job in jobs:
+            if job[1] not in jobs_by_host:
+                hosts.append(job[1])
+            jobs_by_host.setdefault(job[1], []).append(job)
+        return [(host_string, jobs_by_host[host_string]) for host_string in hosts]
+
+    def put_in_sequence(self, jobs):
+        # output is shown as it comes, so only errors are left for the
+        # summary
+        timeout = self.variables.get('host_timeout')
+        results = {}
+        for host_string, host_jobs in self.jobs_by_host(jobs):
+            with fabric.api.settings(
+                    host_string=host_string,
+                    command_timeout=timeout,
+                    abort_exception=MuppetApplicationError):
+                for server, error, outputs in self.put_host(host_jobs):
+                    results[server] = (error is None, error is not None and ['%s' % error] or [])
+        return results
+
+    def put_in_parallel(self, jobs, concurrency):
+        servers_by_host = dict(self.jobs_by_host(jobs))
+        timeout = self.variables.get('host_timeout')
+
+        @fabric.api.parallel(pool_size=concurrency)
+        def put_task():
+            with fabric.api.settings(
+                    fabric.api.hide('everything', 'aborts'),
+                    command_timeout=timeout,
+                    abort_exception=MuppetApplicationError):
+                return self.put_host(servers_by_host[fabric.api.env.host_string], capture=True)
+
+        results = {}
+        for host_results in fabric.api.execute(put_task, hosts=sorted(servers_by_host)).values():
+            for server, error, outputs in host_results or []:
+                if error is not None:
+                    outputs = outputs + ['%s' % error]
+                results[server] = (error is None, outputs)
+        return results
 
     def do(self, servers):
         settings_dir = os.path.join(self.variables['project_dir'], self.settings['settings.dir'])
+        changed_only = self.variables.get('changed_only')
+        if changed_only:
+            backends = query_backends(self.settings, self.variables)
+            if not backends:
+                raise MuppetApplicationError("--changed-only requires the project to be version-controlled")
+            self.vcs = backends[0]
+            head = self.vcs.branch and self.vcs.branch.referenced or self.vcs['HEAD']
+
+        if self.transport() not in TRANSPORTS:
+            raise MuppetApplicationError("unknown transport: %s" % self.transport())
+
+        # everything that needs the working copy or the repository is
+        # worked out here, before any host is contacted.  A server laid
+        # over layers (layers.<server>) is put from the overlay of them all.
+        # Overlays are kept beside the layers unless muppet.overlay_dir says
+        # otherwise, so that putting needs no write access outside the
+        # checkout
+        overlay_dir = self.settings.get('muppet.overlay_dir') or \
+            os.path.join(settings_dir, '.overlays')
+        self.overlays = OverlayCache(overlay_dir)
+        layered = False
+        jobs = []
+        hosts = self.settings.get_prefixed('hosts.')
         for server in servers:
+            source_dirs = []
+            for layer in server_layers(self.settings, server):
+                layer_dir = os.path.join(settings_dir, layer)
+                if not os.path.exists(layer_dir):
+                    raise MuppetApplicationError("%s does not exist" % layer_dir)
+                source_dirs.append(layer_dir)
             server_settings_dir = os.path.join(settings_dir, server)
-            if not os.path.exists(server_settings_dir):
+            if os.path.exists(server_settings_dir):
+                source_dirs.append(server_settings_dir)
+            elif not source_dirs:
                 raise MuppetApplicationError("%s does not exist" % server_settings_dir)
-            host_string = self.settings.get('hosts.%s' % server, server)
-            fabric.api.env['host_string'] = host_string
-            remote_dir = os.path.join(
-                self.settings['muppet.cache_dir'],
-                datetime.now().strftime(self.settings['muppet.timestamp'])
-                )
-            fabric.contrib.project.rsync_project(local_dir=server_settings_dir + '/', remote_dir=remote_dir, extra_opts='-L')
-            options = []
-            if self.variables.get('verbose'):
-                options.append('-v')
-            if self.variables.get('dry_run'):
-                options.append('-n')
-            @fabric.api.task
-            def put_local(remote_dir, options):
-                fabric.api.sudo(' '.join(['muppet'] + options + ['put-local', remote_dir]))
-            put_local(remote_dir, options)
-
-class put_local(Command):
-    def __call__(self, src, dest='/'):
+            tree_dir = source_dirs[0]
+            if len(source_dirs) > 1:
+                layered = True
+                try:
+                    tree_dir = self.overlays.overlay(source_dirs)
+                except EnvironmentError, e:
+                    raise MuppetApplicationError(e)
+                except MuppetException, e:
+                    raise MuppetApplicationError(e)
+            paths = None
+            if changed_only:
+                paths = self.changed_paths(server, source_dirs, tree_dir, head)
+                if paths == []:
+                    logging.warning("Nothing has changed for %s" % server)
+                    continue
+            host_string = hosts.get(server, server)
+            jobs.append((server, host_string, tree_dir, paths))
+
+        tag = changed_only and not self.variables.get('dry_run')
+        if self.settings.get('ssh.multiplex', 'no').lower() in ('yes', 'true', 'on', '1'):
+            self.sessions = SSHSessionPool(self.settings, self.variables.get('host_timeout'))
         try:
-            logging.warning("Copying %s to %s ..." % (src, dest))
-            copy(dest, src, Tree.from_annotated_fs(src), dry_run=self.variables.get('dry_run', False))
-            logging.warning("Done.")
-        except EnvironmentError, e:
-            raise MuppetApplicationError(e)
-        except MuppetException, e:
-            raise MuppetApplicationError(e)
-    
+            self.put_jobs(jobs, tag, changed_only and head)
+        finally:
+            if self.sessions is not None:
+                self.sessions.close()
+                self.sessions = None
+        if layered:
+            try:
+                self.overlays.collect(int(self.settings['muppet.overlay_max_age']))
+            except EnvironmentError, e:
+                logging.warning("Failed to clean up %s: %s" % (self.overlays.root, e))
+
+    def put_jobs(self, jobs, tag, head):
+        concurrency = self.variables.get('concurrency', 1)
+        if concurrency <= 1 or len(jobs) <= 1:
+            results = self.put_in_sequence(jobs)
+        else:
+            results = self.put_in_parallel(jobs, concurrency)
+        succeeded = []
+        failed = []
+        for server, host_string, server_settings_dir, paths in jobs:
+            server_succeeded, outputs = results.get(server, (False, ['no result']))
+            print("%s:" % server)
+            for output in outputs:
+                if output:
+                    print('\n'.join('  ' + line for line in output.splitlines()))
+            if server_succeeded:
+                succeeded.append(server)
+                if tag:
+                    self.vcs.put_tag(server, head.id)
+            else:
+                failed.append(server)
+        print("%d succeeded, %d failed" % (len(succeeded), len(failed)))
+        if failed:
+            raise MuppetApplicationError("failed: %s" % ', '.join(failed))
@@ -1,2 +1,7 @@
 class MuppetApplicationError(Exception):
     pass
+
+class Command(object):
+    def __init__(self, settings, variables):
+        self.settings = settings
+        self.variables = variables
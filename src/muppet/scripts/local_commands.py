@@ -0,0 +1,181 @@
+from muppet.exceptions import MuppetException
+from muppet.scripts.common import Command, MuppetApplicationError
+from muppet.tree import Tree, TreeCopier, CopyStats, PathFilter
+from muppet.store import ObjectStore, load_manifest, materialize, collect_garbage, INDEX_SUFFIX
+from muppet.transport import apply_stream
+from muppet.index import load_index, load_shipped_index, compile_tree
+from muppet.plan import Plan
+from muppet.verify import TreeVerifier
+import sys
+import logging
+import os
+
+# returned by verify when the destination has drifted from the tree
+EXIT_DRIFT = 2
+
+class put_local(Command):
+    def make_copier(self):
+        return TreeCopier(
+            dry_run=self.variables.get('dry_run', False),
+            incremental=self.variables.get('incremental', False),
+            cache_dir=self.settings.get('muppet.cache_dir'),
+            jobs=self.variables.get('jobs', 1),
+            partial=self.variables.get('partial', False) or bool(self.variables.get('only')),
+            batch_size=self.variables.get('batch_size'))
+
+    def make_path_filter(self):
+        patterns = self.variables.get('only')
+        return patterns and PathFilter(patterns) or None
+
+    def warn_unmatched(self, path_filter, src):
+        if path_filter is not None:
+            for pattern in path_filter.unmatched():
+                logging.warning("%s does not match anything in %s" % (pattern, src))
+
+    def load_tree(self, src, tree=None):
+        path_filter = self.make_path_filter()
+        if path_filter is not None:
+            # only the part of the tree that was asked for is loaded, so
+            # the compiled index is of no use here
+            tree = Tree.from_annotated_fs(src, path_filter=path_filter)
+            self.warn_unmatched(path_filter, src)
+            return tree
+        if tree is not None:
+            return tree
+        cache_dir = self.settings.get('muppet.cache_dir')
+        tree = cache_dir and load_index(cache_dir, src)
+        if tree is None:
+            tree = Tree.from_annotated_fs(src)
+        return tree
+
+    def __call__(self, src, dest='/'):
+        self.put(src, dest)
+
+    def put(self, src, dest, tree=None):
+        # tree, if given, is what src holds, as loaded by other means
+        try:
+            logging.warning("Copying %s to %s ..." % (src, dest))
+            copier = self.make_copier()
+            if self.variables.get('stream'):
+                path_filter = self.make_path_filter()
+                copier.stream(dest, src, Tree.walk_annotated_fs(src, path_filter=path_filter))
+                self.warn_unmatched(path_filter, src)
+            else:
+                copier(dest, src, self.load_tree(src, tree))
+            copier.finish()
+            logging.warning("Done.")
+        except EnvironmentError, e:
+            raise MuppetApplicationError(e)
+        except MuppetException, e:
+            raise MuppetApplicationError(e)
+    
+
+class plan(put_local):
+    def __call__(self, src, dest='/', plan_file=None):
+        # a saved plan may be carried out from any directory
+        src = os.path.abspath(src)
+        dest = os.path.abspath(dest)
+        try:
+            copier = self.make_copier()
+            plan = copier.plan(dest, src, self.load_tree(src))
+            if plan_file is None:
+                plan.dump(sys.stdout)
+            else:
+                plan.save(plan_file)
+                logging.warning("Saved the plan (%s) to %s" % (plan.summary(), plan_file))
+        except EnvironmentError, e:
+            raise MuppetApplicationError(e)
+        except MuppetException, e:
+            raise MuppetApplicationError(e)
+
+class put_plan(put_local):
+    def __call__(self, plan_file):
+        try:
+            plan = Plan.load(plan_file)
+            logging.warning("Carrying out %s on %s ..." % (plan.summary(), plan.dest))
+            copier = self.make_copier()
+            copier.incremental = plan.incremental
+            if not copier.dry_run:
+                copier.execute(plan)
+            copier.stats = CopyStats.from_plan(plan)
+            copier.unmanaged_files = plan.unmanaged
+            copier.finish()
+            logging.warning("Done.")
+        except EnvironmentError, e:
+            raise MuppetApplicationError(e)
+        except MuppetException, e:
+            raise MuppetApplicationError(e)
+
+class verify(put_local):
+    def __call__(self, src, dest='/'):
+        try:
+            verifier = TreeVerifier(
+                jobs=self.variables.get('jobs', 1),
+                cache_dir=self.settings.get('muppet.cache_dir'),
+                partial=self.variables.get('partial', False) or bool(self.variables.get('only')))
+            report = verifier.verify(dest, src, self.load_tree(src))
+        except EnvironmentError, e:
+            raise MuppetApplicationError(e)
+        except MuppetException, e:
+            raise MuppetApplicationError(e)
+        report.dump(sys.stdout)
+        if report.drift:
+            logging.warning("%d of %d entries in %s have drifted" % (
+                len(report.drifted_paths()), report.checked, dest))
+            return EXIT_DRIFT
+
+class compile_index(Command):
+    def __call__(self, src):
+        try:
+            path = compile_tree(self.settings['muppet.cache_dir'], src)
+            logging.warning("Compiled %s into %s" % (src, path))
+        except EnvironmentError, e:
+            raise MuppetApplicationError(e)
+        except MuppetException, e:
+            raise MuppetApplicationError(e)
+
+class put_staged(put_local):
+    def __call__(self, manifest_file, dest='/'):
+        # the manifest is muppet.cache_dir/runs/<run>/<server>.json
+        manifest_file = os.path.abspath(manifest_file)
+        run_dir = os.path.dirname(manifest_file)
+        cache_dir = os.path.dirname(os.path.dirname(run_dir))
+        src = os.path.splitext(manifest_file)[0]
+        tree = None
+        try:
+            if not os.path.exists(src):
+                logging.info("Staging %s" % src)
+                materialize(
+                    load_manifest(manifest_file),
+                    ObjectStore(os.path.join(cache_dir, 'objects')), src)
+            tree = load_shipped_index(src + INDEX_SUFFIX)
+        except EnvironmentError, e:
+            raise MuppetApplicationError(e)
+        except MuppetException, e:
+            raise MuppetApplicationError(e)
+        self.put(src, dest, tree)
+        self.collect_garbage(cache_dir, os.path.basename(run_dir))
+
+    def collect_garbage(self, cache_dir, run):
+        max_size = self.settings.get('muppet.cache_max_size')
+        try:
+            collect_garbage(
+                cache_dir,
+                keep=int(self.settings.get('muppet.keep_runs', '5')),
+                max_size=max_size and int(max_size),
+                current=run)
+        except EnvironmentError, e:
+            logging.warning("Failed to clean up %s: %s" % (cache_dir, e))
+
+class put_stream(put_local):
+    def __call__(self, dest='/'):
+        try:
+            logging.warning("Copying the stream to %s ..." % dest)
+            copier = self.make_copier()
+            apply_stream(sys.stdin, dest, copier)
+            copier.finish()
+            logging.warning("Done.")
+        except EnvironmentError, e:
+            raise MuppetApplicationError(e)
+        except MuppetException, e:
+            raise MuppetApplicationError(e)
@@ -2,10 +2,10 @@ from argparse import ArgumentParser
 from muppet.utils import find_executable
 from muppet.settings import config_wrapper_from_file, Settings
 from muppet.scripts.constants import *
-from muppet.scripts import commands 
 from muppet.scripts.common import MuppetApplicationError
+from muppet.exceptions import MuppetConfigurationError
+from muppet.stats import stats, count_syscalls
 import logging
-from inspect import getargspec
 import os, sys, re
 
 global_settings_files = [
@@ -13,6 +13,27 @@ global_settings_files = [
     '~/.muppetrc',
     ]
 
+# subcommands are imported only when run, so that those run on every
+# host on every put do not pay for fabric and the VCS backends
+COMMANDS = {
+    'apply': ('muppet.scripts.commands', 'apply'),
+    'put': ('muppet.scripts.commands', 'put'),
+    'put_local': ('muppet.scripts.local_commands', 'put_local'),
+    'plan': ('muppet.scripts.local_commands', 'plan'),
+    'put_plan': ('muppet.scripts.local_commands', 'put_plan'),
+    'verify': ('muppet.scripts.local_commands', 'verify'),
+    'compile': ('muppet.scripts.local_commands', 'compile_index'),
+    'put_staged': ('muppet.scripts.local_commands', 'put_staged'),
+    'put_stream': ('muppet.scripts.local_commands', 'put_stream'),
+    }
+
+def load_command(name):
+    if name not in COMMANDS:
+        return None
+    module_name, class_name = COMMANDS[name]
+    __import__(module_name)
+    return getattr(sys.modules[module_name], class_name)
+
 def initialize_logger(verbose, progname):
     logging.basicConfig(
         stream=sys.stderr,
@@ -27,6 +48,11 @@ def dynamic_defaults():
         'git.command': find_executable('git'),
         'muppet.cache_dir': os.path.join(CACHEDIR, 'muppet'),
         'muppet.timestamp': '%Y%m%d%H%M%S.%f',
+        'muppet.transport': 'store',
+        'muppet.keep_runs': '5',
+        'muppet.overlay_max_age': '604800',
+        'ssh.multiplex': 'no',
+        'ssh.control_persist': '60',
         }
 
 def build_settings():
@@ -40,6 +66,19 @@ def build_settings():
             logging.info("%s does not exist" % settings_file)
     return settings
 
+def report_stats(args):
+    if args.stats:
+        for line in stats.report():
+            logging.warning(line)
+    if args.stats_json:
+        if args.stats_json == '-':
+            stats.dump(sys.stdout)
+        else:
+            f = open(args.stats_json, 'w')
+            try:
+                stats.dump(f)
+            finally:
+                f.close()
 
 def main():
     global _progname
@@ -56,32 +95,108 @@ def main():
     parser.add_argument(
         '-n', '--dry-run', action='store_true',
         help='preflight; use this to verify what will be done')
+    parser.add_argument(
+        '-i', '--incremental', action='store_true',
+        help='leave files that are already up to date untouched')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1, metavar='N',
+        help='number of files to copy concurrently')
+    parser.add_argument(
+        '--batch-size', type=int, metavar='N',
+        help='number of files each job writes at a time (default: a directory)')
+    parser.add_argument(
+        '-P', '--concurrency', type=int, default=1, metavar='N',
+        help='number of servers to put to concurrently')
+    parser.add_argument(
+        '--host-timeout', type=int, metavar='secs',
+        help='give up on a server that does not respond for this long')
+    parser.add_argument(
+        '--transport', choices=['store', 'tar', 'rsync'],
+        help='how put ships settings to servers (default: muppet.transport)')
+    parser.add_argument(
+        '--changed-only', action='store_true',
+        help='put only what changed since the revision last put to each server')
+    parser.add_argument(
+        '--partial', action='store_true',
+        help='the source holds only part of the tree; do not report unmanaged files')
+    parser.add_argument(
+        '--stream', action='store_true',
+        help='copy each directory as soon as it is loaded instead of loading the whole tree first')
+    parser.add_argument(
+        '--only', action='append', metavar='path',
+        help='apply only this part of the tree, such as etc/nginx/** (may be repeated)')
+    parser.add_argument(
+        '--stats', action='store_true',
+        help='report time spent per phase and counts of system calls, operations and subprocesses')
+    parser.add_argument(
+        '--stats-json', type=str, metavar='file',
+        help='write the same figures as JSON to file (- for standard output)')
+    parser.add_argument(
+        '--profile', type=str, metavar='file',
+        help='write cProfile data for the whole command to file')
     parser.add_argument(
         'arg', type=str, nargs='*',
         help='argument to subcommand')
     args = parser.parse_args()
     initialize_logger(args.verbose, parser.prog)
+    restore_syscalls = None
+    if args.stats or args.stats_json:
+        stats.enabled = True
+        restore_syscalls = count_syscalls()
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with stats.timer('phase.command'):
+            run(args)
+    finally:
+        if restore_syscalls is not None:
+            restore_syscalls()
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        report_stats(args)
+
+def run(args):
     try:
         settings = build_settings()
         variables = {
             'cwd': args.project_dir or os.getcwd(),
             'project_dir': args.project_dir,
             'dry_run': args.dry_run,
+            'incremental': args.incremental,
+            'jobs': args.jobs,
+            'batch_size': args.batch_size,
+            'changed_only': args.changed_only,
+            'concurrency': args.concurrency,
+            'host_timeout': args.host_timeout,
+            'transport': args.transport,
+            'partial': args.partial,
+            'only': args.only or [],
+            'stream': args.stream,
             'verbose': args.verbose
             }
 
-        cmd_klass = getattr(commands, args.command[0].replace('-', '_'), None)
+        cmd_klass = load_command(args.command[0].replace('-', '_'))
         if cmd_klass is not None:
             instance = cmd_klass(settings, variables)
             try:
-                instance(*args.arg)
+                status = instance(*args.arg)
             except TypeError, e:
+                from inspect import getargspec
                 raise MuppetApplicationError("usage: %s %s" % (args.command[0], ' '.join(getargspec(instance.__call__).args[1:])))
+            if status:
+                sys.exit(status)
         else:
             raise MuppetApplicationError("command %s is not supported" % args.command[0])
     except MuppetApplicationError, e:
         logging.error(e.message)
         sys.exit(1)
+    except MuppetConfigurationError, e:
+        logging.error("%s" % e)
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
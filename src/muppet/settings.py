@@ -1,4 +1,5 @@
 from ConfigParser import RawConfigParser, NoSectionError, NoOptionError
+from muppet.exceptions import MuppetConfigurationError
 import re
 
 class ConfigWrapper(object):
@@ -6,6 +7,8 @@ class ConfigWrapper(object):
         self.raw_config = raw_config
 
     def __getitem__(self, key):
+        if '.' not in key:
+            raise KeyError(key)
         section, option = key.split('.', 1)
         try:
             return self.raw_config.get(section, option)
@@ -14,18 +17,40 @@ class ConfigWrapper(object):
         except NoOptionError:
             raise KeyError(key)
 
+    def keys(self):
+        return [
+            '%s.%s' % (section, option)
+            for section in self.raw_config.sections()
+            for option in self.raw_config.options(section)
+            ]
+
 def config_wrapper_from_file(filenames):
     raw_config = RawConfigParser()
     raw_config.read(filenames)
     return ConfigWrapper(raw_config)
 
+INTERPOLATION = re.compile(r'\$\{([^}]+)\}')
+
+_absent = object()
+_unresolved = object()
+
 class Settings(object):
     def __init__(self, encoding='utf-8'):
         self.dicts = []
+        self.encodings = []
         self.encoding = encoding
+        self.cache = {}
 
     def add(self, dict):
+        # the encoding of a layer is looked up once, when it is added
+        encoding = self.encoding
+        try:
+            encoding = dict['muppetrc.encoding']
+        except KeyError:
+            pass
         self.dicts.insert(0, dict)
+        self.encodings.insert(0, encoding)
+        self.cache = {}
 
     def get(self, key, default=None):
         try:
@@ -33,21 +58,42 @@ class Settings(object):
         except KeyError:
             return default
 
-    def _fetch(self, dict, key):
-        encoding = self.encoding
-        try:
-            encoding = dict['muppetrc.encoding']
-        except KeyError:
-            pass
-        return unicode(dict[key], encoding)
+    def get_prefixed(self, prefix):
+        keys = set()
+        for layer in self.dicts:
+            keys.update(key for key in layer.keys() if key.startswith(prefix))
+        return dict((key[len(prefix):], self[key]) for key in keys)
 
-    def interpolate(self, value):
-        return re.sub(r'\$\{([^}+])\}', lambda g: self.get(g.group(1), ''), value)
-
-    def __getitem__(self, key):
-        for dict in self.dicts:
+    def _fetch(self, key, resolving):
+        for dict, encoding in zip(self.dicts, self.encodings):
             try:
-                return self.interpolate(self._fetch(dict, key))
+                value = dict[key]
             except KeyError:
-                pass
-        raise KeyError(key)
+                continue
+            return self.interpolate(unicode(value, encoding), resolving + (key, ))
+        return _absent
+
+    def _resolve(self, key, resolving=()):
+        # misses are cached as well, as _absent
+        value = self.cache.get(key, _unresolved)
+        if value is _unresolved:
+            value = self.cache[key] = self._fetch(key, resolving)
+        return value
+
+    def interpolate(self, value, resolving=()):
+        def replace(match):
+            key = match.group(1)
+            if key in resolving:
+                raise MuppetConfigurationError(
+                    "%s refers to itself (%s)" % (key, ' -> '.join(resolving + (key, ))))
+            value = self._resolve(key, resolving)
+            if value is _absent:
+                return u''
+            return value
+        return INTERPOLATION.sub(replace, value)
+
+    def __getitem__(self, key):
+        value = self._resolve(key)
+        if value is _absent:
+            raise KeyError(key)
+        return value
@@ -0,0 +1,74 @@
+import re
+import os
+import shlex
+import shutil
+import hashlib
+import tempfile
+from subprocess import call
+
+def parse_host_string(host_string):
+    g = re.match(r'^(?:([^@]+)@)?(\[[^\]]+\]|[^:]+)(?::(\d+))?$', host_string)
+    if g is None:
+        return None, host_string, None
+    user, host, port = g.groups()
+    return user, host.strip('[]'), port
+
+def ssh_command(settings, host_string, timeout=None, user=None, identity_files=()):
+    # logs in as user unless host_string names someone else
+    host_user, host, port = parse_host_string(host_string)
+    user = host_user or user
+    command = shlex.split(settings.get('ssh.command', 'ssh'))
+    for identity_file in identity_files:
+        command.extend(['-i', identity_file])
+    if port:
+        command.extend(['-p', port])
+    if timeout:
+        command.extend([
+            '-o', 'ConnectTimeout=%d' % timeout,
+            '-o', 'ServerAliveInterval=%d' % timeout,
+            '-o', 'ServerAliveCountMax=1',
+            ])
+    command.append(user and '%s@%s' % (user, host) or host)
+    return command
+
+def multiplex_options(settings, control_path):
+    return [
+        '-o', 'ControlMaster=auto',
+        '-o', 'ControlPath=%s' % control_path,
+        '-o', 'ControlPersist=%s' % settings.get('ssh.control_persist', '60'),
+        ]
+
+class SSHSessionPool(object):
+    # every ssh and rsync invocation for a host goes through a single
+    # OpenSSH master connection, opened by whichever of them comes first
+    # and closed by close(); the control sockets live in a private
+    # directory created up front, so that processes forked to put to
+    # several hosts at once share it
+    def __init__(self, settings, timeout=None):
+        self.settings = settings
+        self.timeout = timeout
+        self.control_dir = tempfile.mkdtemp(prefix='muppet-ssh-')
+
+    def control_path(self, host_string):
+        # socket paths are limited to about a hundred bytes
+        return os.path.join(self.control_dir, hashlib.sha1(host_string).hexdigest()[:16])
+
+    def options_for(self, host_string):
+        return multiplex_options(self.settings, self.control_path(host_string))
+
+    def command_for(self, host_string, **options):
+        command = ssh_command(self.settings, host_string, self.timeout, **options)
+        return command[:-1] + self.options_for(host_string) + command[-1:]
+
+    def close(self):
+        devnull = open(os.devnull, 'w')
+        try:
+            for name in os.listdir(self.control_dir):
+                control_path = os.path.join(self.control_dir, name)
+                call(
+                    shlex.split(self.settings.get('ssh.command', 'ssh')) + [
+                        '-o', 'ControlPath=%s' % control_path, '-O', 'exit', 'muppet'],
+                    stdout=devnull, stderr=devnull)
+        finally:
+            devnull.close()
+            shutil.rmtree(self.control_dir, ignore_errors=True)
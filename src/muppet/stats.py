@@ -0,0 +1,107 @@
+import simplejson as json
+import os
+import time
+import threading
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_null_timer = _NullTimer()
+
+class _Timer(object):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.name, time.time() - self.start)
+        return False
+
+class Stats(object):
+    # counters are named '<group>.<what>', e.g. 'syscall.lstat' or
+    # 'bytes.copied'; timings likewise, e.g. 'phase.load' or
+    # 'subprocess.git'.  Nothing is recorded unless enabled
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name, elapsed):
+        with self.lock:
+            calls, total, longest = self.timings.get(name, (0, 0.0, 0.0))
+            self.timings[name] = (calls + 1, total + elapsed, max(longest, elapsed))
+
+    def timer(self, name):
+        if not self.enabled:
+            return _null_timer
+        return _Timer(self, name)
+
+    def to_json_dict(self):
+        return {
+            'counters': dict(self.counters),
+            'timings': dict(
+                (name, {'calls': calls, 'total': total, 'max': longest})
+                for name, (calls, total, longest) in self.timings.iteritems()),
+            }
+
+    def dump(self, f):
+        json.dump(self.to_json_dict(), f, indent=2, sort_keys=True)
+        f.write('\n')
+
+    def report(self):
+        lines = []
+        for name in sorted(self.timings):
+            calls, total, longest = self.timings[name]
+            lines.append("%-32s %8d calls %10.3fs (max %.3fs)" % (name, calls, total, longest))
+        for name in sorted(self.counters):
+            lines.append("%-32s %14d" % (name, self.counters[name]))
+        return lines
+
+stats = Stats()
+
+COUNTED_SYSCALLS = (
+    'stat', 'lstat', 'fstat', 'open', 'listdir', 'readlink', 'mkdir', 'rmdir',
+    'chmod', 'lchmod', 'fchmod', 'chown', 'lchown', 'fchown', 'utime',
+    'rename', 'unlink', 'symlink', 'link',
+    )
+
+def _counting(name, func):
+    def wrapper(*args, **kwargs):
+        stats.count(name)
+        return func(*args, **kwargs)
+    return wrapper
+
+def count_syscalls():
+    # this replaces the os functions for the whole process, other threads
+    # and libraries included, so it is only done for --stats and undone by
+    # calling the function returned.  The modules that walk the filesystem
+    # look these up at call time, so every call made from Python is counted
+    from muppet import utils, tree, store
+    originals = []
+    for name in COUNTED_SYSCALLS:
+        func = getattr(os, name, None)
+        if func is not None:
+            originals.append((os, name, func))
+            setattr(os, name, _counting('syscall.%s' % name, func))
+    for module in (utils, tree, store):
+        originals.append((module, 'scandir', module.scandir))
+    utils.scandir = tree.scandir = store.scandir = \
+        _counting('syscall.scandir', utils.scandir)
+    def restore():
+        for module, name, func in originals:
+            setattr(module, name, func)
+    return restore
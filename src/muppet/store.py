@@ -0,0 +1,181 @@
+import simplejson as json
+import os
+import errno
+import shutil
+import logging
+from muppet.exceptions import MuppetException
+from muppet.utils import file_digest, scandir
+
+STAGING_VERSION = 1
+
+# beside a run manifest, the compiled index of the tree, if shipped
+INDEX_SUFFIX = '.index.json'
+
+class ObjectStore(object):
+    def __init__(self, root):
+        self.root = root
+
+    def object_path(self, hash):
+        return os.path.join(self.root, hash[:2], hash[2:])
+
+    def has(self, hash):
+        return os.path.exists(self.object_path(hash))
+
+    def add(self, src_path, hash):
+        path = self.object_path(hash)
+        if os.path.exists(path):
+            return path
+        dir = os.path.dirname(path)
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        link_or_copy(src_path, path)
+        return path
+
+    def __iter__(self):
+        for dirent in scandir(self.root):
+            if not dirent.is_dir():
+                continue
+            for object_dirent in scandir(dirent.path):
+                yield dirent.name + object_dirent.name, object_dirent
+
+def link_or_copy(src_path, dest_path):
+    # a symbolic link stands for the file it points to, as with rsync -L;
+    # linked as it is, it would be a dangling link, or none at all to rsync
+    src_path = os.path.realpath(src_path)
+    try:
+        os.link(src_path, dest_path)
+    except EnvironmentError, e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(src_path, dest_path)
+
+def build_manifest(root, paths=None, known=None):
+    # known maps paths to entries of an earlier manifest of the same files,
+    # whose hashes are taken as they are where size and mtime still match
+    entries = []
+    dirs = set()
+    def add_dir(path):
+        while path and path not in dirs:
+            dirs.add(path)
+            entries.append({
+                'path': path,
+                'type': 'directory',
+                'mtime': int(os.stat(os.path.join(root, path)).st_mtime),
+                })
+            path = os.path.dirname(path)
+    def add_file(path):
+        abs_path = os.path.join(root, path)
+        # follow symbolic links, as rsync -L does
+        stat = os.stat(abs_path)
+        entry = known and known.get(path)
+        if entry is None or entry['type'] != 'file' or \
+                entry['size'] != stat.st_size or entry['mtime'] != int(stat.st_mtime):
+            entry = {
+                'path': path,
+                'type': 'file',
+                'hash': file_digest(abs_path),
+                'size': stat.st_size,
+                'mtime': int(stat.st_mtime),
+                }
+        entries.append(entry)
+        add_dir(os.path.dirname(path))
+
+    if paths is None:
+        stack = ['']
+        while stack:
+            dir = stack.pop()
+            for dirent in scandir(os.path.join(root, dir)):
+                path = os.path.join(dir, dirent.name)
+                if dirent.is_dir():
+                    add_dir(path)
+                    stack.append(path)
+                else:
+                    add_file(path)
+    else:
+        for path in paths:
+            add_file(path)
+    entries.sort(key=lambda entry: entry['path'])
+    return {'version': STAGING_VERSION, 'entries': entries}
+
+def load_manifest(path):
+    try:
+        manifest = json.load(open(path))
+    except ValueError, e:
+        raise MuppetException("%s is corrupt" % path, e)
+    if manifest.get('version') != STAGING_VERSION:
+        raise MuppetException("%s has an unsupported version" % path)
+    return manifest
+
+def stage_objects(manifest, src, store):
+    for entry in manifest['entries']:
+        if entry['type'] == 'file':
+            store.add(os.path.join(src, entry['path']), entry['hash'])
+
+def materialize(manifest, store, dest):
+    os.mkdir(dest)
+    dirs = []
+    for entry in manifest['entries']:
+        path = os.path.join(dest, entry['path'])
+        if entry['type'] == 'directory':
+            os.mkdir(path)
+            dirs.append((path, entry['mtime']))
+        else:
+            object_path = store.object_path(entry['hash'])
+            if not os.path.exists(object_path):
+                raise MuppetException("object %s for %s is missing" % (entry['hash'], entry['path']))
+            link_or_copy(object_path, path)
+    for path, mtime in reversed(dirs):
+        os.utime(path, (mtime, mtime))
+
+def collect_garbage(cache_dir, keep, max_size=None, current=None):
+    # a run is a directory under runs holding the manifest of every server
+    # staged in it; its servers are put one after another, so the run
+    # being put, current, is kept whatever keep and max_size say
+    runs_dir = os.path.join(cache_dir, 'runs')
+    store = ObjectStore(os.path.join(cache_dir, 'objects'))
+    runs = sorted(
+        name for name in os.listdir(runs_dir)
+        if os.path.isdir(os.path.join(runs_dir, name)))
+    retained = runs[-max(keep, 1):]
+    if current is not None and current not in retained:
+        retained.insert(0, current)
+
+    def hashes_of(run):
+        retval = set()
+        run_dir = os.path.join(runs_dir, run)
+        for name in os.listdir(run_dir):
+            if not name.endswith('.json') or name.endswith(INDEX_SUFFIX):
+                continue
+            try:
+                manifest = load_manifest(os.path.join(run_dir, name))
+            except MuppetException, e:
+                logging.warning("%s" % e)
+                continue
+            retval.update(
+                entry['hash'] for entry in manifest['entries']
+                if entry['type'] == 'file')
+        return retval
+
+    referenced = dict((run, hashes_of(run)) for run in retained)
+    sizes = dict(
+        (hash, dirent.stat().st_size) for hash, dirent in store)
+    if max_size is not None:
+        while sum(
+                sizes.get(hash, 0)
+                for hash in set().union(*referenced.values())) > max_size:
+            older = [run for run in retained[:-1] if run != current]
+            if not older:
+                break
+            retained.remove(older[0])
+            del referenced[older[0]]
+
+    for run in runs:
+        if run in referenced:
+            continue
+        logging.info("Removing staged run %s" % run)
+        shutil.rmtree(os.path.join(runs_dir, run))
+
+    live = set().union(*referenced.values())
+    for hash in sizes:
+        if hash not in live:
+            os.unlink(store.object_path(hash))
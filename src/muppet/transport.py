@@ -0,0 +1,103 @@
+import simplejson as json
+import os
+import tarfile
+from cStringIO import StringIO
+from muppet.exceptions import MuppetException
+from muppet.store import build_manifest
+from muppet.tree import Tree, MUPPET_META
+
+MANIFEST_MEMBER = '.muppet-manifest'
+
+class ManifestStat(object):
+    def __init__(self, entry):
+        self.st_size = entry['size']
+        self.st_mtime = entry['mtime']
+        self.st_atime = entry['mtime']
+
+class StreamedFile(object):
+    def __init__(self, path, entry):
+        self.path = path
+        self.stat = ManifestStat(entry)
+        self.hash = entry['hash']
+        self.fileobj = None
+
+    def digest(self):
+        return self.hash
+
+    def write_to(self, fd, bufsize=1 << 20):
+        while True:
+            buf = self.fileobj.read(bufsize)
+            if not buf:
+                break
+            while buf:
+                buf = buf[os.write(fd, buf):]
+
+class StreamedFS(object):
+    def __init__(self, manifest, metadata):
+        self.children = {}
+        for entry in manifest['entries']:
+            dir, name = os.path.split(entry['path'])
+            self.children.setdefault(dir, []).append(
+                (name, entry['type'] == 'directory'))
+        self.metadata = metadata
+
+    def scan(self, path):
+        return self.children.get(path, [])
+
+    def load_metadata(self, path):
+        return self.metadata[path]
+
+def _add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, StringIO(data))
+
+def write_stream(root, paths, fileobj, manifest=None):
+    # the stream starts with the manifest and every .muppetmeta, so that
+    # the receiving end can build the tree and decide what to do with
+    # each file before its content arrives
+    if manifest is None:
+        manifest = build_manifest(root, paths)
+    files = [entry['path'] for entry in manifest['entries'] if entry['type'] == 'file']
+    files.sort(key=lambda path: (os.path.basename(path) != MUPPET_META, path))
+    tar = tarfile.open(fileobj=fileobj, mode='w|gz', dereference=True)
+    try:
+        _add_bytes(tar, MANIFEST_MEMBER, json.dumps(manifest))
+        for path in files:
+            tar.add(os.path.join(root, path), arcname=path, recursive=False)
+    finally:
+        tar.close()
+
+def apply_stream(fileobj, dest, copier):
+    tar = tarfile.open(fileobj=fileobj, mode='r|gz')
+    members = iter(tar)
+    member = next(members, None)
+    if member is None or member.name != MANIFEST_MEMBER:
+        raise MuppetException("not a muppet stream")
+    manifest = json.load(tar.extractfile(member))
+    files = dict(
+        (entry['path'], entry) for entry in manifest['entries']
+        if entry['type'] == 'file')
+
+    metadata = {}
+    for member in members:
+        if os.path.basename(member.name) != MUPPET_META:
+            break
+        try:
+            metadata[member.name] = json.load(tar.extractfile(member))
+        except ValueError, e:
+            raise MuppetException("%s" % member.name, e)
+    else:
+        member = None
+
+    tree = Tree.from_annotated_fs('', fs=StreamedFS(manifest, metadata))
+    copier.defer_writes(lambda path: StreamedFile(path, files[path]))
+    copier(dest, '', tree)
+    while member is not None:
+        if member.isfile():
+            copier.write_deferred(member.name, tar.extractfile(member))
+        member = next(members, None)
+    pending = copier.pending_writes()
+    if pending:
+        raise MuppetException("%s did not arrive" % ', '.join(pending))
+    return tree
@@ -3,8 +3,15 @@ import os
 import logging
 from stat import *
 from muppet.exceptions import MuppetException, MuppetPrerequisiteError
-from muppet.utils import getuidfor, getgidfor
+from muppet.utils import IdResolver, file_digest, WorkerPool, CollectedErrors, scandir, scan_dir, lstat_dirent, copy_fd, current_umask, symlink_modes_supported
+from muppet.manifest import Manifest
+from muppet.plan import Plan
+from muppet.stats import stats
+import errno
 import shutil
+import threading
+import tempfile
+from fnmatch import fnmatchcase
 
 MUPPET_META = '.muppetmeta'
 
@@ -15,31 +22,130 @@ class Tree(object):
     def __repr__(self):
         return '%s(root=%r)' % (self.__class__.__name__, self.root)
 
+    def owners_and_groups(self):
+        owners = set()
+        groups = set()
+        stack = [self.root]
+        while stack:
+            entry = stack.pop()
+            if entry.owner is not None:
+                owners.add(entry.owner)
+            if entry.group is not None:
+                groups.add(entry.group)
+            if isinstance(entry, Directory):
+                stack.extend(entry.entries.itervalues())
+        return owners, groups
+
     @classmethod
-    def from_annotated_fs(self, root, prototype=None):
+    def from_annotated_fs(self, root, prototype=None, fs=None, path_filter=None):
         retval = Tree()
-        retval.root = Directory.from_annotated_fs(retval, root, prototype)
+        with stats.timer('phase.load'):
+            retval.root = Directory.from_annotated_fs(retval, root, prototype, fs or LocalFS(), path_filter)
         return retval
 
+    @classmethod
+    def walk_annotated_fs(self, root, prototype=None, fs=None, path_filter=None):
+        return Directory.walk_annotated_fs(Tree(), root, prototype, fs or LocalFS(), path_filter)
+
+class LocalFS(object):
+    # with follow_symlinks, a symbolic link to a directory is loaded as the
+    # directory, as the transports ship it (rsync -L)
+    def __init__(self, follow_symlinks=False):
+        self.follow_symlinks = follow_symlinks
+
+    def scan(self, path):
+        return [
+            (dirent.name, dirent.is_dir(follow_symlinks=self.follow_symlinks))
+            for dirent in scandir(path)
+            ]
+
+    def load_metadata(self, path):
+        with stats.timer('load.parse-metadata'):
+            return json.load(open(path))
+
+_interned = {}
+
+def intern_value(value):
+    # owner, group and expects values repeat across most of a tree, so a
+    # single instance of each is shared by every entry that uses it
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        key = (dict, tuple(sorted(value.iteritems())))
+    else:
+        key = value
+    return _interned.setdefault(key, value)
+
+class PathFilter(object):
+    # patterns are paths relative to the root of the tree, whose components
+    # may contain shell wildcards; a pattern selects the entry it names and
+    # everything below it, and a trailing '**' is accepted for clarity
+    def __init__(self, patterns):
+        self.patterns = []
+        for pattern in patterns:
+            components = [component for component in pattern.split('/') if component]
+            if components and components[-1] == '**':
+                components.pop()
+            if '**' in components:
+                raise MuppetException("'**' is only supported at the end of %s" % pattern)
+            self.patterns.append((pattern, components))
+        self.matched = set()
+
+    def _matches(self, path_components, pattern_components):
+        for path_component, pattern_component in zip(path_components, pattern_components):
+            if not fnmatchcase(path_component, pattern_component):
+                return False
+        return True
+
+    def selects(self, path):
+        components = [component for component in path.split('/') if component]
+        for pattern, pattern_components in self.patterns:
+            if len(components) >= len(pattern_components) and \
+                    self._matches(components, pattern_components):
+                self.matched.add(pattern)
+                return True
+        return False
+
+    def leads_to(self, path):
+        components = [component for component in path.split('/') if component]
+        for pattern, pattern_components in self.patterns:
+            if len(components) < len(pattern_components) and \
+                    self._matches(components, pattern_components):
+                return True
+        return False
+
+    def unmatched(self):
+        return [pattern for pattern, components in self.patterns if pattern not in self.matched]
+
 class EntryMetadata(object):
+    __slots__ = ('entry_defaults', 'expects')
+
     def __init__(self, entry_defaults=None, expects=None):
-        self.entry_defaults = entry_defaults or Entry()
-        self.expects = expects or {}
+        self.entry_defaults = entry_defaults or NO_DEFAULTS
+        self.expects = intern_value(expects or {})
+
+    def is_empty(self):
+        return self.entry_defaults is NO_DEFAULTS and not self.expects
 
     def merge(self, that):
-        if self.expects:
+        # metadata is never modified once built, so it is shared rather
+        # than copied whenever one side contributes nothing
+        if that is self or that.is_empty():
+            return self
+        if self.is_empty():
+            return that
+        if self.expects and that.expects:
             expects = dict(self.expects)
-            if that.expects:
-                expects.update(that.expects)
+            expects.update(that.expects)
         else:
-            if that.expects:
-                expects = dict(that.expects)
-            else:
-                expects = {}
-        return self.__class__(
-            entry_defaults=self.entry_defaults.merge(that.entry_defaults),
-            expects=expects
-            )
+            expects = that.expects or self.expects
+        if that.entry_defaults is NO_DEFAULTS:
+            entry_defaults = self.entry_defaults
+        elif self.entry_defaults is NO_DEFAULTS:
+            entry_defaults = that.entry_defaults
+        else:
+            entry_defaults = self.entry_defaults.merge(that.entry_defaults)
+        return self.__class__(entry_defaults=entry_defaults, expects=expects)
 
     @classmethod
     def from_json_dict(self, dict_):
@@ -53,14 +159,16 @@ class EntryMetadata(object):
             )
 
 class Entry(object):
+    __slots__ = ('tree', 'parent', 'name', 'meta', 'mode', 'owner', 'group')
+
     def __init__(self, tree=None, parent=None, name=None, meta=None, mode=None, owner=None, group=None, **kwargs):
         self.tree = tree
         self.parent = parent
         self.name = name
         self.meta = meta
         self.mode = mode
-        self.owner = owner
-        self.group = group
+        self.owner = intern_value(owner)
+        self.group = intern_value(group)
 
     def merge(self, that):
         if isinstance(that, self.__class__):
@@ -101,10 +209,15 @@ class Entry(object):
             group=dict.get('file-group')
             )
 
+NO_DEFAULTS = Entry()
+NO_METADATA = EntryMetadata()
+
 class File(Entry):
-    pass
+    __slots__ = ()
 
 class Symlink(Entry):
+    __slots__ = ('to',)
+
     def __init__(self, *args, **kwargs):
         Entry.__init__(self, *args, **kwargs)
         self.to = kwargs.get('to', None)
@@ -118,32 +231,46 @@ class Symlink(Entry):
         return retval
 
 class Directory(Entry):
+    __slots__ = ('entries',)
+
     def __init__(self, *args, **kwargs):
         Entry.__init__(self, *args, **kwargs)
-        self.entries = set()
+        self.entries = {}
 
     def add(self, entry):
-        self.entries.add(entry)
+        existing = self.entries.get(entry.name)
+        if existing is not None:
+            entry = existing.merge(entry)
+        self.entries[entry.name] = entry
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def children(self):
+        return [self.entries[name] for name in sorted(self.entries)]
 
     def merge(self, that):
         retval = Entry.merge(self, that)
-        if isinstance(that, Directory):
-            retval.entries.update(that.entries)
+        # children of the same name are merged rather than duplicated
+        for dir in (self, that):
+            if isinstance(dir, Directory):
+                for entry in dir.entries.itervalues():
+                    retval.add(entry)
         return retval
 
     def __repr__(self):
-        return '%s[%s]' % (object.__repr__(self), ', '.join(repr(i) for i in self.entries))
+        return '%s[%s]' % (object.__repr__(self), ', '.join(repr(i) for i in self.children()))
 
     @classmethod
-    def from_annotated_fs(self, tree, root, prototype):
+    def _from_metadata(self, tree, root, prototype, has_metadata, fs):
         metadata_file = os.path.join(root, MUPPET_META)
         metadata_json = None
-        retval = Directory(tree, None, None, EntryMetadata())
+        retval = Directory(tree, None, None, NO_METADATA)
         if prototype:
             retval = prototype.merge(retval)
-        if os.path.exists(metadata_file):
+        if has_metadata:
             try:
-                metadata_json = json.load(open(metadata_file))
+                metadata_json = fs.load_metadata(metadata_file)
             except ValueError, e:
                 raise MuppetException("%s" % metadata_file, e)
             retval = retval.merge(
@@ -163,128 +290,632 @@ class Directory(Entry):
                 entry_prototypes[entry.name] = entry.merge(
                     retval.meta.entry_defaults.merge(
                         Entry.from_json_dict(metadata_json_for_entry)))
- 
-        for entry_name in os.listdir(root):
-            abs_path = os.path.join(root, entry_name)
-            if entry_name == MUPPET_META:
-                continue
-            
-            entry_prototype = entry_prototypes.get(entry_name)
-
-            stat = os.lstat(abs_path)
-            if stat.st_mode & S_IFDIR:
-                entry = Directory(tree, retval, entry_name, EntryMetadata())
-            elif entry_prototype is None:
-                entry = File(tree, retval, entry_name, EntryMetadata())
-            else:
-                entry = Entry(tree, retval, entry_name, EntryMetadata())
+        return retval, entry_prototypes
 
-            if entry_prototype is not None:
-                entry = entry_prototype.merge(entry)
-            else:
-                logging.info("Metadata for %s is not provided" % abs_path)
-            if isinstance(entry, Directory):
-                entry = Directory.from_annotated_fs(tree, abs_path, entry)
-            if entry.__class__ == Entry:
-                logging.warning("%s is not a regular file; ignored" % entry.name)
+    @classmethod
+    def walk_annotated_fs(self, tree, root, prototype, fs, path_filter=None):
+        # yields (parent, path relative to root, directory, names of its
+        # subdirectories) for each directory in name order, parents first.
+        # A directory holds its files and symbolic links once yielded; its
+        # subdirectories follow as they are loaded, so that only the
+        # directories pending on the way down are held at any time.
+        # The walk uses an explicit stack so that the depth of the tree is
+        # not bounded by the recursion limit.  With a path filter, only the
+        # directories on the way to a selected subtree are read outside it
+        stack = [(None, root, '', prototype, path_filter is None or path_filter.selects(''))]
+        while stack:
+            parent, path, rel_path, prototype, selected = stack.pop()
+            dirents = fs.scan(path)
+            dir, entry_prototypes = self._from_metadata(
+                tree, path, prototype,
+                any(entry_name == MUPPET_META for entry_name, is_dir in dirents),
+                fs)
+
+            subdirs = []
+            for entry_name, is_dir in dirents:
+                if entry_name == MUPPET_META:
+                    continue
+
+                entry_rel_path = os.path.join(rel_path, entry_name)
+                entry_selected = selected or path_filter.selects(entry_rel_path)
+                if not entry_selected and \
+                        not (is_dir and path_filter.leads_to(entry_rel_path)):
+                    continue
+
+                abs_path = os.path.join(path, entry_name)
+                entry_prototype = entry_prototypes.get(entry_name)
+
+                if is_dir:
+                    entry = Directory(tree, dir, entry_name, NO_METADATA)
+                elif entry_prototype is None:
+                    entry = File(tree, dir, entry_name, NO_METADATA)
+                else:
+                    entry = Entry(tree, dir, entry_name, NO_METADATA)
+
+                if entry_prototype is not None:
+                    entry = entry_prototype.merge(entry)
+                else:
+                    logging.info("Metadata for %s is not provided" % abs_path)
+                if isinstance(entry, Directory):
+                    subdirs.append((dir, abs_path, entry_rel_path, entry, entry_selected))
+                elif entry.__class__ == Entry:
+                    logging.warning("%s is not a regular file; ignored" % entry.name)
+                else:
+                    dir.add(entry)
+
+            subdirs.sort(key=lambda subdir: subdir[3].name, reverse=True)
+            stack.extend(subdirs)
+            yield parent, rel_path, dir, [subdir[3].name for subdir in subdirs]
+
+    @classmethod
+    def from_annotated_fs(self, tree, root, prototype, fs, path_filter=None):
+        retval = None
+        for parent, rel_path, dir, subdir_names in \
+                self.walk_annotated_fs(tree, root, prototype, fs, path_filter):
+            if parent is None:
+                retval = dir
             else:
-                retval.add(entry)
- 
+                parent.add(dir)
         return retval
 
-def set_mode_and_owner(entry_path, stat, entry):
-    if entry.mode is not None:
+def set_mode_and_owner(entry_path, mode, owner, group, resolver):
+    if mode is not None:
         if hasattr(os, 'lchmod'):
-            os.lchmod(entry_path, entry.mode)
+            try:
+                os.lchmod(entry_path, mode)
+            except OSError, e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOSYS):
+                    raise
+                # chmod() would follow a link and change its target
+                if not os.path.islink(entry_path):
+                    os.chmod(entry_path, mode)
         else:
-            os.chmod(entry_path, entry.mode)
-    if entry.owner is not None or entry.group is not None:
-        owner = getuidfor(entry.owner) or stat.st_uid
-        group = getgidfor(entry.group) or stat.st_gid
-        os.lchown(entry_path, owner, group)
+            os.chmod(entry_path, mode)
+    if owner is not None or group is not None:
+        os.lchown(entry_path, *resolver.ids_for(owner, group))
+
+class SourceFile(object):
+    def __init__(self, path):
+        self.path = path
+        self._stat = None
+
+    @property
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def digest(self):
+        return file_digest(self.path)
+
+    def write_to(self, fd):
+        src_fd = os.open(self.path, os.O_RDONLY)
+        try:
+            copy_fd(src_fd, fd)
+        finally:
+            os.close(src_fd)
+
+def replace_file(dest_path, source, mode, owner, group, resolver, keep_mtime=False):
+    # the new content is assembled in a temporary file next to dest_path,
+    # given its final mode and owner, and then renamed over dest_path so
+    # that the file is never observed missing or half-written
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(dest_path),
+        prefix='.%s.muppet-' % os.path.basename(dest_path))
+    try:
+        try:
+            source.write_to(fd)
+            os.fchmod(fd, mode)
+            if owner is not None or group is not None:
+                os.fchown(fd, *resolver.ids_for(owner, group))
+        finally:
+            os.close(fd)
+        if keep_mtime:
+            os.utime(tmp_path, (source.stat.st_atime, source.stat.st_mtime))
+        os.rename(tmp_path, dest_path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+def metadata_drifted(stat, entry, resolver):
+    return mode_drifted(stat, entry) or owner_drifted(stat, entry, resolver)
+
+def mode_applies(entry):
+    # the mode of a symbolic link is only ever set where links have one;
+    # elsewhere lstat() reads 0777 whatever was asked for
+    return entry.mode is not None and (not isinstance(entry, Symlink) or symlink_modes_supported())
+
+def mode_drifted(stat, entry):
+    return mode_applies(entry) and S_IMODE(stat.st_mode) != entry.mode
+
+def owner_drifted(stat, entry, resolver):
+    if entry.owner is not None and stat.st_uid != resolver.uid_for(entry.owner):
+        return True
+    if entry.group is not None and stat.st_gid != resolver.gid_for(entry.group):
+        return True
+    return False
+
+def contents_identical(source, dest_path, dest_stat):
+    if not S_ISREG(dest_stat.st_mode):
+        return False
+    if source.stat.st_size != dest_stat.st_size:
+        return False
+    if int(source.stat.st_mtime) == int(dest_stat.st_mtime):
+        return True
+    return source.digest() == file_digest(dest_path)
+
+ENTRY_TYPE_CHECKS = {
+    'directory': S_ISDIR,
+    'symlink': S_ISLNK,
+    'file': S_ISREG,
+    }
+
+ENTRY_TYPE_NAMES = {
+    'directory': 'a directory',
+    'symlink': 'a symbolic link',
+    'file': 'a regular file',
+    }
+
+def entry_type_name(entry):
+    if isinstance(entry, Directory):
+        return 'directory'
+    elif isinstance(entry, Symlink):
+        return 'symlink'
+    else:
+        return 'file'
+
+def verify_precreated(path, stat, type):
+    if stat is None:
+        raise MuppetPrerequisiteError("%s must have been created" % path)
+    if not ENTRY_TYPE_CHECKS[type](stat.st_mode):
+        raise MuppetPrerequisiteError("%s must be %s" % (path, ENTRY_TYPE_NAMES[type]))
+
+class CopyStats(object):
+    def __init__(self):
+        self.skipped = 0
+        self.rewritten = 0
+        self.metadata_fixed = 0
+        self.lock = threading.Lock()
+
+    def count(self, kind):
+        with self.lock:
+            setattr(self, kind, getattr(self, kind) + 1)
+
+    @classmethod
+    def from_plan(self, plan):
+        retval = self()
+        rewritten = set(operation['path'] for operation in plan.select('create', 'replace'))
+        retval.rewritten = len(rewritten)
+        retval.metadata_fixed = len(set(
+            operation['path'] for operation in plan.select('chmod', 'chown')
+            ) - rewritten)
+        retval.skipped = len(plan.select('keep'))
+        return retval
+
+    def __str__(self):
+        return "%d rewritten, %d metadata fixed, %d skipped" % (
+            self.rewritten, self.metadata_fixed, self.skipped)
 
 class TreeCopier(object):
-    def __init__(self, dry_run=False):
+    # plan() compares a tree with the destination and returns the
+    # operations that would bring the destination in line with it, without
+    # touching anything; execute() carries out a plan
+    def __init__(self, dry_run=False, incremental=False, cache_dir=None, jobs=1, partial=False, batch_size=None):
         self.dry_run = dry_run
+        self.partial = partial
+        self.incremental = incremental
+        self.cache_dir = cache_dir
+        self.previous_manifest = None
+        self.jobs = jobs
+        self.batch_size = batch_size
+        # what a file without a mode of its own is given, as if created
+        # afresh; the umask is read here, before any worker thread runs
+        self.default_file_mode = 0666 & ~current_umask()
+        self.pool = None
+        self.source_for = SourceFile
+        self.deferred = None
+        self.resolver = IdResolver()
+        self.manifest = None
         self.unmanaged_files = []
+        self.stats = CopyStats()
+
+    def _load_manifests(self, dest):
+        if self.incremental and self.manifest is None:
+            if self.cache_dir is not None:
+                self.previous_manifest = Manifest.load(self.cache_dir, dest)
+            self.manifest = Manifest(dest)
+            if self.partial and self.previous_manifest is not None:
+                # entries outside the partial source are left as they were
+                self.manifest.entries.update(self.previous_manifest.entries)
+
+    def _record(self, dest_path, source=None):
+        if self.manifest is not None and not self.dry_run:
+            self.manifest.record(
+                dest_path, os.lstat(dest_path),
+                source, self.previous_manifest)
+
+    def _identical(self, dest_path, stat, source):
+        if self.previous_manifest is not None:
+            if self.previous_manifest.unchanged(dest_path, stat, source.stat):
+                return True
+            record = self.previous_manifest.lookup(dest_path)
+            if record is not None and S_ISREG(stat.st_mode):
+                # rewritten since the last run, whatever its mtime says now;
+                # the recorded hash stands for a source that has not changed
+                if record.get('src_size') == source.stat.st_size and \
+                        record.get('src_mtime') == int(source.stat.st_mtime) and \
+                        record.get('hash'):
+                    src_digest = record['hash']
+                else:
+                    src_digest = source.digest()
+                return source.stat.st_size == stat.st_size and \
+                    src_digest == file_digest(dest_path)
+        return contents_identical(source, dest_path, stat)
+
+    def check_unmanaged(self, path, names, entries):
+        self.unmanaged_files.extend(os.path.join(path, file) for file in sorted(set(names).difference(entries)))
+
+    def _plan_metadata(self, plan, dest_path, stat, entry, src_path=None):
+        fields = {}
+        if src_path is not None:
+            fields['src'] = src_path
+        drifted = False
+        if mode_drifted(stat, entry):
+            plan.add('chmod', dest_path, mode=entry.mode, **fields)
+            drifted = True
+        if owner_drifted(stat, entry, self.resolver):
+            plan.add('chown', dest_path, owner=entry.owner, group=entry.group, **fields)
+            drifted = True
+        if drifted:
+            logging.info("Fixing mode and owner of %s" % dest_path)
+            self.stats.count('metadata_fixed')
+        else:
+            logging.info("%s is up to date" % dest_path)
+            plan.add('keep', dest_path, **fields)
+            self.stats.count('skipped')
 
-    def check_unmanaged(self, path, entries):
-        self.unmanaged_files.extend(os.path.join(path, file) for file in set(os.listdir(path)) - set(entry.name for entry in entries))
+    def _plan_remove(self, plan, dest_path, stat):
+        logging.info("%s already exists; removing it" % dest_path)
+        plan.add('remove', dest_path)
 
-    def _copy(self, dest, src, dir):
-        for entry in dir.entries:
+    def _plan_directory(self, plan, dest_path, stat, entry):
+        if stat and not S_ISDIR(stat.st_mode):
+            logging.info("%s is not a directory; removing it" % dest_path)
+            plan.add('remove', dest_path)
+            stat = None
+        if self.incremental and stat is not None:
+            self._plan_metadata(plan, dest_path, stat, entry)
+        else:
+            logging.info("Creating %s" % dest_path)
+            if stat is None:
+                plan.add(
+                    'create', dest_path, type='directory',
+                    mode=entry.mode, owner=entry.owner, group=entry.group)
+            else:
+                if entry.mode is not None:
+                    plan.add('chmod', dest_path, mode=entry.mode)
+                if entry.owner is not None or entry.group is not None:
+                    plan.add('chown', dest_path, owner=entry.owner, group=entry.group)
+            self.stats.count('rewritten')
+        return stat is not None
+
+    def _plan_symlink(self, plan, dest_path, stat, entry):
+        if stat:
+            if self.incremental and S_ISLNK(stat.st_mode) and \
+                    os.readlink(dest_path) == entry.to:
+                self._plan_metadata(plan, dest_path, stat, entry)
+                return
+            self._plan_remove(plan, dest_path, stat)
+        logging.info("Creating %s" % dest_path)
+        plan.add(
+            'create', dest_path, type='symlink', to=entry.to,
+            mode=mode_applies(entry) and entry.mode or None,
+            owner=entry.owner, group=entry.group)
+        self.stats.count('rewritten')
+
+    def _plan_file(self, plan, dest_path, source, stat, entry):
+        if self.incremental:
+            if stat and self._identical(dest_path, stat, source):
+                self._plan_metadata(plan, dest_path, stat, entry, source.path)
+                return
+        op = 'create'
+        if stat:
+            if S_ISDIR(stat.st_mode):
+                self._plan_remove(plan, dest_path, stat)
+            else:
+                op = 'replace'
+        logging.info("Copying %s to %s" % (source.path, dest_path))
+        plan.add(
+            op, dest_path, type='file', src=source.path,
+            mode=entry.mode, owner=entry.owner, group=entry.group)
+        self.stats.count('rewritten')
+
+    def _plan_entry(self, plan, dest_path, src_path, stat, entry, pool=None):
+        # returns whether dest_path is, or is planned to be, a directory
+        if 'precreated' in entry.meta.expects:
+            type = entry_type_name(entry)
+            logging.info("Verifying %s is %s" % (dest_path, ENTRY_TYPE_NAMES[type]))
+            verify_precreated(dest_path, stat, type)
+            plan.add('verify', dest_path, type=type)
+            return True
+        if isinstance(entry, Directory):
+            return self._plan_directory(plan, dest_path, stat, entry)
+        elif isinstance(entry, Symlink):
+            self._plan_symlink(plan, dest_path, stat, entry)
+        elif isinstance(entry, File):
+            source = self.source_for(src_path)
+            if pool is not None:
+                pool.submit(dest_path, self._plan_file, plan, dest_path, source, stat, entry)
+            else:
+                self._plan_file(plan, dest_path, source, stat, entry)
+        return False
+
+    def _plan_entries(self, plan, dest, src, dir, exists, report_unmanaged, managed=None, pool=None):
+        # a single scan of the destination directory tells which entries
+        # exist and which of them are unmanaged
+        dirents = exists and scan_dir(dest) or {}
+        if report_unmanaged and not self.partial:
+            self.check_unmanaged(dest, dirents, managed or dir.entries)
+        subdirs = []
+        for entry in dir.children():
             dest_path = os.path.join(dest, entry.name)
             src_path = os.path.join(src, entry.name)
+            stat = lstat_dirent(dirents.get(entry.name))
+            is_dir = self._plan_entry(plan, dest_path, src_path, stat, entry, pool)
+            if isinstance(entry, Directory):
+                subdirs.append((dest_path, src_path, entry, is_dir, True))
+        return subdirs
+
+    def _plan(self, plan, dest, src, dir):
+        stack = [(dest, src, dir, True, False)]
+        while stack:
+            subdirs = self._plan_entries(plan, *stack.pop(), pool=self.pool)
+            # descend in name order as well
+            stack.extend(reversed(subdirs))
+
+    def _run_pool(self, func, *args):
+        if self.pool is not None:
+            # the pool outlives this call; see stream()
+            func(*args)
+            return
+        self.pool = WorkerPool(self.jobs)
+        errors = []
+        try:
+            func(*args)
+        finally:
+            if self.pool is not None:
+                errors = self.pool.join()
+                self.pool = None
+        if errors:
+            raise_collected_errors(errors)
+
+    def plan(self, dest, src, tree):
+        # resolve every owner and group up front so that an unknown name
+        # fails the run before anything has been written
+        self.resolver.preload(*tree.owners_and_groups())
+        self._load_manifests(dest)
+        plan = Plan(dest, src, self.incremental)
+        # comparing file contents is the expensive part of planning, so
+        # that is what goes to the pool
+        with stats.timer('phase.plan'):
+            self._run_pool(self._plan, plan, dest, src, tree.root)
+            plan.sort()
+        plan.unmanaged = self.unmanaged_files
+        return plan
+
+    def _write_file(self, operation, source):
+        # in incremental mode the source mtime is kept, so that the next
+        # run can take the size / mtime shortcut instead of hashing
+        mode = operation.get('mode')
+        if mode is None:
+            mode = self.default_file_mode
+        replace_file(
+            operation['path'], source, mode,
+            operation.get('owner'), operation.get('group'),
+            self.resolver, self.incremental)
+        stats.count('files.copied')
+        stats.count('bytes.copied', source.stat.st_size)
+        self._record(operation['path'], source)
+
+    def defer_writes(self, source_for):
+        # from now on the content of each file is written once it is handed
+        # to write_deferred(), rather than when the plan is carried out;
+        # source_for(path) stands for the file until then
+        self.source_for = source_for
+        self.deferred = {}
+
+    def pending_writes(self):
+        return sorted(self.deferred or ())
+
+    def write_deferred(self, path, fileobj):
+        operation = self.deferred.pop(path, None)
+        if operation is not None:
+            source = self.source_for(path)
+            source.fileobj = fileobj
+            self._write_file(operation, source)
+
+    def _execute_verify(self, operation):
+        try:
+            stat = os.lstat(operation['path'])
+        except OSError:
+            stat = None
+        verify_precreated(operation['path'], stat, operation['type'])
+
+    def _execute_remove(self, operation):
+        path = operation['path']
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+
+    def _execute_mkdir(self, operation):
+        path = operation['path']
+        try:
+            os.mkdir(path)
+        except OSError, e:
+            # a saved plan may be carried out after the directory appeared
+            if e.errno != errno.EEXIST or not os.path.isdir(path):
+                raise
+        set_mode_and_owner(path, operation.get('mode'), operation.get('owner'), operation.get('group'), self.resolver)
+
+    def _execute_write(self, operation):
+        if operation['type'] == 'symlink':
+            os.symlink(operation['to'], operation['path'])
+            set_mode_and_owner(
+                operation['path'], operation.get('mode'),
+                operation.get('owner'), operation.get('group'), self.resolver)
+        elif self.deferred is not None:
+            # the content is not available yet; see write_deferred()
+            self.deferred[operation['src']] = operation
+        else:
+            self._write_file(operation, self.source_for(operation['src']))
+
+    def _execute_batch(self, operations):
+        # a failed write does not hold up the rest of its batch; each
+        # failure is reported under its own path
+        errors = []
+        for operation in operations:
             try:
-                stat = os.lstat(dest_path)
-            except EnvironmentError, e:
-                if e.errno == 2:
-                    stat = None
-                else:
-                    raise
-            if 'precreated' in entry.meta.expects:
-                if stat is None:
-                    raise MuppetPrerequisiteError("%s must have been created" % dest_path)
-                if isinstance(entry, Directory):
-                    logging.info("Verifying %s is a directory" % dest_path)
-                    if stat.st_mode & S_IFDIR != S_IFDIR:
-                        raise MuppetPrerequisiteError("%s must be a directory" % dest_path)
-                    self._copy(dest_path, src_path, entry)
-                    self.check_unmanaged(dest_path, entry.entries)
-                elif isinstance(entry, Symlink):
-                    logging.info("Verifying %s is a symbolic link" % dest_path)
-                    if stat.st_mode & S_IFLNK != S_IFLNK:
-                        raise MuppetPrerequisiteError("%s must be a symbolic link" % dest_path)
-                elif isinstance(entry, File):
-                    logging.info("Verifying %s is a regular file" % dest_path)
-                    if stat.st_mode & S_IFREG != S_IFREG:
-                        raise MuppetPrerequisiteError("%s must be a regular file" % dest_path)
+                self._execute_write(operation)
+            except Exception, e:
+                errors.append((operation['path'], e))
+        if errors:
+            raise CollectedErrors(errors)
+
+    def _execute_metadata(self, operation):
+        if operation['op'] == 'chmod':
+            set_mode_and_owner(operation['path'], operation['mode'], None, None, self.resolver)
+        else:
+            set_mode_and_owner(
+                operation['path'], None,
+                operation.get('owner'), operation.get('group'), self.resolver)
+
+    def _batches(self, operations):
+        # writes are grouped by directory, so that each batch works on one
+        # directory at a time rather than following the order of the walk
+        batch = []
+        for operation in operations:
+            if batch and (
+                    os.path.dirname(batch[0]['path']) != os.path.dirname(operation['path']) or
+                    (self.batch_size and len(batch) >= self.batch_size)):
+                yield batch
+                batch = []
+            batch.append(operation)
+        if batch:
+            yield batch
+
+    def _execute_writes(self, operations):
+        for batch in self._batches(operations):
+            if self.pool is not None:
+                self.pool.submit(batch[0]['path'], self._execute_batch, batch)
             else:
-                if isinstance(entry, Directory):
-                    if stat and stat.st_mode & S_IFDIR != S_IFDIR:
-                        logging.info("%s is not a directory; removing it" % dest_path)
-                        if not self.dry_run:
-                            os.unlink(dest_path)
-                    logging.info("Creating %s" % dest_path)
-                    if not self.dry_run:
-                        if stat is None:
-                            os.mkdir(dest_path)
-                        set_mode_and_owner(dest_path, stat, dir)
-                    self._copy(dest_path, src_path, entry)
-                    self.check_unmanaged(dest_path, entry.entries)
-                elif isinstance(entry, Symlink):
-                    if stat:
-                        logging.info("%s already exists; removing it" % dest_path)
-                        if not self.dry_run:
-                            if stat.st_mode & S_IFDIR == S_IFDIR:
-                                shutil.rmtree(dest_path)
-                            else:
-                                os.unlink(dest_path)
-                    logging.info("Creating %s" % dest_path)
-                    if not self.dry_run:
-                        os.symlink(entry.to, dest_path)
-                        set_mode_and_owner(dest_path, stat, entry) 
-                elif isinstance(entry, File):
-                    if stat:
-                        logging.info("%s already exists; removing it" % dest_path)
-                        if not self.dry_run:
-                            if stat.st_mode & S_IFDIR == S_IFDIR:
-                                shutil.rmtree(dest_path)
-                            else:
-                                os.unlink(dest_path)
-                    logging.info("Copying %s to %s" % (src_path, dest_path))
-                    if not self.dry_run:
-                        shutil.copyfile(src_path, dest_path)
-                        set_mode_and_owner(dest_path, stat, entry) 
+                self._execute_batch(batch)
+
+    def execute(self, plan):
+        with stats.timer('phase.execute'):
+            self._execute(plan)
+
+    def _execute(self, plan):
+        if stats.enabled:
+            for operation in plan.operations:
+                stats.count('op.%s' % operation['op'])
+        self.resolver.preload(*plan.owners_and_groups())
+        self._load_manifests(plan.dest)
+        # prerequisites are checked before anything is touched; then stale
+        # entries are removed, directories created, contents written and
+        # the mode and owner of existing entries fixed, each in one sweep
+        for operation in plan.select('verify'):
+            self._execute_verify(operation)
+        for operation in plan.select('remove'):
+            self._execute_remove(operation)
+        writes = []
+        for operation in plan.select('create', 'replace'):
+            if operation['type'] == 'directory':
+                self._execute_mkdir(operation)
+            else:
+                writes.append(operation)
+        self._run_pool(self._execute_writes, writes)
+        for operation in plan.select('chmod', 'chown'):
+            self._execute_metadata(operation)
+        if self.manifest is not None:
+            recorded = set()
+            for operation in plan.select('create', 'replace', 'chmod', 'chown', 'keep'):
+                path = operation['path']
+                # files that are written are recorded by _write_file()
+                if path in recorded or operation.get('type') == 'file':
+                    continue
+                recorded.add(path)
+                src = operation.get('src')
+                self._record(path, src is not None and self.source_for(src) or None)
 
     def __call__(self, dest, src, tree):
-        self._copy(dest, src, tree.root)
+        plan = self.plan(dest, src, tree)
+        if not self.dry_run:
+            self.execute(plan)
+        return plan
 
-def copy(dest, src, tree, dry_run=False):
-    copier = TreeCopier(dry_run)
-    copier(dest, src, tree)
-    if copier.unmanaged_files:
-        logging.warning("The following files are unmanaged:")
-        for file in copier.unmanaged_files:
-            logging.warning("  %s" % file)
+    def stream(self, dest, src, directories):
+        # plans and carries out each directory as soon as the loader yields
+        # it (see Directory.walk_annotated_fs), so that neither the tree nor
+        # the plan is ever held as a whole.  Unlike __call__(), an unknown
+        # owner or a missing prerequisite is only found once it is reached
+        self._load_manifests(dest)
+        if self.jobs > 1 and not self.dry_run:
+            self.pool = WorkerPool(self.jobs)
+        errors = []
+        try:
+            for parent, rel_path, dir, subdir_names in directories:
+                dest_dir = os.path.join(dest, rel_path)
+                src_dir = os.path.join(src, rel_path)
+                plan = Plan(dest, src, self.incremental)
+                with stats.timer('phase.plan'):
+                    exists = True
+                    if parent is not None:
+                        exists = self._plan_entry(
+                            plan, dest_dir, src_dir, lstat_path(dest_dir), dir)
+                    self._plan_entries(
+                        plan, dest_dir, src_dir, dir, exists, parent is not None,
+                        set(dir.entries).union(subdir_names))
+                    plan.sort()
+                if not self.dry_run:
+                    self.execute(plan)
+        finally:
+            if self.pool is not None:
+                errors = self.pool.join()
+                self.pool = None
+        if errors:
+            raise_collected_errors(errors)
+
+    def finish(self):
+        logging.warning("%s" % self.stats)
+        if self.manifest is not None and self.cache_dir is not None and not self.dry_run:
+            try:
+                with stats.timer('phase.save-manifest'):
+                    self.manifest.save(self.cache_dir)
+            except EnvironmentError, e:
+                logging.warning("Failed to save the manifest: %s" % e)
+        if self.unmanaged_files:
+            logging.warning("The following files are unmanaged:")
+            for file in self.unmanaged_files:
+                logging.warning("  %s" % file)
 
+def lstat_path(path):
+    try:
+        return os.lstat(path)
+    except EnvironmentError, e:
+        if e.errno in (errno.ENOENT, errno.ENOTDIR):
+            return None
+        raise
+
+def raise_collected_errors(errors):
+    if len(errors) == 1:
+        raise errors[0][1]
+    message = '\n'.join("%s: %s" % (path, e) for path, e in errors)
+    if all(isinstance(e, MuppetPrerequisiteError) for path, e in errors):
+        raise MuppetPrerequisiteError(message)
+    raise MuppetException(message)
+
+def copy(dest, src, tree, dry_run=False, incremental=False, cache_dir=None, jobs=1, partial=False):
+    copier = TreeCopier(dry_run, incremental, cache_dir, jobs, partial)
+    copier(dest, src, tree)
+    copier.finish()
@@ -1,11 +1,97 @@
 from subprocess import Popen, PIPE
-from muppet.exceptions import MuppetExternalCommandError
+from muppet.exceptions import MuppetExternalCommandError, MuppetPrerequisiteError
+from muppet.stats import stats
 from distutils.spawn import find_executable as _find_executable
+from stat import S_ISDIR, S_ISREG, S_ISLNK
 import re
+import os
+import errno
+import hashlib
+import threading
+import fcntl
+import mmap
+import shutil
+import tempfile
+from Queue import Queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+if scandir is None:
+    class DirEntry(object):
+        def __init__(self, dir, name):
+            self.name = name
+            self.path = os.path.join(dir, name)
+            self._lstat = None
+
+        def stat(self, follow_symlinks=True):
+            if follow_symlinks:
+                return os.stat(self.path)
+            if self._lstat is None:
+                self._lstat = os.lstat(self.path)
+            return self._lstat
+
+        def _is(self, check, follow_symlinks):
+            # false for a dangling link, as with os.scandir()
+            try:
+                return check(self.stat(follow_symlinks).st_mode)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return False
+
+        def is_dir(self, follow_symlinks=True):
+            return self._is(S_ISDIR, follow_symlinks)
+
+        def is_file(self, follow_symlinks=True):
+            return self._is(S_ISREG, follow_symlinks)
+
+        def is_symlink(self):
+            return S_ISLNK(self.stat(False).st_mode)
+
+    def scandir(path):
+        for name in os.listdir(path):
+            yield DirEntry(path, name)
+
+def scan_dir(path):
+    try:
+        return dict((dirent.name, dirent) for dirent in scandir(path))
+    except EnvironmentError, e:
+        if e.errno == errno.ENOENT:
+            return {}
+        raise
+
+def lstat_dirent(dirent):
+    if dirent is None:
+        return None
+    try:
+        return dirent.stat(follow_symlinks=False)
+    except EnvironmentError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+def iter_files(root, subdir=''):
+    stack = [subdir]
+    while stack:
+        dir = stack.pop()
+        for dirent in scandir(os.path.join(root, dir)):
+            path = os.path.join(dir, dirent.name)
+            if dirent.is_dir():
+                stack.append(path)
+            else:
+                yield path
 
 def do_cmd(*args, **kwargs):
-    p = Popen(args, stdin=None, stdout=PIPE, stderr=PIPE, **kwargs)
-    stdout, stderr = p.communicate()
+    stats.count('subprocess.spawned')
+    with stats.timer('subprocess.%s' % os.path.basename(args[0])):
+        p = Popen(args, stdin=None, stdout=PIPE, stderr=PIPE, **kwargs)
+        stdout, stderr = p.communicate()
     if p.returncode != 0:
         raise MuppetExternalCommandError(stderr, p.returncode)
     return stdout
@@ -35,3 +121,240 @@ def getgidfor(name):
     from grp import getgrnam
     grent = getgrnam(name)
     return grent.gr_gid
+
+class IdResolver(object):
+    def __init__(self):
+        self.uids = {}
+        self.gids = {}
+
+    def uid_for(self, name):
+        uid = self.uids.get(name)
+        if uid is None:
+            try:
+                uid = self.uids[name] = getuidfor(name)
+            except KeyError:
+                raise MuppetPrerequisiteError("No such user: %s" % name)
+        return uid
+
+    def gid_for(self, name):
+        gid = self.gids.get(name)
+        if gid is None:
+            try:
+                gid = self.gids[name] = getgidfor(name)
+            except KeyError:
+                raise MuppetPrerequisiteError("No such group: %s" % name)
+        return gid
+
+    def ids_for(self, owner, group):
+        uid = -1
+        if owner is not None:
+            uid = self.uid_for(owner)
+        gid = -1
+        if group is not None:
+            gid = self.gid_for(group)
+        return uid, gid
+
+    def preload(self, owners, groups):
+        errors = []
+        for owner in sorted(set(owners)):
+            try:
+                self.uid_for(owner)
+            except MuppetPrerequisiteError, e:
+                errors.append(str(e))
+        for group in sorted(set(groups)):
+            try:
+                self.gid_for(group)
+            except MuppetPrerequisiteError, e:
+                errors.append(str(e))
+        if errors:
+            raise MuppetPrerequisiteError('\n'.join(errors))
+
+def file_digest(path, algorithm='sha1', bufsize=65536):
+    h = hashlib.new(algorithm)
+    size = 0
+    f = open(path, 'rb')
+    try:
+        while True:
+            buf = f.read(bufsize)
+            if not buf:
+                break
+            size += len(buf)
+            h.update(buf)
+    finally:
+        f.close()
+    stats.count('files.hashed')
+    stats.count('bytes.hashed', size)
+    return h.hexdigest()
+
+def mmap_digest(path, algorithm='sha1'):
+    # hashes the file straight from the page cache; hashlib releases the
+    # GIL while it works through the mapping, so several threads hash at
+    # once
+    h = hashlib.new(algorithm)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if size > 0:
+            m = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+            try:
+                h.update(m)
+            finally:
+                m.close()
+    finally:
+        os.close(fd)
+    stats.count('files.hashed')
+    stats.count('bytes.hashed', size)
+    return h.hexdigest()
+
+class CollectedErrors(Exception):
+    # raised by work that went on past its own failures; errors is a list
+    # of (key, exception)
+    def __init__(self, errors):
+        Exception.__init__(self, errors)
+        self.errors = errors
+
+class WorkerPool(object):
+    # with a single job, work is done in the calling thread as it is
+    # submitted, and its errors collected just the same, so that -j 1 and
+    # -j N fail alike
+    def __init__(self, jobs):
+        self.queue = Queue(jobs * 4)
+        self.errors = []
+        self.lock = threading.Lock()
+        self.threads = []
+        if jobs > 1:
+            for i in range(jobs):
+                thread = threading.Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def _call(self, key, func, args):
+        try:
+            func(*args)
+        except CollectedErrors, e:
+            with self.lock:
+                self.errors.extend(e.errors)
+        except Exception, e:
+            with self.lock:
+                self.errors.append((key, e))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self._call(*item)
+
+    def submit(self, key, func, *args):
+        if self.threads:
+            self.queue.put((key, func, args))
+        else:
+            self._call(key, func, args)
+
+    def join(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        return sorted(self.errors, key=lambda error: error[0])
+
+FICLONE = 0x40049409
+
+def _reflink(src_fd, dest_fd):
+    fcntl.ioctl(dest_fd, FICLONE, src_fd)
+
+def _load_libc_sendfile():
+    # looked up in the symbols already loaded into the process, since
+    # ctypes.util.find_library() runs ldconfig; and only on the first copy,
+    # so that runs with nothing to copy never load ctypes
+    import ctypes
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None
+    sendfile = getattr(libc, 'sendfile', None)
+    if sendfile is None:
+        return None
+    sendfile.restype = ctypes.c_ssize_t
+    sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+    def _sendfile(out_fd, in_fd, offset, count):
+        n = sendfile(out_fd, in_fd, None, count)
+        if n < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return n
+    return _sendfile
+
+_sendfile = getattr(os, 'sendfile', None)
+_sendfile_loaded = _sendfile is not None
+
+def _get_sendfile():
+    global _sendfile, _sendfile_loaded
+    if not _sendfile_loaded:
+        _sendfile = _load_libc_sendfile()
+        _sendfile_loaded = True
+    return _sendfile
+
+def _copy_with_sendfile(src_fd, dest_fd, chunk=1 << 30):
+    while _sendfile(dest_fd, src_fd, None, chunk) > 0:
+        pass
+
+def _copy_with_read_write(src_fd, dest_fd, bufsize=1 << 20):
+    while True:
+        buf = os.read(src_fd, bufsize)
+        if not buf:
+            break
+        while buf:
+            buf = buf[os.write(dest_fd, buf):]
+
+_fallback_errnos = frozenset([
+    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+    errno.ENOTTY, errno.EBADF,
+    ])
+
+def copy_fd(src_fd, dest_fd):
+    copiers = [_reflink]
+    if _get_sendfile() is not None:
+        copiers.append(_copy_with_sendfile)
+    for copier in copiers:
+        try:
+            copier(src_fd, dest_fd)
+            return
+        except EnvironmentError, e:
+            if e.errno not in _fallback_errnos:
+                raise
+        # start over from scratch with the next method
+        os.lseek(src_fd, 0, os.SEEK_SET)
+        os.lseek(dest_fd, 0, os.SEEK_SET)
+        os.ftruncate(dest_fd, 0)
+    _copy_with_read_write(src_fd, dest_fd)
+
+def current_umask():
+    # the umask can only be read by setting it, so this must not run while
+    # other threads may be creating files
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+_symlink_modes = None
+
+def symlink_modes_supported():
+    # whether a symbolic link has a mode of its own; on Linux it has not,
+    # and lchmod(), where it exists, fails for links
+    global _symlink_modes
+    if _symlink_modes is None:
+        _symlink_modes = False
+        if hasattr(os, 'lchmod'):
+            dir = tempfile.mkdtemp(prefix='muppet-')
+            try:
+                path = os.path.join(dir, 'link')
+                os.symlink('target', path)
+                try:
+                    os.lchmod(path, 0700)
+                    _symlink_modes = True
+                except OSError:
+                    pass
+            finally:
+                shutil.rmtree(dir, ignore_errors=True)
+    return _symlink_modes
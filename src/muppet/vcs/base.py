@@ -21,6 +21,12 @@ class VCSBase(object):
     def diff(self, rev1, rev2):
         pass
 
+    def changed_paths(self, rev1, rev2, path):
+        pass
+
+    def close(self):
+        pass
+
 class NoSuchReference(MuppetException):
     pass
 
@@ -1,6 +1,9 @@
 from muppet.vcs.base import Reference, Branch, Revision, VCSBase, NoSuchRevision, NoSuchReference
 from muppet.utils import do_cmd, line_by_line, traverse_dict
 from muppet.exceptions import MuppetException, MuppetExternalCommandError, MuppetConfigurationError
+from muppet.stats import stats
+from subprocess import Popen, PIPE
+import threading
 import os
 
 class GitReference(Reference):
@@ -31,7 +34,7 @@ class GitRevision(Revision):
         return self._sha1 == that._sha1
 
     def populate_with_raw(self, props, message):
-        self._parents = [self.git.get_rev(parent_rev) for parent_rev in props.get('parent', [])]
+        self._parents = [self.git._get_rev(parent_rev) for parent_rev in props.get('parent', [])]
         self._message = message
 
     def populate(self):
@@ -53,28 +56,92 @@ class GitRevision(Revision):
         return self._message
 
 class GitBranch(GitReference):
-    pass
+    @property
+    def referenced(self):
+        # not a tag of the same name
+        return self.git['refs/heads/%s' % self._ref]
+
+class GitObjectReader(object):
+    def __init__(self, command, cwd, mode):
+        self.command = command
+        self.cwd = cwd
+        self.mode = mode
+        self.process = None
+        self.devnull = None
+        self.lock = threading.Lock()
+
+    def _ensure_process(self):
+        if self.process is None or self.process.poll() is not None:
+            stats.count('subprocess.spawned')
+            if self.devnull is None:
+                self.devnull = open(os.devnull, 'w')
+            self.process = Popen(
+                [self.command, 'cat-file', self.mode],
+                cwd=self.cwd, stdin=PIPE, stdout=PIPE,
+                stderr=self.devnull)
+        return self.process
+
+    def query(self, name):
+        with self.lock, stats.timer('subprocess.git-cat-file'):
+            process = self._ensure_process()
+            process.stdin.write(name + '\n')
+            process.stdin.flush()
+            header = process.stdout.readline()
+            if not header:
+                self.close()
+                raise MuppetExternalCommandError("git cat-file %s exited unexpectedly" % self.mode)
+            fields = header.split()
+            if len(fields) != 3:
+                # "<name> missing" or "<name> ambiguous"
+                return None
+            sha1, type, size = fields
+            data = None
+            if self.mode == '--batch':
+                data = process.stdout.read(int(size))
+                process.stdout.read(1)
+            return sha1, type, data
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+        if self.devnull is not None:
+            self.devnull.close()
+            self.devnull = None
 
 class GitLowLevelWrapper(object):
     def __init__(self, command, cwd):
         self.command = command
         self.cwd = cwd
+        self.objects = GitObjectReader(command, cwd, '--batch')
+        self.object_ids = GitObjectReader(command, cwd, '--batch-check')
 
     def do_cmd(self, *args):
        return do_cmd(self.command, cwd=self.cwd, *args)
 
+    def close(self):
+        self.objects.close()
+        self.object_ids.close()
+
     def do_log_1(self, commit):
-        i = line_by_line(sef.do_cmd('log', '-1', '--format=raw', commit))
-        props = {}
-        for line in i:
-            line = line.strip()
-            if line == '':
-                break
+        result = self.objects.query(commit + '^{commit}')
+        if result is None:
+            raise MuppetExternalCommandError("%s is not a commit" % commit, 128)
+        sha1, type, data = result
+        header, _, body = data.partition('\n\n')
+        props = {'commit': [sha1]}
+        key = None
+        for line in header.split('\n'):
+            if line.startswith(' ') and key is not None:
+                # continuation of a multi-line header such as gpgsig
+                props[key][-1] += '\n' + line[1:]
+                continue
             key, value = line.split(' ', 1)
             props.setdefault(key, []).append(value)
         message = unicode(
-            ''.join([line[4:].strip() for line in i]),
-            self.do_config('i18n.logOutputEncoding', 'utf-8')
+            ''.join([line.strip() for line in line_by_line(body)]),
+            props.get('encoding', ['utf-8'])[0]
             )
         return props, message
 
@@ -90,18 +157,46 @@ class GitLowLevelWrapper(object):
             branches.append(branch)
         return branches, current
 
+    def do_refs(self):
+        i = line_by_line(self.do_cmd(
+            'for-each-ref',
+            '--format=%(HEAD) %(objectname) %(*objectname) %(refname)',
+            'refs/heads', 'refs/tags'))
+        tags = []
+        branches = []
+        current = None
+        for line in i:
+            fields = line.rstrip('\r\n').split(' ')
+            head = fields[0] == '*'
+            fields = [field for field in fields[1:] if field]
+            # %(*objectname) is only filled in for annotated tags
+            sha1, refname = fields[-2], fields[-1]
+            if refname.startswith('refs/tags/'):
+                tags.append((refname[10:], sha1))
+            elif refname.startswith('refs/heads/'):
+                branches.append((refname[11:], sha1))
+                if head:
+                    current = refname[11:]
+        return tags, branches, current
+
     def do_tag(self, name, commit):
         return self.do_cmd('tag', '-f', name, commit)
 
     def do_revparse(self, name):
-        try:
-            return self.do_cmd('rev-parse', name)
-        except MuppetExternalCommandError:
+        result = self.object_ids.query(name)
+        if result is None:
             return None
+        return result[0]
 
     def do_diff(self, rev1, rev2, path):
         return self.do_cmd('diff', rev1, rev2, '--', path)
 
+    def do_diff_name_status(self, rev1, rev2, path):
+        fields = self.do_cmd(
+            'diff', '--name-status', '--no-renames', '-z',
+            rev1, rev2, '--', path).split('\0')
+        return [(fields[i], fields[i + 1]) for i in range(0, len(fields) - 1, 2)]
+
     def do_get_gitdir(self):
         return os.path.normpath(os.path.join(self.cwd, self.do_cmd('rev-parse', '--git-dir')))
 
@@ -129,37 +224,66 @@ class Git(VCSBase):
         self.config = GitConfig(self)
         self._branch = None
         self._branches = None
+        self._ref_ids = None
         self._refs = {}
+        self._branch_refs = {}
         self._revs = {}
 
     @classmethod
     def from_settings_and_variables(self, settings, variables):
         return self(settings['git.command'], variables['cwd'])
 
+    def close(self):
+        self.wrapper.close()
+
     @property
     def repo_root(self):
         return os.path.dirname(self.wrapper.do_get_gitdir())
 
     def diff(self, rev1, rev2, path):
-        self.wrapper.do_diff(rev1.id, rev2.id, path)
+        return self.wrapper.do_diff(rev1.id, rev2.id, path)
+
+    def changed_paths(self, rev1, rev2, path):
+        repo_root = self.repo_root
+        return [
+            (status, os.path.join(repo_root, changed_path))
+            for status, changed_path in \
+                self.wrapper.do_diff_name_status(rev1.id, rev2.id, path)
+            ]
 
     def __getitem__(self, commit):
+        if self._ref_ids is not None:
+            sha1 = self._ref_ids.get(commit)
+            if sha1 is not None:
+                rev_obj = self._revs.get(sha1)
+                if rev_obj is not None and rev_obj._parents is not None:
+                    return rev_obj
+                commit = sha1
         props, message = self.wrapper.do_log_1(commit)
         rev_obj = self._get_rev(props['commit'][0])
         rev_obj.populate_with_raw(props, message)
         return rev_obj
 
     def get_tag(self, name):
-        rev = self.wrapper.do_revparse(name)
+        self._populate_refs()
+        rev = self._ref_ids.get(name)
         if rev is None:
-            raise NoSuchReference(name)
+            rev = self.wrapper.do_revparse(name)
+            if rev is None:
+                raise NoSuchReference(name)
         self._get_rev(rev)
         return self._get_ref(name)
 
-    def put_tag(self, name):
+    def put_tag(self, name, ref='HEAD'):
         self.wrapper.do_tag(name, ref)
+        self.invalidate_refs()
         return self._get_ref(name)
 
+    def invalidate_refs(self):
+        self._ref_ids = None
+        self._branch = None
+        self._branches = None
+
     def _get_ref(self, ref):
         ref_obj = self._refs.get(ref)
         if ref_obj is not None:
@@ -170,12 +294,9 @@ class Git(VCSBase):
         return ref_obj
 
     def _get_branch(self, ref):
-        ref_obj = self._refs.get(ref)
-        if ref_obj is not None:
-            if ref_obj.__class__ != GitBranch:
-                raise MuppetException("%s was not a branch" % ref)
-        else:
-            ref_obj = self._refs[ref] = GitBranch(self, ref)
+        ref_obj = self._branch_refs.get(ref)
+        if ref_obj is None:
+            ref_obj = self._branch_refs[ref] = GitBranch(self, ref)
         return ref_obj
 
     def _get_rev(self, rev):
@@ -184,19 +305,30 @@ class Git(VCSBase):
             rev_obj = self._revs[rev] = GitRevision(self, rev)
         return rev_obj
 
-    def _populate_branches(self):
-        if self._branches is None:
-            branch_refs, current_branch_ref = self.wrapper.do_branches()
-            self._branches = [self._get_branch(ref) for ref in branch_refs]
-            self._branch = self._get_branch(current_branch_ref)
+    def _populate_refs(self):
+        if self._ref_ids is None:
+            # one for-each-ref snapshots every tag and branch, so that
+            # looking them up afterwards is a dictionary hit
+            tags, branches, current_branch_ref = self.wrapper.do_refs()
+            ref_ids = {}
+            for ref, sha1 in branches:
+                ref_ids['refs/heads/%s' % ref] = ref_ids[ref] = sha1
+                self._get_rev(sha1)
+            # a tag wins over a branch of the same name, as with rev-parse
+            for ref, sha1 in tags:
+                ref_ids['refs/tags/%s' % ref] = ref_ids[ref] = sha1
+                self._get_rev(sha1)
+            self._branches = [self._get_branch(ref) for ref, sha1 in branches]
+            self._branch = current_branch_ref and self._get_branch(current_branch_ref)
+            self._ref_ids = ref_ids
 
     @property
     def branches(self):
-        self._populate_branches()
+        self._populate_refs()
         return self._branches
 
     @property
     def branch(self):
-        self._populate_branches()
+        self._populate_refs()
         return self._branch
 
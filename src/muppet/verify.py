@@ -0,0 +1,165 @@
+import simplejson as json
+import os
+import pwd
+import grp
+import threading
+from stat import S_IMODE
+from muppet.manifest import Manifest, entry_type
+from muppet.stats import stats
+from muppet.tree import Directory, Symlink, File, entry_type_name, mode_drifted, raise_collected_errors
+from muppet.utils import IdResolver, WorkerPool, scan_dir, lstat_dirent, mmap_digest
+
+REPORT_VERSION = 1
+
+def user_name(uid):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return uid
+
+def group_name(gid):
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return gid
+
+class DriftReport(object):
+    def __init__(self, dest, src=None):
+        self.dest = dest
+        self.src = src
+        self.checked = 0
+        self.drift = []
+        self.unmanaged = []
+        self.lock = threading.Lock()
+
+    def add(self, path, kind, expected, actual):
+        with self.lock:
+            self.drift.append({
+                'path': path,
+                'drift': kind,
+                'expected': expected,
+                'actual': actual,
+                })
+
+    def sort(self):
+        self.drift.sort(key=lambda drift: (drift['path'].split(os.path.sep), drift['drift']))
+
+    def drifted_paths(self):
+        return set(drift['path'] for drift in self.drift)
+
+    def to_json_dict(self):
+        return {
+            'version': REPORT_VERSION,
+            'dest': self.dest,
+            'src': self.src,
+            'checked': self.checked,
+            'drifted': len(self.drifted_paths()),
+            'drift': self.drift,
+            'unmanaged': self.unmanaged,
+            }
+
+    def dump(self, f):
+        json.dump(self.to_json_dict(), f, indent=2, sort_keys=True)
+        f.write('\n')
+
+class TreeVerifier(object):
+    # compares a tree with the destination without touching either.
+    # Content is compared only for files of the right size, and not at all
+    # for files the manifest of the last incremental put shows untouched
+    # since they were written; the rest are hashed on the pool
+    def __init__(self, jobs=1, cache_dir=None, partial=False):
+        self.jobs = jobs
+        self.cache_dir = cache_dir
+        self.partial = partial
+        self.resolver = IdResolver()
+        self.manifest = None
+        self.pool = None
+
+    def _check_metadata(self, report, dest_path, stat, entry):
+        if mode_drifted(stat, entry):
+            report.add(dest_path, 'mode', '%04o' % entry.mode, '%04o' % S_IMODE(stat.st_mode))
+        if entry.owner is not None and stat.st_uid != self.resolver.uid_for(entry.owner):
+            report.add(dest_path, 'owner', entry.owner, user_name(stat.st_uid))
+        if entry.group is not None and stat.st_gid != self.resolver.gid_for(entry.group):
+            report.add(dest_path, 'group', entry.group, group_name(stat.st_gid))
+
+    def _check_content(self, report, dest_path, src_path, stat):
+        src_stat = os.stat(src_path)
+        if src_stat.st_size != stat.st_size:
+            report.add(dest_path, 'content', '%d bytes' % src_stat.st_size, '%d bytes' % stat.st_size)
+            return
+        record = self.manifest and self.manifest.lookup(dest_path)
+        if record is not None and record.get('hash'):
+            if self.manifest.unchanged(dest_path, stat, src_stat):
+                return
+            if record.get('src_size') != src_stat.st_size or \
+                    record.get('src_mtime') != int(src_stat.st_mtime):
+                record = None
+        src_digest = record is not None and record['hash'] or mmap_digest(src_path)
+        dest_digest = mmap_digest(dest_path)
+        if src_digest != dest_digest:
+            report.add(dest_path, 'content', src_digest, dest_digest)
+
+    def _check_entry(self, report, dest_path, src_path, stat, entry):
+        # returns whether the entries below dest_path are to be checked
+        report.checked += 1
+        type = entry_type_name(entry)
+        if stat is None:
+            report.add(dest_path, 'missing', type, None)
+            return False
+        actual_type = entry_type(stat)
+        if actual_type != type:
+            report.add(dest_path, 'type', type, actual_type)
+            return False
+        if 'precreated' in entry.meta.expects:
+            return True
+        self._check_metadata(report, dest_path, stat, entry)
+        if isinstance(entry, Symlink):
+            to = os.readlink(dest_path)
+            if to != entry.to:
+                report.add(dest_path, 'target', entry.to, to)
+        elif isinstance(entry, File):
+            if self.pool is not None:
+                self.pool.submit(dest_path, self._check_content, report, dest_path, src_path, stat)
+            else:
+                self._check_content(report, dest_path, src_path, stat)
+        return True
+
+    def _verify(self, report, dest, src, dir):
+        stack = [(dest, src, dir, False)]
+        while stack:
+            dest_dir, src_dir, dir, report_unmanaged = stack.pop()
+            dirents = scan_dir(dest_dir)
+            if report_unmanaged and not self.partial:
+                report.unmanaged.extend(
+                    os.path.join(dest_dir, name)
+                    for name in sorted(set(dirents).difference(dir.entries)))
+            subdirs = []
+            for entry in dir.children():
+                dest_path = os.path.join(dest_dir, entry.name)
+                src_path = os.path.join(src_dir, entry.name)
+                if self._check_entry(report, dest_path, src_path,
+                                     lstat_dirent(dirents.get(entry.name)), entry) and \
+                        isinstance(entry, Directory):
+                    subdirs.append((dest_path, src_path, entry, True))
+            stack.extend(reversed(subdirs))
+
+    def verify(self, dest, src, tree):
+        self.resolver.preload(*tree.owners_and_groups())
+        if self.cache_dir is not None:
+            self.manifest = Manifest.load(self.cache_dir, dest)
+        report = DriftReport(dest, src)
+        with stats.timer('phase.verify'):
+            if self.jobs > 1:
+                self.pool = WorkerPool(self.jobs)
+            errors = []
+            try:
+                self._verify(report, dest, src, tree.root)
+            finally:
+                if self.pool is not None:
+                    errors = self.pool.join()
+                    self.pool = None
+            if errors:
+                raise_collected_errors(errors)
+            report.sort()
+        return report
@@ -0,0 +1,31 @@
+import os
+import sys
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+src = os.path.join(os.path.dirname(here), 'src')
+sys.path.insert(0, src)
+
+def write_script(path, content):
+    f = open(path, 'w')
+    f.write(content)
+    f.close()
+    os.chmod(path, 0755)
+
+@pytest.fixture
+def ssh_standin(tmpdir, monkeypatch):
+    # the ssh.command that logs in to a host whose muppet puts to the
+    # returned directory; see ssh_standin.py
+    standin = os.path.join(here, 'ssh_standin.py')
+    bin_dir = str(tmpdir.mkdir('standin-bin'))
+    dest = str(tmpdir.mkdir('remote'))
+    write_script(os.path.join(bin_dir, 'sudo'), '#!/bin/sh\nexec %s %s sudo "$@"\n' % (
+        sys.executable, standin))
+    write_script(os.path.join(bin_dir, 'muppet'), (
+        '#!/bin/sh\n'
+        'PYTHONPATH=%s exec %s -c "from muppet.scripts.muppet_ import main; main()" "$@" "$STANDIN_DEST"\n') % (
+        src, sys.executable))
+    monkeypatch.setenv('STANDIN_BIN', bin_dir)
+    monkeypatch.setenv('STANDIN_DEST', dest)
+    monkeypatch.setenv('STANDIN_LOG', str(tmpdir.join('standin.log')))
+    return '%s %s ssh' % (sys.executable, standin), dest
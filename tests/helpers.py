@@ -0,0 +1,32 @@
+import simplejson as json
+import os
+from muppet.settings import Settings
+from muppet.scripts.muppet_ import dynamic_defaults
+
+def write_tree(root, files):
+    # files maps paths under root to their contents; a dict is written as
+    # JSON, as for a .muppetmeta
+    for path, content in files.items():
+        path = os.path.join(root, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, 'w')
+        if isinstance(content, dict):
+            json.dump(content, f)
+        else:
+            f.write(content)
+        f.close()
+
+def read(path):
+    f = open(path)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def make_settings(*dicts):
+    settings = Settings()
+    settings.add(dynamic_defaults())
+    for dict_ in dicts:
+        settings.add(dict_)
+    return settings
@@ -0,0 +1,55 @@
+# Stands in for ssh, and for sudo on the far side, so that put can be
+# tested without an sshd.  As ssh, it runs the remote command locally with
+# the scripts in $STANDIN_BIN (sudo, muppet) first on the PATH, and logs
+# each login to $STANDIN_LOG.  As sudo, it wants $STANDIN_SUDO_PASSWORD if
+# that is set.  Pointing ssh.command at a real ssh with the options for a
+# local sshd tests the same way.
+import os
+import sys
+import getopt
+
+def ssh(args):
+    opts, args = getopt.getopt(args, '1246AaCfGgKkMNnqsTtVvXxYyb:c:D:E:e:F:I:i:J:L:l:m:O:o:p:Q:R:S:W:w:')
+    log = os.environ.get('STANDIN_LOG')
+    if log:
+        f = open(log, 'a')
+        f.write('%s %s\n' % (
+            ' '.join(value for opt, value in opts if opt == '-O') or 'login',
+            ' '.join(value for opt, value in opts if opt == '-o' and value.startswith('ControlPath='))))
+        f.close()
+    if any(opt == '-O' for opt, value in opts):
+        return 0
+    for opt, value in opts:
+        # the first login opens the master, whose socket is left behind
+        if opt == '-o' and value.startswith('ControlPath=') and \
+                not os.path.exists(value[len('ControlPath='):]):
+            open(value[len('ControlPath='):], 'w').close()
+    env = dict(os.environ)
+    env['PATH'] = os.environ['STANDIN_BIN'] + os.pathsep + os.environ.get('PATH', '')
+    os.execve('/bin/sh', ['/bin/sh', '-c', ' '.join(args[1:])], env)
+
+def sudo(args):
+    opts, args = getopt.getopt(args, 'nSp:')
+    opts = dict(opts)
+    password = os.environ.get('STANDIN_SUDO_PASSWORD')
+    if password is not None:
+        if '-n' in opts:
+            sys.stderr.write('sudo: a password is required\n')
+            return 1
+        if '-S' not in opts:
+            sys.stderr.write('sudo: no tty present and no askpass program specified\n')
+            return 1
+        # one byte at a time, as sudo does, leaving the rest to the command
+        line = ''
+        while not line.endswith('\n'):
+            c = os.read(0, 1)
+            if not c:
+                break
+            line += c
+        if line.rstrip('\n') != password:
+            sys.stderr.write('sudo: incorrect password\n')
+            return 1
+    os.execvp(args[0], args)
+
+if __name__ == '__main__':
+    sys.exit({'ssh': ssh, 'sudo': sudo}[sys.argv[1]](sys.argv[2:]))
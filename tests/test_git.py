@@ -0,0 +1,98 @@
+import os
+import pytest
+from muppet.utils import do_cmd, find_executable
+from muppet.vcs.base import NoSuchReference
+from muppet.vcs.git import Git
+from muppet.scripts.commands import put
+from helpers import write_tree, read, make_settings
+
+git = find_executable('git')
+
+pytestmark = pytest.mark.skipif(git is None, reason='git is not available')
+
+def commit(repo, message):
+    do_cmd(git, 'add', '-A', cwd=repo)
+    do_cmd(git, '-c', 'user.name=test', '-c', 'user.email=test@example.com',
+           'commit', '-q', '-m', message, cwd=repo)
+    return do_cmd(git, 'rev-parse', 'HEAD', cwd=repo).strip()
+
+@pytest.fixture
+def repo(tmpdir):
+    repo = str(tmpdir.join('repo'))
+    os.mkdir(repo)
+    do_cmd(git, 'init', '-q', cwd=repo)
+    return repo
+
+def test_tag_wins_over_branch_of_the_same_name(repo):
+    write_tree(repo, {'a': '1\n'})
+    first = commit(repo, 'first')
+    write_tree(repo, {'a': '2\n'})
+    second = commit(repo, 'second')
+    do_cmd(git, 'tag', 'web1', first, cwd=repo)
+    do_cmd(git, 'branch', 'web1', second, cwd=repo)
+    vcs = Git(git, repo)
+    try:
+        assert vcs.get_tag('web1').referenced.id == first
+        assert do_cmd(git, 'rev-parse', 'web1', cwd=repo).strip() == first
+    finally:
+        vcs.close()
+
+def test_put_tag_and_changed_paths(repo):
+    write_tree(repo, {'settings/web1/a': '1\n', 'settings/web1/b': '1\n'})
+    first = commit(repo, 'first')
+    vcs = Git(git, repo)
+    try:
+        with pytest.raises(NoSuchReference):
+            vcs.get_tag('web1')
+        vcs.put_tag('web1', first)
+        write_tree(repo, {'settings/web1/b': '2\n'})
+        commit(repo, 'second')
+        vcs.invalidate_refs()
+        tag = vcs.get_tag('web1')
+        assert tag.referenced.id == first
+        assert vcs.changed_paths(tag.referenced, vcs['HEAD'], os.path.join(repo, 'settings')) == [
+            ('M', os.path.join(vcs.repo_root, 'settings', 'web1', 'b'))]
+    finally:
+        vcs.close()
+
+def test_branch_of_the_same_name_as_a_tag(repo):
+    write_tree(repo, {'a': '1\n'})
+    first = commit(repo, 'first')
+    write_tree(repo, {'a': '2\n'})
+    second = commit(repo, 'second')
+    branch = do_cmd(git, 'symbolic-ref', '--short', 'HEAD', cwd=repo).strip()
+    do_cmd(git, 'tag', branch, first, cwd=repo)
+    vcs = Git(git, repo)
+    try:
+        assert vcs.branch.name == branch
+        assert vcs.branch.referenced.id == second
+        assert vcs.get_tag(branch).referenced.id == first
+    finally:
+        vcs.close()
+
+def test_close_stops_the_cat_file_processes(repo):
+    write_tree(repo, {'a': '1\n'})
+    first = commit(repo, 'first')
+    vcs = Git(git, repo)
+    vcs.put_tag('web1', first)
+    assert vcs.get_tag('web1').referenced.id == first
+    readers = [vcs.wrapper.objects, vcs.wrapper.object_ids]
+    processes = [reader.process for reader in readers if reader.process is not None]
+    assert processes
+    vcs.close()
+    assert all(process.poll() is not None for process in processes)
+    assert [(reader.process, reader.devnull) for reader in readers] == [(None, None)] * 2
+
+def test_put_closes_the_repository(repo, ssh_standin, monkeypatch):
+    ssh, dest = ssh_standin
+    write_tree(repo, {
+        '.muppetrc': '[settings]\ndir = settings\n',
+        'settings/web1/etc/motd': 'hello\n',
+        })
+    commit(repo, 'first')
+    closed = []
+    monkeypatch.setattr(Git, 'close', lambda self: closed.append(self))
+    variables = {'project_dir': repo, 'cwd': repo, 'transport': 'tar', 'changed_only': True}
+    put(make_settings({'ssh.command': ssh}), variables)('web1')
+    assert read(os.path.join(dest, 'etc', 'motd')) == 'hello\n'
+    assert len(closed) == 1
@@ -0,0 +1,98 @@
+import os
+import time
+import pytest
+from muppet.index import compile_tree, load_index, current_index
+from muppet.store import ObjectStore, build_manifest, stage_objects, collect_garbage, INDEX_SUFFIX
+from muppet.scripts.muppet_ import load_command
+from muppet.scripts.local_commands import put_staged
+from helpers import write_tree, read, make_settings
+
+@pytest.fixture
+def src(tmpdir):
+    root = str(tmpdir.join('src'))
+    write_tree(root, {
+        '.muppetmeta': {'entries': {'etc/': {'file-mode': '755'}}},
+        'etc/.muppetmeta': {
+            'entry-defaults': {'file-owner': 'root'},
+            'entries': {'motd': {'file-mode': '640'}, 'link': {'symlink': 'motd'}},
+            },
+        'etc/motd': 'hello\n',
+        'etc/link': '',
+        })
+    return root
+
+def test_compiled_index_round_trip(src, tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    compile_tree(cache_dir, src)
+    tree = load_index(cache_dir, src)
+    motd = tree.root.get('etc').get('motd')
+    assert (motd.mode, motd.owner) == (0640, 'root')
+    assert tree.root.get('etc').get('link').to == 'motd'
+
+def test_stale_index_is_ignored(src, tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    compile_tree(cache_dir, src)
+    time.sleep(0.01)
+    write_tree(src, {'etc/.muppetmeta': {'entries': {'motd': {'file-mode': '600'}}}})
+    assert load_index(cache_dir, src) is None
+    assert current_index(cache_dir, src)['entries'][-1]['mode'] == 0600
+    assert load_index(cache_dir, src) is not None
+
+def stage(src, cache_dir, run, index):
+    # what put's store transport leaves on the host
+    manifest = build_manifest(src)
+    stage_objects(manifest, src, ObjectStore(os.path.join(cache_dir, 'objects')))
+    write_tree(cache_dir, {'runs/%s/web1.json' % run: manifest})
+    if index is not None:
+        write_tree(cache_dir, {'runs/%s/web1%s' % (run, INDEX_SUFFIX): index})
+    return os.path.join(cache_dir, 'runs', run, 'web1.json')
+
+def test_put_staged_takes_the_shipped_index(src, tmpdir):
+    index = current_index(str(tmpdir.join('local')), src)
+    # the index is taken over the .muppetmeta it was compiled from
+    for record in index['entries']:
+        if record['path'] == 'etc/motd':
+            record['mode'] = 0600
+    cache_dir = str(tmpdir.join('remote-cache'))
+    dest = str(tmpdir.mkdir('dest'))
+    manifest_file = stage(src, cache_dir, '1', index)
+    put_staged(make_settings(), {})(manifest_file, dest)
+    assert read(os.path.join(dest, 'etc', 'motd')) == 'hello\n'
+    assert os.stat(os.path.join(dest, 'etc', 'motd')).st_mode & 0777 == 0600
+
+def test_put_staged_without_index(src, tmpdir):
+    cache_dir = str(tmpdir.join('remote-cache'))
+    dest = str(tmpdir.mkdir('dest'))
+    put_staged(make_settings(), {})(stage(src, cache_dir, '1', None), dest)
+    assert os.stat(os.path.join(dest, 'etc', 'motd')).st_mode & 0777 == 0640
+
+def test_garbage_collection_keeps_indexes_with_their_runs(src, tmpdir):
+    cache_dir = str(tmpdir.join('remote-cache'))
+    index = current_index(str(tmpdir.join('local')), src)
+    for run in '123':
+        stage(src, cache_dir, run, index)
+    collect_garbage(cache_dir, keep=2)
+    assert sorted(os.listdir(os.path.join(cache_dir, 'runs'))) == ['2', '3']
+    assert sorted(os.listdir(os.path.join(cache_dir, 'runs', '3'))) == ['web1.index.json', 'web1.json']
+
+def test_shipped_index_follows_symbolic_links(src, tmpdir):
+    # as the staging manifest does; etc/ssl, which the metadata does not
+    # mention, reaches the host as a directory
+    write_tree(str(tmpdir), {
+        'shared/ssl/.muppetmeta': {'entries': {'cert.pem': {'file-mode': '600'}}},
+        'shared/ssl/cert.pem': 'cert\n',
+        })
+    os.symlink(str(tmpdir.join('shared', 'ssl')), os.path.join(src, 'etc', 'ssl'))
+    local_cache = str(tmpdir.join('local'))
+    index = current_index(local_cache, src, follow_symlinks=True)
+    assert [record['type'] for record in index['entries'] if record['path'] == 'etc/ssl'] == ['directory']
+    # the index put-local keeps for itself is not mistaken for it
+    assert current_index(local_cache, src)['follow_symlinks'] is False
+    cache_dir = str(tmpdir.join('remote-cache'))
+    dest = str(tmpdir.mkdir('dest'))
+    put_staged(make_settings(), {})(stage(src, cache_dir, '1', index), dest)
+    assert read(os.path.join(dest, 'etc', 'ssl', 'cert.pem')) == 'cert\n'
+    assert os.stat(os.path.join(dest, 'etc', 'ssl', 'cert.pem')).st_mode & 0777 == 0600
+
+def test_compile_command_does_not_shadow_the_builtin():
+    assert load_command('compile').__name__ == 'compile_index'
@@ -0,0 +1,101 @@
+import os
+import time
+import pytest
+from muppet.exceptions import MuppetConfigurationError
+from muppet.layers import server_layers, OverlayCache, tree_stamp
+from muppet.store import build_manifest
+from muppet.tree import Tree, Symlink
+from helpers import write_tree, read, make_settings
+
+def test_server_layers():
+    settings = make_settings({'layers.web1': 'base, web', 'layers.web': 'base', 'layers.base': 'common'})
+    assert server_layers(settings, 'web1') == ['common', 'base', 'web']
+    assert server_layers(settings, 'common') == []
+
+def test_layers_that_refer_back():
+    settings = make_settings({'layers.web1': 'web', 'layers.web': 'base', 'layers.base': 'web'})
+    with pytest.raises(MuppetConfigurationError):
+        server_layers(settings, 'web1')
+
+@pytest.fixture
+def layers(tmpdir):
+    write_tree(str(tmpdir), {
+        'base/.muppetmeta': {'entries': {'etc/': {'file-mode': '755'}}},
+        'base/etc/.muppetmeta': {'entries': {
+            'motd': {'file-mode': '644', 'file-owner': 'root'},
+            'issue': {},
+            'hosts': {'file-mode': '644'},
+            }},
+        'base/etc/motd': 'base\n',
+        'base/etc/issue': 'base issue\n',
+        'base/etc/hosts': 'base hosts\n',
+        'web1/.muppetmeta': {'entries': {'etc/': {}}},
+        'web1/etc/.muppetmeta': {'entries': {
+            'motd': {'file-mode': '600'},
+            'issue': {'symlink': 'motd'},
+            'hosts': {},
+            }},
+        'web1/etc/motd': 'web1\n',
+        'web1/etc/issue': '',
+        'elsewhere/hosts': 'web1 hosts\n',
+        })
+    os.symlink(str(tmpdir.join('elsewhere', 'hosts')), str(tmpdir.join('web1', 'etc', 'hosts')))
+    return str(tmpdir.join('base')), str(tmpdir.join('web1'))
+
+def test_upper_layer_takes_precedence(layers, tmpdir):
+    cache = OverlayCache(str(tmpdir.join('overlays')))
+    path = cache.overlay(list(layers))
+    tree = Tree.from_annotated_fs(path)
+    etc = tree.root.get('etc')
+    assert etc.mode == 0755
+    motd = etc.get('motd')
+    # the mode from above, the owner from below
+    assert (motd.mode, motd.owner) == (0600, 'root')
+    assert read(os.path.join(path, 'etc', 'motd')) == 'web1\n'
+    assert isinstance(etc.get('issue'), Symlink) and etc.get('issue').to == 'motd'
+    # a symbolic link in a layer stands for what it points to
+    assert not os.path.islink(os.path.join(path, 'etc', 'hosts'))
+    assert read(os.path.join(path, 'etc', 'hosts')) == 'web1 hosts\n'
+    assert etc.get('hosts').mode == 0644
+    assert cache.manifest(path) == build_manifest(path)
+
+def test_overlays_are_reused_until_a_layer_changes(layers, tmpdir):
+    base, web1 = layers
+    path = OverlayCache(str(tmpdir.join('overlays'))).overlay([base, web1])
+    assert OverlayCache(str(tmpdir.join('overlays'))).overlay([base, web1]) == path
+    os.unlink(os.path.join(web1, 'etc', 'motd'))
+    write_tree(web1, {'etc/motd': 'changed\n'})
+    changed = OverlayCache(str(tmpdir.join('overlays'))).overlay([base, web1])
+    assert changed != path
+    assert read(os.path.join(changed, 'etc', 'motd')) == 'changed\n'
+
+def test_unused_overlays_are_collected(layers, tmpdir):
+    cache = OverlayCache(str(tmpdir.join('overlays')))
+    path = cache.overlay(list(layers))
+    cache.collect(3600)
+    assert os.path.isdir(path)
+    old = time.time() - 7200
+    os.utime(path, (old, old))
+    cache.collect(3600)
+    assert os.listdir(str(tmpdir.join('overlays'))) == []
+
+def test_dangling_symlink_in_a_layer(tmpdir):
+    write_tree(str(tmpdir), {'layer/etc/motd': 'motd\n'})
+    stamp = tree_stamp(str(tmpdir.join('layer')))
+    os.symlink('nowhere', str(tmpdir.join('layer', 'etc', 'dangling')))
+    assert tree_stamp(str(tmpdir.join('layer'))) != stamp
+
+def test_symlinked_directory_in_a_layer(layers, tmpdir):
+    base, web1 = layers
+    write_tree(str(tmpdir), {'shared/ssl/cert.pem': 'cert\n'})
+    os.symlink(str(tmpdir.join('shared', 'ssl')), os.path.join(base, 'etc', 'ssl'))
+    cache = OverlayCache(str(tmpdir.join('overlays')))
+    path = cache.overlay([base, web1])
+    assert os.path.isdir(os.path.join(path, 'etc', 'ssl'))
+    assert not os.path.islink(os.path.join(path, 'etc', 'ssl'))
+    assert read(os.path.join(path, 'etc', 'ssl', 'cert.pem')) == 'cert\n'
+    # what lies behind the link is part of the layer's stamp
+    os.unlink(str(tmpdir.join('shared', 'ssl', 'cert.pem')))
+    write_tree(str(tmpdir), {'shared/ssl/cert.pem': 'renewed\n'})
+    changed = OverlayCache(str(tmpdir.join('overlays'))).overlay([base, web1])
+    assert read(os.path.join(changed, 'etc', 'ssl', 'cert.pem')) == 'renewed\n'
@@ -0,0 +1,81 @@
+import os
+import pytest
+import muppet.tree
+from muppet.manifest import Manifest
+from muppet.tree import SourceFile
+from muppet.scripts.local_commands import put_local
+from muppet.utils import file_digest
+from helpers import write_tree, read, make_settings
+
+@pytest.fixture
+def src(tmpdir):
+    root = str(tmpdir.join('src'))
+    write_tree(root, {
+        '.muppetmeta': {'entries': {'etc/': {'file-mode': '755'}}},
+        'etc/.muppetmeta': {'entries': {'motd': {'file-mode': '640'}, 'issue': {}}},
+        'etc/motd': 'hello\n',
+        'etc/issue': 'issue\n',
+        })
+    return root
+
+def put_to(dest, src, tmpdir, **variables):
+    variables.setdefault('incremental', True)
+    settings = make_settings({'muppet.cache_dir': str(tmpdir.join('cache'))})
+    put_local(settings, variables)(src, dest)
+
+def test_manifest_round_trip(src, tmpdir):
+    dest = str(tmpdir.mkdir('dest'))
+    put_to(dest, src, tmpdir)
+    manifest = Manifest.load(str(tmpdir.join('cache')), dest)
+    record = manifest.lookup(os.path.join(dest, 'etc', 'motd'))
+    assert (record['type'], record['mode'], record['size']) == ('file', 0640, 6)
+    assert record['hash'] == file_digest(os.path.join(src, 'etc', 'motd'))
+    assert manifest.lookup(os.path.join(dest, 'etc'))['type'] == 'directory'
+
+def test_corrupt_manifest_is_ignored(src, tmpdir):
+    dest = str(tmpdir.mkdir('dest'))
+    put_to(dest, src, tmpdir)
+    path = Manifest.path_for(str(tmpdir.join('cache')), dest)
+    write_tree(os.path.dirname(path), {os.path.basename(path): '{"version": 1'})
+    assert Manifest.load(str(tmpdir.join('cache')), dest) is None
+    put_to(dest, src, tmpdir)
+    assert Manifest.load(str(tmpdir.join('cache')), dest) is not None
+
+def test_untouched_entries_are_not_hashed(src, tmpdir, monkeypatch):
+    dest = str(tmpdir.mkdir('dest'))
+    put_to(dest, src, tmpdir)
+    def digest(*args):
+        raise AssertionError("hashed")
+    monkeypatch.setattr(muppet.tree, 'file_digest', digest)
+    monkeypatch.setattr(SourceFile, 'digest', digest)
+    put_to(dest, src, tmpdir)
+
+def test_changed_source_is_applied(src, tmpdir):
+    dest = str(tmpdir.mkdir('dest'))
+    put_to(dest, src, tmpdir)
+    write_tree(src, {'etc/motd': 'changed\n'})
+    put_to(dest, src, tmpdir)
+    assert read(os.path.join(dest, 'etc', 'motd')) == 'changed\n'
+
+def test_destination_changes_are_repaired(src, tmpdir):
+    dest = str(tmpdir.mkdir('dest'))
+    put_to(dest, src, tmpdir)
+    issue = os.path.join(dest, 'etc', 'issue')
+    # same size and mtime; only the manifest tells
+    mtime = os.stat(issue).st_mtime
+    write_tree(dest, {'etc/issue': 'ISSUE\n'})
+    os.utime(issue, (mtime, mtime))
+    os.chmod(os.path.join(dest, 'etc', 'motd'), 0777)
+    put_to(dest, src, tmpdir)
+    assert read(issue) == 'issue\n'
+    assert os.stat(os.path.join(dest, 'etc', 'motd')).st_mode & 0777 == 0640
+    os.unlink(issue)
+    put_to(dest, src, tmpdir)
+    assert read(os.path.join(dest, 'etc', 'issue')) == 'issue\n'
+
+def test_partial_run_keeps_the_rest_of_the_manifest(src, tmpdir):
+    dest = str(tmpdir.mkdir('dest'))
+    put_to(dest, src, tmpdir)
+    put_to(dest, src, tmpdir, only=['etc/motd'])
+    assert Manifest.load(str(tmpdir.join('cache')), dest).lookup(
+        os.path.join(dest, 'etc', 'issue')) is not None
@@ -0,0 +1,50 @@
+import os
+import logging
+import pytest
+from muppet.tree import PathFilter
+from muppet.scripts.common import MuppetApplicationError
+from muppet.scripts.local_commands import put_local
+from helpers import write_tree, read, make_settings
+
+@pytest.fixture
+def src(tmpdir):
+    root = str(tmpdir.join('src'))
+    write_tree(root, {
+        '.muppetmeta': {'entries': {'etc/': {'file-mode': '755'}}},
+        'etc/.muppetmeta': {'entries': {'motd': {}, 'nginx/': {'file-mode': '750'}}},
+        'etc/motd': 'hello\n',
+        'etc/nginx/.muppetmeta': {'entries': {'nginx.conf': {'file-mode': '640'}, 'mime.types': {}}},
+        'etc/nginx/nginx.conf': 'conf\n',
+        'etc/nginx/mime.types': 'types\n',
+        })
+    return root
+
+def test_path_filter():
+    path_filter = PathFilter(['etc/nginx/**', 'etc/*.conf', 'var/missing'])
+    assert path_filter.selects('etc/nginx/nginx.conf')
+    assert path_filter.selects('etc/nginx')
+    assert path_filter.selects('etc/resolv.conf')
+    assert not path_filter.selects('etc/motd')
+    assert path_filter.leads_to('etc')
+    assert not path_filter.leads_to('usr')
+    assert path_filter.unmatched() == ['var/missing']
+
+def test_double_star_only_at_the_end():
+    with pytest.raises(MuppetApplicationError):
+        put_local(make_settings(), {'only': ['etc/**/nginx.conf']})('/nonexistent', '/nonexistent')
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_only_applies_the_selected_part(src, tmpdir, caplog, stream):
+    dest = str(tmpdir.join('dest'))
+    write_tree(dest, {'etc/motd': 'old\n', 'etc/stray': 'stray\n'})
+    with caplog.at_level(logging.WARNING):
+        put_local(make_settings(), {'only': ['etc/nginx/nginx.conf', 'etc/missing'], 'stream': stream})(src, dest)
+    assert read(os.path.join(dest, 'etc', 'nginx', 'nginx.conf')) == 'conf\n'
+    assert os.stat(os.path.join(dest, 'etc', 'nginx')).st_mode & 0777 == 0750
+    assert not os.path.exists(os.path.join(dest, 'etc', 'nginx', 'mime.types'))
+    assert read(os.path.join(dest, 'etc', 'motd')) == 'old\n'
+    # what lies outside the selection is neither touched nor reported
+    assert read(os.path.join(dest, 'etc', 'stray')) == 'stray\n'
+    messages = [record.getMessage() for record in caplog.records]
+    assert 'etc/missing does not match anything in %s' % src in messages
+    assert not any('unmanaged' in message for message in messages)
@@ -0,0 +1,70 @@
+import os
+import pytest
+from muppet.plan import Plan
+from muppet.scripts.common import MuppetApplicationError
+from muppet.scripts.local_commands import plan, put_plan
+from helpers import write_tree, read, make_settings
+
+@pytest.fixture
+def src(tmpdir):
+    root = str(tmpdir.join('src'))
+    write_tree(root, {
+        '.muppetmeta': {'entries': {'etc/': {'file-mode': '755'}}},
+        'etc/.muppetmeta': {'entries': {'motd': {'file-mode': '640'}, 'new': {}}},
+        'etc/motd': 'hello\n',
+        'etc/new': 'new\n',
+        })
+    return root
+
+@pytest.fixture
+def dest(tmpdir):
+    root = str(tmpdir.join('dest'))
+    write_tree(root, {'etc/motd': 'old\n'})
+    os.chmod(os.path.join(root, 'etc', 'motd'), 0644)
+    return root
+
+def test_plan_then_put(src, dest, tmpdir, monkeypatch):
+    # planned with relative paths and carried out from elsewhere
+    monkeypatch.chdir(str(tmpdir))
+    plan(make_settings(), {})('src', 'dest', 'saved.plan')
+    assert read(os.path.join(dest, 'etc', 'motd')) == 'old\n'
+    assert not os.path.exists(os.path.join(dest, 'etc', 'new'))
+    saved = Plan.load('saved.plan')
+    assert saved.dest == dest and saved.src == src
+    assert [(operation['op'], operation['path']) for operation in saved.select('create', 'replace')] == [
+        ('replace', os.path.join(dest, 'etc', 'motd')),
+        ('create', os.path.join(dest, 'etc', 'new')),
+        ]
+    monkeypatch.chdir(str(tmpdir.mkdir('elsewhere')))
+    put_plan(make_settings(), {})(os.path.join(str(tmpdir), 'saved.plan'))
+    assert read(os.path.join(dest, 'etc', 'motd')) == 'hello\n'
+    assert os.stat(os.path.join(dest, 'etc', 'motd')).st_mode & 0777 == 0640
+    assert read(os.path.join(dest, 'etc', 'new')) == 'new\n'
+
+def test_incremental_plan_of_an_applied_tree_only_keeps(src, dest, tmpdir):
+    variables = {'incremental': True}
+    plan(make_settings(), variables)(src, dest, str(tmpdir.join('first.plan')))
+    put_plan(make_settings(), variables)(str(tmpdir.join('first.plan')))
+    plan(make_settings(), variables)(src, dest, str(tmpdir.join('second.plan')))
+    second = Plan.load(str(tmpdir.join('second.plan')))
+    assert second.incremental
+    assert set(operation['op'] for operation in second.operations) == set(['keep'])
+
+def test_plans_are_ordered_parents_first():
+    p = Plan('/dest')
+    p.add('chmod', '/dest/etc/motd', mode=0640)
+    p.add('create', '/dest/etc/motd', type='file')
+    p.add('create', '/dest/etc', type='directory')
+    p.sort()
+    assert [(operation['op'], operation['path']) for operation in p.operations] == [
+        ('create', '/dest/etc'), ('create', '/dest/etc/motd'), ('chmod', '/dest/etc/motd')]
+
+def test_invalid_plan(tmpdir):
+    write_tree(str(tmpdir), {
+        'old.plan': {'version': 0, 'dest': '/', 'operations': []},
+        'bad.plan': {'version': 1, 'dest': '/', 'operations': [{'op': 'format', 'path': '/'}]},
+        'junk.plan': 'junk',
+        })
+    for name in ('old.plan', 'bad.plan', 'junk.plan'):
+        with pytest.raises(MuppetApplicationError):
+            put_plan(make_settings(), {})(str(tmpdir.join(name)))
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import pytest
+from muppet.exceptions import MuppetConfigurationError
+from muppet.settings import Settings, config_wrapper_from_file
+from muppet.scripts.commands import expand_servers
+
+def settings_of(*dicts):
+    settings = Settings()
+    for dict_ in dicts:
+        settings.add(dict_)
+    return settings
+
+def test_interpolation():
+    settings = settings_of({
+        'muppet.root': '/srv/muppet',
+        'muppet.cache_dir': '${muppet.root}/cache',
+        'muppet.overlay_dir': '${muppet.cache_dir}/overlays',
+        'muppet.unset': '[${no.such.key}]',
+        })
+    assert settings['muppet.overlay_dir'] == '/srv/muppet/cache/overlays'
+    assert settings['muppet.unset'] == '[]'
+    assert settings.get('no.such.key') is None
+    with pytest.raises(KeyError):
+        settings['no.such.key']
+
+def test_later_layers_win_and_the_cache_follows():
+    settings = settings_of({'a.root': '/one', 'a.dir': '${a.root}/dir'})
+    assert settings['a.dir'] == '/one/dir'
+    settings.add({'a.root': '/two'})
+    assert settings['a.dir'] == '/two/dir'
+    assert settings.get_prefixed('a.') == {'root': '/two', 'dir': '/two/dir'}
+
+@pytest.mark.parametrize('dict_', [
+    {'a.b': '${a.b}'},
+    {'a.b': '${a.c}', 'a.c': 'x${a.d}', 'a.d': '${a.b}'},
+    ])
+def test_cycles(dict_):
+    settings = settings_of(dict_)
+    with pytest.raises(MuppetConfigurationError) as e:
+        settings['a.b']
+    assert 'refers to itself' in str(e.value)
+
+def test_a_key_may_be_used_twice():
+    settings = settings_of({'a.b': '${a.c}-${a.c}', 'a.c': '${a.d}', 'a.d': 'd'})
+    assert settings['a.b'] == 'd-d'
+
+def test_encoding_per_layer():
+    settings = settings_of(
+        {'a.motd': 'caf\xc3\xa9'},
+        {'muppetrc.encoding': 'latin-1', 'a.issue': 'caf\xe9', 'a.both': '${a.motd}/${a.issue}'})
+    assert settings['a.both'] == u'café/café'
+
+def test_server_groups(tmpdir):
+    path = str(tmpdir.join('.muppetrc'))
+    f = open(path, 'w')
+    f.write('[servers]\nweb = web1, ${servers.db}\ndb = db1\n')
+    f.close()
+    settings = settings_of(config_wrapper_from_file(path))
+    assert settings.get_prefixed('servers.') == {'web': 'web1, db1', 'db': 'db1'}
+    assert expand_servers(settings, ['web', 'mail1']) == ['web1', 'db1', 'mail1']
@@ -0,0 +1,99 @@
+import os
+import fabric.api
+import pytest
+from muppet.ssh import ssh_command, parse_host_string, SSHSessionPool
+from muppet.scripts.commands import put
+from muppet.scripts.common import MuppetApplicationError
+from helpers import write_tree, read, make_settings
+
+def test_parse_host_string():
+    assert parse_host_string('web1') == (None, 'web1', None)
+    assert parse_host_string('admin@web1:2222') == ('admin', 'web1', '2222')
+    assert parse_host_string('[::1]:22') == (None, '::1', '22')
+
+def test_ssh_command():
+    settings = {'ssh.command': 'ssh -q'}
+    assert ssh_command(settings, 'admin@web1:2222', 5, user='other', identity_files=['key']) == [
+        'ssh', '-q', '-i', 'key', '-p', '2222',
+        '-o', 'ConnectTimeout=5', '-o', 'ServerAliveInterval=5', '-o', 'ServerAliveCountMax=1',
+        'admin@web1']
+    assert ssh_command(settings, 'web1', user='other') == ['ssh', '-q', 'other@web1']
+
+def test_session_pool_shares_one_socket_per_host():
+    pool = SSHSessionPool({'ssh.command': 'ssh'})
+    try:
+        command = pool.command_for('web1')
+        assert command[-1] == 'web1'
+        assert 'ControlPath=%s' % pool.control_path('web1') in command
+        assert pool.command_for('web1') == command
+        assert pool.control_path('web2') != pool.control_path('web1')
+    finally:
+        pool.close()
+    assert not os.path.exists(pool.control_dir)
+
+def test_multiplexing_is_off_by_default():
+    assert make_settings()['ssh.multiplex'] == 'no'
+
+@pytest.fixture
+def project(tmpdir):
+    write_tree(str(tmpdir.join('project')), {
+        '.muppetrc': '[settings]\ndir = settings\n',
+        'settings/web1/.muppetmeta': {'entries': {'etc/': {'file-mode': '755'}}},
+        'settings/web1/etc/.muppetmeta': {'entries': {'motd': {'file-mode': '640'}}},
+        'settings/web1/etc/motd': 'hello\n',
+        })
+    return str(tmpdir.join('project'))
+
+def put_to(project, ssh, **settings):
+    settings.update({'ssh.command': ssh, 'muppet.overlay_dir': os.path.join(project, 'overlays')})
+    variables = {'project_dir': project, 'cwd': project, 'transport': 'tar'}
+    put(make_settings(settings), variables)('web1')
+
+def test_put_through_standin(project, ssh_standin):
+    ssh, dest = ssh_standin
+    put_to(project, ssh)
+    assert read(os.path.join(dest, 'etc', 'motd')) == 'hello\n'
+    assert oct(os.stat(os.path.join(dest, 'etc', 'motd')).st_mode & 0777) == '0640'
+
+def test_put_with_sudo_password(project, ssh_standin, monkeypatch):
+    ssh, dest = ssh_standin
+    monkeypatch.setenv('STANDIN_SUDO_PASSWORD', 'secret')
+    monkeypatch.setitem(fabric.api.env, 'password', 'secret')
+    put_to(project, ssh)
+    assert read(os.path.join(dest, 'etc', 'motd')) == 'hello\n'
+
+def test_put_reuses_one_session(project, ssh_standin, tmpdir):
+    ssh, dest = ssh_standin
+    put_to(project, ssh, **{'ssh.multiplex': 'yes'})
+    logins = read(str(tmpdir.join('standin.log'))).splitlines()
+    # the sudo check and the put, both on one socket, which is then closed
+    assert [line.split()[0] for line in logins] == ['login', 'login', 'exit']
+    assert len(set(line.split()[1] for line in logins)) == 1
+
+@pytest.mark.parametrize('concurrency', [1, 2])
+def test_failed_server_is_reported(project, ssh_standin, capsys, concurrency):
+    ssh, dest = ssh_standin
+    write_tree(project, {
+        'settings/web2/.muppetmeta': {'entries': {'etc/': {'file-owner': 'no-such-user'}}},
+        'settings/web2/etc/motd': 'hello\n',
+        })
+    variables = {'project_dir': project, 'cwd': project, 'transport': 'tar', 'concurrency': concurrency}
+    with pytest.raises(MuppetApplicationError) as e:
+        put(make_settings({'ssh.command': ssh}), variables)('web1', 'web2')
+    assert 'web2' in str(e.value) and 'web1' not in str(e.value)
+    assert read(os.path.join(dest, 'etc', 'motd')) == 'hello\n'
+    assert capsys.readouterr()[0].splitlines()[-1] == '1 succeeded, 1 failed'
+
+def test_overlays_are_kept_in_the_checkout(project, ssh_standin):
+    ssh, dest = ssh_standin
+    write_tree(project, {
+        '.muppetrc': '[settings]\ndir = settings\n[layers]\nweb1 = base\n',
+        'settings/base/.muppetmeta': {'entries': {'etc/': {'file-mode': '755'}}},
+        'settings/base/etc/.muppetmeta': {'entries': {'issue': {'file-mode': '644'}}},
+        'settings/base/etc/issue': 'base\n',
+        })
+    variables = {'project_dir': project, 'cwd': project, 'transport': 'tar'}
+    put(make_settings({'ssh.command': ssh}), variables)('web1')
+    assert read(os.path.join(dest, 'etc', 'motd')) == 'hello\n'
+    assert read(os.path.join(dest, 'etc', 'issue')) == 'base\n'
+    assert os.listdir(os.path.join(project, 'settings', '.overlays'))
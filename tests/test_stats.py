@@ -0,0 +1,45 @@
+import simplejson as json
+import os
+import sys
+import pytest
+from muppet import utils, tree
+from muppet.stats import stats
+from muppet.scripts import muppet_
+from helpers import write_tree, read
+
+@pytest.fixture
+def run_main(tmpdir, monkeypatch):
+    write_tree(str(tmpdir), {
+        'muppetrc': '[muppet]\ncache_dir = %s\n' % tmpdir.join('cache'),
+        'src/.muppetmeta': {'entries': {'etc/': {'file-mode': '755'}}},
+        'src/etc/.muppetmeta': {'entries': {'motd': {'file-mode': '640'}}},
+        'src/etc/motd': 'hello\n',
+        })
+    monkeypatch.setattr(muppet_, 'global_settings_files', [str(tmpdir.join('muppetrc'))])
+    monkeypatch.setattr(stats, 'enabled', False)
+    monkeypatch.setattr(stats, 'counters', {})
+    monkeypatch.setattr(stats, 'timings', {})
+    def run_main(*args):
+        monkeypatch.setattr(sys, 'argv', ['muppet'] + list(args) + [
+            'put_local', str(tmpdir.join('src')), str(tmpdir.mkdir('dest'))])
+        muppet_.main()
+    return run_main
+
+def test_stats_json(run_main, tmpdir):
+    originals = os.lstat, utils.scandir, tree.scandir
+    run_main('--stats-json', str(tmpdir.join('stats.json')))
+    figures = json.loads(read(str(tmpdir.join('stats.json'))))
+    assert figures['counters']['syscall.mkdir'] == 1
+    assert figures['counters']['syscall.scandir'] > 0
+    assert figures['counters']['files.copied'] == 1
+    assert figures['timings']['phase.command']['calls'] == 1
+    # the counting wrappers do not outlive the command
+    assert (os.lstat, utils.scandir, tree.scandir) == originals
+
+def test_stats_report(run_main, caplog):
+    originals = os.lstat, utils.scandir, tree.scandir
+    run_main('--stats')
+    lines = [record.getMessage() for record in caplog.records]
+    assert any(line.startswith('phase.command ') for line in lines)
+    assert any(line.split() == ['files.copied', '1'] for line in lines)
+    assert (os.lstat, utils.scandir, tree.scandir) == originals
@@ -0,0 +1,118 @@
+import os
+import pytest
+from muppet.exceptions import MuppetException
+from muppet.store import ObjectStore, build_manifest, stage_objects, materialize, load_manifest, collect_garbage
+from muppet.utils import file_digest
+from muppet.scripts.local_commands import put_staged
+from helpers import write_tree, read, make_settings
+
+@pytest.fixture
+def src(tmpdir):
+    root = str(tmpdir.join('src'))
+    write_tree(root, {
+        'etc/motd': 'hello\n',
+        'etc/copy-of-motd': 'hello\n',
+        'etc/app/conf': 'conf\n',
+        })
+    write_tree(str(tmpdir), {'elsewhere/issue': 'issue\n'})
+    os.symlink('../../elsewhere/issue', os.path.join(root, 'etc', 'issue'))
+    return root
+
+def stage(src, cache_dir, run, server='web1'):
+    manifest = build_manifest(src)
+    stage_objects(manifest, src, ObjectStore(os.path.join(cache_dir, 'objects')))
+    write_tree(cache_dir, {'runs/%s/%s.json' % (run, server): manifest})
+    return manifest
+
+def test_stage_and_materialize(src, tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    manifest = stage(src, cache_dir, '1')
+    assert [(entry['path'], entry['type']) for entry in manifest['entries']] == [
+        ('etc', 'directory'), ('etc/app', 'directory'), ('etc/app/conf', 'file'),
+        ('etc/copy-of-motd', 'file'), ('etc/issue', 'file'), ('etc/motd', 'file')]
+    store = ObjectStore(os.path.join(cache_dir, 'objects'))
+    # one object for the two copies of motd
+    assert len(list(store)) == 3
+    dest = str(tmpdir.join('materialized'))
+    assert load_manifest(os.path.join(cache_dir, 'runs', '1', 'web1.json')) == manifest
+    materialize(manifest, store, dest)
+    assert read(os.path.join(dest, 'etc', 'motd')) == 'hello\n'
+    assert read(os.path.join(dest, 'etc', 'copy-of-motd')) == 'hello\n'
+    assert read(os.path.join(dest, 'etc', 'app', 'conf')) == 'conf\n'
+    assert os.path.getmtime(os.path.join(dest, 'etc')) == int(os.path.getmtime(os.path.join(src, 'etc')))
+
+def test_symbolic_links_are_staged_as_their_targets(src, tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    manifest = stage(src, cache_dir, '1')
+    store = ObjectStore(os.path.join(cache_dir, 'objects'))
+    hash = file_digest(str(tmpdir.join('elsewhere', 'issue')))
+    assert [entry['hash'] for entry in manifest['entries'] if entry['path'] == 'etc/issue'] == [hash]
+    assert not os.path.islink(store.object_path(hash))
+    dest = str(tmpdir.join('materialized'))
+    materialize(manifest, store, dest)
+    assert not os.path.islink(os.path.join(dest, 'etc', 'issue'))
+    assert read(os.path.join(dest, 'etc', 'issue')) == 'issue\n'
+
+def test_known_hashes_are_reused(src):
+    known = {'etc/motd': {'path': 'etc/motd', 'type': 'file', 'hash': 'cafe',
+                          'size': 6, 'mtime': int(os.path.getmtime(os.path.join(src, 'etc', 'motd')))}}
+    manifest = build_manifest(src, ['etc/motd', 'etc/app/conf'], known)
+    assert [(entry['path'], entry['type']) for entry in manifest['entries']] == [
+        ('etc', 'directory'), ('etc/app', 'directory'), ('etc/app/conf', 'file'), ('etc/motd', 'file')]
+    assert manifest['entries'][-1]['hash'] == 'cafe'
+
+def test_missing_object(src, tmpdir):
+    manifest = build_manifest(src)
+    with pytest.raises(MuppetException):
+        materialize(manifest, ObjectStore(str(tmpdir.join('empty'))), str(tmpdir.join('materialized')))
+
+def test_invalid_run(tmpdir):
+    write_tree(str(tmpdir), {'corrupt.json': '{', 'old.json': {'version': 0, 'entries': []}})
+    for name in ('corrupt.json', 'old.json'):
+        with pytest.raises(MuppetException):
+            load_manifest(str(tmpdir.join(name)))
+
+def rewrite(path, content):
+    # the staged object is the very file, as it is on the staging side
+    os.unlink(path)
+    write_tree(os.path.dirname(path), {os.path.basename(path): content})
+
+def test_collect_garbage(src, tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    stage(src, cache_dir, '1')
+    for run, content in (('2', 'changed\n'), ('3', 'changed again\n')):
+        rewrite(os.path.join(src, 'etc', 'motd'), content)
+        rewrite(os.path.join(src, 'etc', 'copy-of-motd'), content)
+        stage(src, cache_dir, run)
+    store = ObjectStore(os.path.join(cache_dir, 'objects'))
+    assert len(list(store)) == 5
+    collect_garbage(cache_dir, keep=2)
+    assert sorted(os.listdir(os.path.join(cache_dir, 'runs'))) == ['2', '3']
+    assert len(list(store)) == 4
+    # the size of what run 3 alone refers to
+    collect_garbage(cache_dir, keep=2, max_size=len('changed again\nconf\nissue\n'))
+    assert os.listdir(os.path.join(cache_dir, 'runs')) == ['3']
+    assert len(list(store)) == 3
+
+def test_every_server_of_the_run_being_put_is_kept(src, tmpdir):
+    # more servers on the host than runs to keep, put one after another
+    cache_dir = str(tmpdir.join('cache'))
+    for run in '12':
+        stage(src, cache_dir, run)
+    servers = ['web%d' % i for i in range(7)]
+    for server in servers:
+        stage(src, cache_dir, '3', server)
+    def put(server, **settings):
+        dest = str(tmpdir.join('dest', server))
+        os.makedirs(dest)
+        settings['muppet.keep_runs'] = '2'
+        put_staged(make_settings(settings), {})(
+            os.path.join(cache_dir, 'runs', '3', server + '.json'), dest)
+        assert read(os.path.join(dest, 'etc', 'motd')) == 'hello\n'
+    for server in servers[:4]:
+        put(server)
+        # runs are counted, not the servers in them
+        assert sorted(os.listdir(os.path.join(cache_dir, 'runs'))) == ['2', '3']
+    for server in servers[4:]:
+        put(server, **{'muppet.cache_max_size': '1'})
+        assert os.listdir(os.path.join(cache_dir, 'runs')) == ['3']
@@ -0,0 +1,77 @@
+import os
+import tarfile
+import pytest
+from cStringIO import StringIO
+from muppet.exceptions import MuppetException
+from muppet.transport import write_stream, apply_stream, MANIFEST_MEMBER
+from muppet.tree import TreeCopier
+from helpers import write_tree, read
+
+@pytest.fixture
+def src(tmpdir):
+    root = str(tmpdir.join('src'))
+    write_tree(root, {
+        '.muppetmeta': {'entries': {'etc/': {'file-mode': '755'}}},
+        'etc/.muppetmeta': {'entries': {
+            'motd': {'file-mode': '640'},
+            'issue': {'file-mode': '644'},
+            'link': {'symlink': 'motd'},
+            }},
+        'etc/motd': 'hello\n',
+        'etc/link': '',
+        })
+    # shipped as what it points to
+    write_tree(str(tmpdir), {'elsewhere/issue': 'issue\n'})
+    os.symlink('../../elsewhere/issue', os.path.join(root, 'etc', 'issue'))
+    return root
+
+def stream_of(root, paths=None):
+    buf = StringIO()
+    write_stream(root, paths, buf)
+    buf.seek(0)
+    return buf
+
+def test_stream_round_trip(src, tmpdir):
+    dest = str(tmpdir.mkdir('dest'))
+    copier = TreeCopier()
+    apply_stream(stream_of(src), dest, copier)
+    assert read(os.path.join(dest, 'etc', 'motd')) == 'hello\n'
+    assert oct(os.stat(os.path.join(dest, 'etc', 'motd')).st_mode & 0777) == '0640'
+    assert not os.path.islink(os.path.join(dest, 'etc', 'issue'))
+    assert read(os.path.join(dest, 'etc', 'issue')) == 'issue\n'
+    assert os.readlink(os.path.join(dest, 'etc', 'link')) == 'motd'
+    assert copier.pending_writes() == []
+
+def test_stream_of_selected_paths(src, tmpdir):
+    dest = str(tmpdir.mkdir('dest'))
+    apply_stream(
+        stream_of(src, ['.muppetmeta', 'etc/.muppetmeta', 'etc/motd']),
+        dest, TreeCopier(partial=True))
+    assert sorted(os.listdir(os.path.join(dest, 'etc'))) == ['motd']
+
+def test_stream_metadata_comes_first(src):
+    names = [member.name for member in tarfile.open(fileobj=stream_of(src), mode='r|gz')]
+    assert names[0] == MANIFEST_MEMBER
+    assert names[1:3] == ['.muppetmeta', 'etc/.muppetmeta']
+
+def test_truncated_stream(src, tmpdir):
+    # a stream that stops after the metadata
+    buf = StringIO()
+    tar = tarfile.open(fileobj=buf, mode='w|gz')
+    original = tarfile.open(fileobj=stream_of(src), mode='r|gz')
+    for member in original:
+        if member.name == 'etc/issue':
+            break
+        tar.addfile(member, original.extractfile(member))
+    tar.close()
+    buf.seek(0)
+    with pytest.raises(MuppetException):
+        apply_stream(buf, str(tmpdir.mkdir('dest')), TreeCopier())
+
+def test_not_a_stream(tmpdir):
+    buf = StringIO()
+    tar = tarfile.open(fileobj=buf, mode='w|gz')
+    tar.close()
+    buf.seek(0)
+    with pytest.raises(MuppetException):
+        apply_stream(buf, str(tmpdir.mkdir('dest')), TreeCopier())
@@ -0,0 +1,176 @@
+import os
+import pytest
+from muppet.exceptions import MuppetException, MuppetPrerequisiteError
+from muppet.tree import Tree, TreeCopier, SourceFile, Directory, File, replace_file
+from muppet.utils import IdResolver
+from helpers import write_tree, read
+
+def mode_of(path):
+    return os.lstat(path).st_mode & 07777
+
+@pytest.fixture
+def src(tmpdir):
+    root = str(tmpdir.join('src'))
+    write_tree(root, {
+        '.muppetmeta': {'entries': {'etc/': {'file-mode': '755'}}},
+        'etc/.muppetmeta': {'entries': {
+            'motd': {'file-mode': '640'},
+            'plain': {},
+            'app/': {'file-mode': '700'},
+            'link': {'symlink': 'motd'},
+            }},
+        'etc/motd': 'hello\n',
+        'etc/plain': 'plain\n',
+        'etc/link': '',
+        'etc/app/conf': 'conf\n',
+        })
+    return root
+
+def copy(dest, src, **kwargs):
+    copier = TreeCopier(**kwargs)
+    plan = copier(dest, src, Tree.from_annotated_fs(src))
+    copier.finish()
+    return copier, plan
+
+def test_replace_file_is_atomic(tmpdir):
+    write_tree(str(tmpdir), {'new': 'new\n', 'dest/file': 'old\n'})
+    dest_path = str(tmpdir.join('dest', 'file'))
+    old_inode = os.stat(dest_path).st_ino
+    replace_file(dest_path, SourceFile(str(tmpdir.join('new'))), 0600, None, None, IdResolver())
+    assert read(dest_path) == 'new\n'
+    assert mode_of(dest_path) == 0600
+    # renamed over the old file rather than rewritten in place
+    assert os.stat(dest_path).st_ino != old_inode
+    assert os.listdir(str(tmpdir.join('dest'))) == ['file']
+
+def test_replace_file_leaves_the_old_file_on_failure(tmpdir):
+    class FailingSource(SourceFile):
+        def write_to(self, fd):
+            os.write(fd, 'partial')
+            raise IOError('read error')
+    write_tree(str(tmpdir), {'new': 'new\n', 'dest/file': 'old\n'})
+    dest_path = str(tmpdir.join('dest', 'file'))
+    with pytest.raises(IOError):
+        replace_file(dest_path, FailingSource(str(tmpdir.join('new'))), 0644, None, None, IdResolver())
+    assert read(dest_path) == 'old\n'
+    assert os.listdir(str(tmpdir.join('dest'))) == ['file']
+
+def test_copy(src, tmpdir):
+    dest = str(tmpdir.mkdir('dest'))
+    copy(dest, src)
+    assert read(os.path.join(dest, 'etc', 'motd')) == 'hello\n'
+    assert mode_of(os.path.join(dest, 'etc', 'motd')) == 0640
+    assert mode_of(os.path.join(dest, 'etc', 'app')) == 0700
+    assert os.readlink(os.path.join(dest, 'etc', 'link')) == 'motd'
+    assert read(os.path.join(dest, 'etc', 'app', 'conf')) == 'conf\n'
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_umask_is_read_once(src, tmpdir, monkeypatch, jobs):
+    dest = str(tmpdir.mkdir('dest'))
+    old_umask = os.umask(027)
+    try:
+        copier = TreeCopier(jobs=jobs)
+        tree = Tree.from_annotated_fs(src)
+        # setting the umask from a worker would race with the directories
+        # the main thread creates
+        def umask(mask):
+            raise AssertionError("umask changed during the copy")
+        monkeypatch.setattr(os, 'umask', umask)
+        copier(dest, src, tree)
+        monkeypatch.undo()
+    finally:
+        os.umask(old_umask)
+    assert mode_of(os.path.join(dest, 'etc', 'plain')) == 0640
+
+def test_incremental_counts_and_symlink_modes(tmpdir):
+    src = str(tmpdir.join('src'))
+    write_tree(src, {
+        '.muppetmeta': {'entries': {'etc/': {'file-mode': '755'}}},
+        'etc/.muppetmeta': {'entries': {
+            'motd': {'file-mode': '640'},
+            'link': {'symlink': 'motd', 'file-mode': '644'},
+            }},
+        'etc/motd': 'hello\n',
+        'etc/link': '',
+        })
+    dest = str(tmpdir.mkdir('dest'))
+    copier, plan = copy(dest, src, incremental=True)
+    assert (copier.stats.rewritten, copier.stats.metadata_fixed, copier.stats.skipped) == (3, 0, 0)
+    # a link reads as 0777; unless it can be lchmod()ed, it is left alone
+    # rather than taken for drifted and chmod()ed through to its target
+    copier, plan = copy(dest, src, incremental=True)
+    assert (copier.stats.rewritten, copier.stats.metadata_fixed, copier.stats.skipped) == (0, 0, 3)
+    assert mode_of(os.path.join(dest, 'etc', 'motd')) == 0640
+    os.chmod(os.path.join(dest, 'etc', 'motd'), 0600)
+    copier, plan = copy(dest, src, incremental=True)
+    assert (copier.stats.rewritten, copier.stats.metadata_fixed, copier.stats.skipped) == (0, 1, 2)
+    assert plan.select('chmod') == [{'op': 'chmod', 'path': os.path.join(dest, 'etc', 'motd'), 'mode': 0640, 'src': os.path.join(src, 'etc', 'motd')}]
+    assert mode_of(os.path.join(dest, 'etc', 'motd')) == 0640
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_every_failed_write_is_reported_in_order(src, tmpdir, jobs):
+    dest = str(tmpdir.mkdir('dest'))
+    copier = TreeCopier(jobs=jobs)
+    plan = copier.plan(dest, src, Tree.from_annotated_fs(src))
+    # gone between planning and carrying out the plan
+    os.unlink(os.path.join(src, 'etc', 'plain'))
+    os.unlink(os.path.join(src, 'etc', 'app', 'conf'))
+    with pytest.raises(MuppetException) as e:
+        copier.execute(plan)
+    assert str(e.value) == '\n'.join([
+        "%s: [Errno 2] No such file or directory: '%s'" % (os.path.join(dest, 'etc', 'app', 'conf'), os.path.join(src, 'etc', 'app', 'conf')),
+        "%s: [Errno 2] No such file or directory: '%s'" % (os.path.join(dest, 'etc', 'plain'), os.path.join(src, 'etc', 'plain')),
+        ])
+    # the rest of the plan was still carried out
+    assert read(os.path.join(dest, 'etc', 'motd')) == 'hello\n'
+
+def test_unknown_owners_and_groups_are_reported_together(tmpdir):
+    src = str(tmpdir.join('src'))
+    write_tree(src, {
+        '.muppetmeta': {'entries': {'etc/': {'file-owner': 'no-such-user-b'}}},
+        'etc/.muppetmeta': {'entries': {
+            'motd': {'file-owner': 'no-such-user-a', 'file-group': 'no-such-group'},
+            'issue': {'file-owner': 'root'},
+            }},
+        'etc/motd': 'hello\n',
+        'etc/issue': 'issue\n',
+        })
+    dest = str(tmpdir.mkdir('dest'))
+    with pytest.raises(MuppetPrerequisiteError) as e:
+        copy(dest, src)
+    assert str(e.value) == '\n'.join([
+        'No such user: no-such-user-a',
+        'No such user: no-such-user-b',
+        'No such group: no-such-group',
+        ])
+    # found before anything was written
+    assert os.listdir(dest) == []
+
+def test_directory_merge_unions_same_named_children():
+    def directory(name, *children, **kwargs):
+        retval = Directory(name=name, **kwargs)
+        for child in children:
+            retval.add(child)
+        return retval
+    left = directory('etc',
+        directory('app', File(name='conf', mode=0600), mode=0700),
+        File(name='motd', mode=0640, owner='root'),
+        File(name='plain'))
+    right = directory('etc',
+        directory('app', File(name='extra')),
+        File(name='motd', mode=0644),
+        mode=0755)
+
+    merged = left.merge(right)
+    assert merged.mode == 0755
+    assert [e.name for e in merged.children()] == ['app', 'motd', 'plain']
+    app = merged.get('app')
+    assert app.mode == 0700
+    assert [e.name for e in app.children()] == ['conf', 'extra']
+    assert app.get('conf').mode == 0600
+    motd = merged.get('motd')
+    assert (motd.mode, motd.owner) == (0644, 'root')
+    # neither operand is modified
+    assert [e.name for e in left.get('app').children()] == ['conf']
+    assert [e.name for e in right.get('app').children()] == ['extra']
+    assert left.get('motd').mode == 0640
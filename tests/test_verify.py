@@ -0,0 +1,83 @@
+import os
+import sys
+import pytest
+import simplejson as json
+from subprocess import Popen, PIPE
+from muppet.tree import Tree, TreeCopier
+from muppet.verify import TreeVerifier
+from muppet.scripts.local_commands import EXIT_DRIFT
+from helpers import write_tree
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+@pytest.fixture
+def src(tmpdir):
+    root = str(tmpdir.join('src'))
+    write_tree(root, {
+        '.muppetmeta': {'entries': {'etc/': {'file-mode': '755'}}},
+        'etc/.muppetmeta': {'entries': {
+            'motd': {'file-mode': '640'},
+            'issue': {},
+            'hosts': {},
+            'link': {'symlink': 'motd'},
+            'app/': {},
+            }},
+        'etc/motd': 'hello\n',
+        'etc/issue': 'issue\n',
+        'etc/hosts': 'hosts\n',
+        'etc/link': '',
+        'etc/app/conf': 'conf\n',
+        })
+    return root
+
+@pytest.fixture
+def dest(src, tmpdir):
+    root = str(tmpdir.mkdir('dest'))
+    copier = TreeCopier(incremental=True, cache_dir=str(tmpdir.join('cache')))
+    copier(root, src, Tree.from_annotated_fs(src))
+    copier.finish()
+    return root
+
+def verify(dest, src, **kwargs):
+    return TreeVerifier(**kwargs).verify(dest, src, Tree.from_annotated_fs(src))
+
+def test_no_drift(src, dest, tmpdir):
+    report = verify(dest, src, cache_dir=str(tmpdir.join('cache')))
+    assert report.drift == []
+    assert report.checked == 7
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_drift(src, dest, jobs):
+    etc = os.path.join(dest, 'etc')
+    os.chmod(os.path.join(etc, 'motd'), 0644)
+    # same size, so only the content tells
+    write_tree(etc, {'issue': 'ISSUE\n', 'stray': 'stray\n'})
+    os.unlink(os.path.join(etc, 'hosts'))
+    os.unlink(os.path.join(etc, 'link'))
+    os.symlink('issue', os.path.join(etc, 'link'))
+    os.unlink(os.path.join(etc, 'app', 'conf'))
+    os.mkdir(os.path.join(etc, 'app', 'conf'))
+    report = verify(dest, src, jobs=jobs)
+    assert sorted((drift['path'][len(etc) + 1:], drift['drift']) for drift in report.drift) == [
+        ('app/conf', 'type'), ('hosts', 'missing'), ('issue', 'content'),
+        ('link', 'target'), ('motd', 'mode')]
+    assert report.unmanaged == [os.path.join(etc, 'stray')]
+
+def run_muppet(*args):
+    env = dict(os.environ, PYTHONPATH=os.path.join(os.path.dirname(here), 'src'))
+    process = Popen(
+        [sys.executable, '-c', 'from muppet.scripts.muppet_ import main; main()'] + list(args),
+        stdout=PIPE, stderr=PIPE, env=env)
+    out, err = process.communicate()
+    return process.returncode, out
+
+def test_exit_status(src, dest):
+    status, out = run_muppet('verify', src, dest)
+    assert status == 0
+    assert json.loads(out)['drift'] == []
+    os.chmod(os.path.join(dest, 'etc', 'motd'), 0644)
+    status, out = run_muppet('verify', src, dest)
+    assert status == EXIT_DRIFT
+    assert [drift['drift'] for drift in json.loads(out)['drift']] == ['mode']
+    status, out = run_muppet('verify', os.path.join(src, 'missing'), dest)
+    assert status == 1